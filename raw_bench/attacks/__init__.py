@@ -1,25 +1,93 @@
+import multiprocessing
 import os
-from omegaconf import DictConfig
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from omegaconf import DictConfig, OmegaConf
 from loguru import logger
 import pandas as pd
 import torch
 from torch import nn
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 import torchaudio
 import torchaudio.functional as F
 
 from grafx.processors import GraphicEqualizer
 
-from .compression import aac_wrapper, mp3_wrapper, vorbis_wrapper
+from .cache import AttackCache
+from .compression import CODEC_BACKENDS, CODEC_FRAME_SIZES, aac_wrapper, configure_codec_service, get_codec_service, mp3_wrapper, vorbis_wrapper
 from .dynamics import dynamic_range_compression, dynamic_range_expansion
 from .filtering import highpass_filter, lowpass_filter
 from .low_level import inverse_polarity, phase_shift, quantize, time_jitter, time_stretch_wrapper
-from .neural_codecs import DACWrapper, EncodecWrapper
 from .noise import gaussian_noise
 from .specaugment import freq_mask, time_mask
 from .utils import ste, choose_random_uniform_val, sample_from_intervals
 
 
+# Version of the attack implementations. Bump it whenever an attack changes its output for the same input and
+# parameters (2: torch dynamics and time stretching, 3: one encoder per item of a batched codec round-trip,
+# 4: MP3 encoded at the attack sampling rate), so that results and cached attacked audio of an older
+# implementation are not reused
+ATTACK_IMPLEMENTATION_VERSION = 4
+
+# AudioAttack of a worker process of the attack pool (see `AudioAttack.submit`)
+_WORKER_ATTACK = None
+
+
+def _init_attack_worker(
+    attack_kwargs: dict
+):
+    """
+    Initializer of the worker processes of the attack pool. Each worker holds its own CPU
+    `AudioAttack` (ffmpeg path, noise/RIR paths and configuration), built once per process.
+
+    Args:
+        attack_kwargs: dict
+            Keyword arguments of `AudioAttack`.
+    """
+    global _WORKER_ATTACK
+    # Workers already run in parallel, avoid oversubscribing the cores
+    torch.set_num_threads(1)
+    _WORKER_ATTACK = AudioAttack(**attack_kwargs)
+
+
+def _apply_attack_in_worker(
+    audio: torch.Tensor,
+    attack_type: str,
+    kwargs: dict,
+    submitted_at: float
+) -> Tuple[torch.Tensor, float, dict]:
+    """
+    Apply an attack in a worker process of the attack pool.
+
+    Args:
+        audio: torch.Tensor
+            Input audio tensor (on CPU).
+        attack_type: str
+            Attack to apply.
+        kwargs: dict
+            Parameters of the attack.
+        submitted_at: float
+            Time at which the attack was submitted to the pool (`time.time()`).
+
+    Returns:
+        Tuple[torch.Tensor, float, dict]: Distorted audio (on CPU), time spent in the pool queue,
+            and codec statistics of the worker since its last task (see `CodecService.pop_stats`).
+    """
+    queue_wait = time.time() - submitted_at
+    with torch.inference_mode():
+        distorted_audio = _WORKER_ATTACK(audio, attack_type=attack_type, **kwargs)
+    return distorted_audio, queue_wait, get_codec_service().pop_stats()
+
+
+def _completed_future(
+    result: torch.Tensor
+) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
 class AudioAttack(nn.Module):
     """
     Implements a variety of audio attacks and augmentations for robustness evaluation.
@@ -37,6 +105,26 @@ class AudioAttack(nn.Module):
             Configuration for attack parameters and settings.
         ffmpeg4codecs: str
             Path to ffmpeg binary for codecs.
+        codec_backend: str
+            Backend of the MP3, AAC and Vorbis attacks: 'ffmpeg' (ffmpeg4codecs in a subprocess)
+            or 'torchaudio' (in-process encoding and decoding).
+        codec_batching: bool
+            Whether the MP3, AAC and Vorbis attacks encode all the items of a batch in a single encoder
+            session, separated by frame-aligned silence (otherwise they are applied item by item).
+        codec_delay_table: str, optional
+            Path to the table of calibrated MP3, AAC and Vorbis delays (see `compression.CodecDelayTable`).
+            If provided, the delays are removed analytically instead of trimming the end of the decoded
+            signal (MP3, Vorbis) or searching the delay for every signal (AAC).
+        codec_cache_dir: str, optional
+            Directory of the on-disk cache of MP3, AAC and Vorbis outputs (see `compression.cached_codec`).
+            Unlike `cache`, it is also used in the worker processes and by training.
+        codec_cache_max_size_gb: float
+            Maximum size of the codec cache, in GB. The least recently used outputs are evicted beyond it.
+        codec_max_concurrency: int, optional
+            Maximum number of concurrent MP3, AAC and Vorbis round-trips in each process (default: number
+            of cores). See `compression.CodecService`.
+        codec_scratch_dir: str, optional
+            Parent directory of the scratch files of the codecs (default: /dev/shm if writable).
         mixing_train_filepath: str
             Path to CSV file for mixing noises.
         reverb_train_filepath: str
@@ -47,6 +135,28 @@ class AudioAttack(nn.Module):
             Whether to apply a single attack or composite attacks. currently only single attacks are supported.
         device: str
             Device to run computations on.
+        cache: AttackCache, optional
+            On-disk cache of attacked audio, used when `forward` is called with `use_cache=True`.
+        cached_attacks: list, optional
+            Attacks stored in the cache. Only deterministic attacks (given their parameters) should be listed.
+        num_workers: int
+            Number of worker processes used by `submit` for CPU-bound attacks (0: run them in the calling process).
+        pool_attacks: list, optional
+            Attacks run in the worker processes. Only CPU attacks that are deterministic given their
+            parameters should be listed, since the workers have their own random state. If 'dac' or
+            'encodec' are listed, their weights are shared with the workers (see `export_codec_weights`).
+        neural_codec_window: dict, optional
+            Windowing of long inputs of the neural codecs: `window_seconds` (None: no windowing),
+            `overlap_seconds` and `max_batch_windows` (see `neural_codecs.NeuralCodecWrapper.encode_codes`).
+        neural_codec_inference: str
+            Inference mode of the neural codecs: 'fp32', 'bf16', 'int8' or 'compile'
+            (see `neural_codecs.NeuralCodecWrapper.optimize_inference`).
+        init_neural_codecs: bool
+            Whether the neural codecs (DAC and Encodec) may be loaded, on first use. Disabled in the worker
+            processes, unless the neural codecs are in `pool_attacks`.
+        shared_codec_weights: dict, optional
+            Weights of the neural codecs exported by another process, by codec ('dac' or 'encodec').
+            The codecs are then built from these memory-mapped weights instead of being downloaded and loaded.
     """
     def __init__(
         self,
@@ -56,11 +166,26 @@ class AudioAttack(nn.Module):
         mode: str = 'test',
         config: DictConfig = None,
         ffmpeg4codecs: Optional[str] = None,
+        codec_backend: str = 'ffmpeg',
+        codec_batching: bool = False,
+        codec_delay_table: Optional[str] = None,
+        codec_cache_dir: Optional[str] = None,
+        codec_cache_max_size_gb: float = 10.0,
+        codec_max_concurrency: Optional[int] = None,
+        codec_scratch_dir: Optional[str] = None,
         mixing_train_filepath: Optional[str] = None,
         reverb_train_filepath: Optional[str] = None,
         delimiter: str = '|',
         single_attack: bool = True,
-        device: str = 'cuda'
+        device: str = 'cuda',
+        cache: Optional[AttackCache] = None,
+        cached_attacks: Optional[List[str]] = None,
+        num_workers: int = 0,
+        pool_attacks: Optional[List[str]] = None,
+        neural_codec_window: Optional[dict] = None,
+        neural_codec_inference: str = 'fp32',
+        init_neural_codecs: bool = True,
+        shared_codec_weights: Optional[Dict[str, str]] = None
     ):
         """
         Initialize AudioAttack with configuration and resources.
@@ -74,15 +199,56 @@ class AudioAttack(nn.Module):
         self.single_attack = single_attack
         self.device = device
         self.ffmpeg4codecs = ffmpeg4codecs
+        if codec_backend not in CODEC_BACKENDS:
+            raise ValueError(f"codec_backend should be one of {CODEC_BACKENDS}, got {codec_backend}.")
+        self.codec_backend = codec_backend
+        self.codec_batching = codec_batching
+        self.codec_delay_table = codec_delay_table
+        self.codec_cache_dir = codec_cache_dir
+        self.codec_cache_max_size_gb = codec_cache_max_size_gb
+        configure_codec_service(max_concurrency=codec_max_concurrency, scratch_root=codec_scratch_dir)
+        self.cache = cache
+        self.cached_attacks = set(cached_attacks) if cached_attacks is not None else {
+            'aac', 'mp3', 'vorbis', 'dac', 'encodec', 'time_stretch',
+            'dynamic_range_compression', 'dynamic_range_expansion', 'limiter'}
+        self.num_workers = num_workers
+        self.pool_attacks = set(pool_attacks) if pool_attacks is not None else {
+            'aac', 'mp3', 'vorbis', 'background_noise', 'reverb', 'time_stretch',
+            'dynamic_range_compression', 'dynamic_range_expansion', 'limiter'}
+        self.pool = None
+        # Everything needed to build the same attacks (on CPU) in the worker processes.
+        # Configs are resolved, since interpolations may refer to the parent config.
+        self.worker_kwargs = dict(sr=sr,
+                                  datapath=OmegaConf.to_container(datapath, resolve=True) 
+                                           if isinstance(datapath, DictConfig) else datapath,
+                                  mode=mode,
+                                  config=OmegaConf.create(OmegaConf.to_container(config, resolve=True))
+                                         if isinstance(config, DictConfig) else config,
+                                  ffmpeg4codecs=ffmpeg4codecs,
+                                  codec_backend=codec_backend,
+                                  codec_batching=codec_batching,
+                                  codec_delay_table=codec_delay_table,
+                                  codec_cache_dir=codec_cache_dir,
+                                  codec_cache_max_size_gb=codec_cache_max_size_gb,
+                                  codec_max_concurrency=codec_max_concurrency,
+                                  codec_scratch_dir=codec_scratch_dir,
+                                  mixing_train_filepath=mixing_train_filepath,
+                                  reverb_train_filepath=reverb_train_filepath,
+                                  delimiter=delimiter,
+                                  single_attack=single_attack,
+                                  device='cpu',
+                                  neural_codec_window=neural_codec_window,
+                                  neural_codec_inference=neural_codec_inference,
+                                  init_neural_codecs=False)
         if self.ffmpeg4codecs is None:
-            logger.warning(
-                "ffmpeg4codecs is not provided. "
-                "Codec attacks may not work properly if your default ffmpeg "
-                "does not support all of them."
-            )
-        else:
-            if not os.path.exists(self.ffmpeg4codecs):
-                raise FileNotFoundError(f"ffmpeg binary not found at {self.ffmpeg4codecs}.")
+            if self.codec_backend == 'ffmpeg':
+                logger.warning(
+                    "ffmpeg4codecs is not provided. "
+                    "Codec attacks may not work properly if your default ffmpeg "
+                    "does not support all of them."
+                )
+        elif not os.path.exists(self.ffmpeg4codecs):
+            raise FileNotFoundError(f"ffmpeg binary not found at {self.ffmpeg4codecs}.")
 
         # Initialize the mixing file for training
         if self.mode == 'train':
@@ -98,11 +264,16 @@ class AudioAttack(nn.Module):
         else:
             self.df_train_rir = None
 
-        # Initialize the graphic equalizer (GEQ) based on second-order peaking filters
-        self._init_graphic_eq()
-
-        # Initialize neural codecs (Encodec and DAC)
-        self._init_neural_codecs()
+        # The graphic equalizer (GEQ) and the neural codecs (Encodec and DAC) are built on first use 
+        # (see `eq`, `encodec` and `dac`), so runs without these attacks never load them
+        self.init_neural_codecs = init_neural_codecs
+        self.neural_codec_window = dict(neural_codec_window or {})
+        self.neural_codec_inference = neural_codec_inference
+        self.shared_codec_weights = dict(shared_codec_weights or {})
+        self._lazy_init_lock = threading.Lock()
+        self._eq = None
+        self._encodec = None
+        self._dac = None
 
         # Initialize the dictionary of attacks
         self._init_dict_attacks()
@@ -111,12 +282,70 @@ class AudioAttack(nn.Module):
         # Initialize the attack probabilities for each attack
         self._init_attack_probabilities()
 
+        # Attacks that can only process a single item at a time. For a batch (B > 1),
+        # these are applied item by item (codecs would otherwise leak state across items).
+        self.per_item_attacks = {'aac', 'mp3', 'vorbis',
+                                 'eq', 'reverb', 'freq_mask', 'time_mask'}
+        if self.codec_batching:
+            # Items are separated within the encoded signal, see `compression.batched_roundtrip`
+            self.per_item_attacks -= {'aac', 'mp3', 'vorbis'}
+        # Attacks that process a batch at once, but with parameters drawn for each item in train mode
+        self.per_item_train_attacks = {'dynamic_range_compression', 'dynamic_range_expansion', 'limiter', 'time_stretch'}
+
+    @property
+    def eq(self) -> GraphicEqualizer:
+        """
+        Graphic equalizer of the equalization attacks, built on first use.
+        """
+        with self._lazy_init_lock:
+            if self._eq is None:
+                self._init_graphic_eq()
+        return self._eq
+
+    @property
+    def encodec(self) -> 'EncodecWrapper':
+        """
+        Encodec wrapper of the neural compression attacks, loaded on first use.
+        """
+        with self._lazy_init_lock:
+            if self._encodec is None:
+                self._init_neural_codecs('encodec')
+        return self._encodec
+
+    @property
+    def dac(self) -> 'DACWrapper':
+        """
+        DAC wrapper of the neural compression attacks, loaded on first use.
+        """
+        with self._lazy_init_lock:
+            if self._dac is None:
+                self._init_neural_codecs('dac')
+        return self._dac
+
+    def release(
+        self
+    ):
+        """
+        Free the graphic equalizer and the neural codecs, if loaded. They are loaded again if used afterwards.
+        """
+        with self._lazy_init_lock:
+            loaded = [name for name in ['eq', 'encodec', 'dac'] if getattr(self, f'_{name}') is not None]
+            self._eq = None
+            self._encodec = None
+            self._dac = None
+            self.model_sr2eq_sr = None
+            self.eq_sr2model_sr = None
+        if len(loaded) > 0:
+            logger.info(f"Released {', '.join(loaded)}")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     def _init_graphic_eq(self):
         """
         Initialize the graphic equalizer and resamplers for equalization attacks.
         """
-        self.eq = GraphicEqualizer(sr=self.config.eq.sr,
-                                   scale=self.config.eq.scale).to(self.device)
+        eq = GraphicEqualizer(sr=self.config.eq.sr,
+                              scale=self.config.eq.scale).to(self.device)
         
         if self.sr != self.config.eq.sr:
             self.model_sr2eq_sr= torchaudio.transforms.Resample(orig_freq=self.sr, 
@@ -128,25 +357,102 @@ class AudioAttack(nn.Module):
             self.eq_resampler = None
 
         if self.config.eq.scale == 'bark':
-            self.eq.num_bands = 24
+            eq.num_bands = 24
         elif self.config.eq.scale == 'third_oct':
-            self.eq.num_bands = 31
+            eq.num_bands = 31
         else:
             raise ValueError('scale should be one of bark or third_oct.')
+        self._eq = eq
 
-    def _init_neural_codecs(self):
+    def _init_neural_codecs(
+        self,
+        codec: str
+    ):
+        """
+        Initialize a neural audio codec (Encodec or DAC) for compression attacks.
+
+        Args:
+            codec: str
+                Codec to load ('encodec' or 'dac').
+        """
+        if not self.init_neural_codecs:
+            raise RuntimeError(f"{codec} is not available: neural codecs are disabled (init_neural_codecs=False).")
+        wrapper = self._build_neural_codec(codec, 
+                                           inference=self.neural_codec_inference, 
+                                           shared_weights=self.shared_codec_weights.get(codec))
+        setattr(self, f'_{codec}', wrapper)
+        source = ' from shared weights' if codec in self.shared_codec_weights else ''
+        logger.info(f"Loaded {codec} ({self.config[codec].type}){source}")
+
+    def _build_neural_codec(
+        self,
+        codec: str,
+        inference: str,
+        shared_weights: Optional[str] = None
+    ) -> 'NeuralCodecWrapper':
         """
-        Initialize neural audio codecs (Encodec and DAC) for compression attacks.
+        Build the wrapper of a neural audio codec (Encodec or DAC).
+
+        Args:
+            codec: str
+                Codec to build ('encodec' or 'dac').
+            inference: str
+                Inference mode of the codec (see `neural_codec_inference`).
+            shared_weights: str, optional
+                File of weights exported by `export_codec_weights` (default: download and load the model).
+
+        Returns:
+            NeuralCodecWrapper: Wrapper of the codec.
+        """
+        # Imported here, since DAC and transformers are slow to import
+        from .neural_codecs import DACWrapper, EncodecWrapper
+
+        if codec == 'encodec':
+            return EncodecWrapper(
+                codec_type=self.config.encodec.type,
+                model_sr=self.sr,
+                device=self.device,
+                inference=inference,
+                shared_weights=shared_weights,
+                **self.neural_codec_window
+            )
+        elif codec == 'dac':
+            return DACWrapper(
+                codec_type=self.config.dac.type,
+                device=self.device,
+                inference=inference,
+                shared_weights=shared_weights,
+                **self.neural_codec_window
+            )
+        else:
+            raise ValueError(f"Unknown neural codec {codec}.")
+
+    def export_codec_weights(
+        self,
+        codec: str
+    ) -> str:
+        """
+        Export the weights of a neural codec to a memory-mapped file for the worker processes.
+
+        Every worker attaching the file shares the same physical pages, instead of loading its own
+        copy of the model. The codec of this process is reused if it is already loaded in an exportable
+        mode (fp32 or bf16); otherwise a temporary fp32 copy is loaded and freed after the export.
+
+        Args:
+            codec: str
+                Codec to export ('encodec' or 'dac').
+
+        Returns:
+            str: Path of the file (see `neural_codecs.NeuralCodecWrapper.export_weights`).
         """
-        self.encodec = EncodecWrapper(
-            codec_type=self.config.encodec.type,
-            model_sr=self.sr,
-            device=self.device
-        )
-        self.dac = DACWrapper(
-            codec_type=self.config.dac.type,
-            device=self.device
-        )
+        wrapper = getattr(self, f'_{codec}')
+        if wrapper is None or wrapper.inference not in ['fp32', 'bf16']:
+            wrapper = self._build_neural_codec(codec, 
+                                               inference='fp32',
+                                               shared_weights=self.shared_codec_weights.get(codec))
+        path = wrapper.export_weights()
+        logger.info(f"Exported the weights of {codec} to {path}")
+        return path
 
     def _init_dict_attacks(self):
         """
@@ -177,25 +483,121 @@ class AudioAttack(nn.Module):
             mode: str
                 Mode to set ('train', 'test', or 'val').
         """
+        if mode != self.mode and self.pool is not None:
+            # The workers were built with the previous mode
+            self.close()
         self.mode = mode
+        self.worker_kwargs['mode'] = mode
+
+    def submit(
+        self,
+        audio: torch.Tensor,
+        attack_type: str,
+        use_cache: bool = False,
+        **kwargs
+    ) -> Future:
+        """
+        Apply an attack asynchronously.
+
+        Attacks in `pool_attacks` (CPU-bound: ffmpeg codecs, dynamics, time stretching, ...)
+        run in a persistent pool of `num_workers` processes, so that independent rows are attacked in
+        parallel across cores. The other attacks, or all of them if `num_workers` is 0, run in the calling
+        process and return an already completed future.
+
+        Args:
+            audio: torch.Tensor
+                Input audio tensor of shape (B, C, T) or (C, T).
+            attack_type: str
+                Attack to apply.
+            use_cache: bool
+                Whether to use the attack cache (see `forward`).
+
+        Returns:
+            Future: Future of the distorted audio, on the device of the input audio.
+        """
+        if self.num_workers == 0 or self.mode == 'train' or attack_type not in self.pool_attacks:
+            return _completed_future(self.forward(audio, attack_type=attack_type, use_cache=use_cache, **kwargs))
+
+        if audio.dim() == 2:
+            audio = audio.unsqueeze(0)
+
+        keys = None
+        if use_cache and self.cache is not None and attack_type in self.cached_attacks:
+            keys = [self.cache.key(audio[b], self.sr, attack_type, kwargs) for b in range(audio.shape[0])]
+            outputs = [self.cache.get(key) for key in keys]
+            if all(output is not None for output in outputs):
+                return _completed_future(torch.stack([output.to(audio.device) for output in outputs], dim=0))
+
+        if self.pool is None:
+            neural_codecs = sorted(self.pool_attacks & {'dac', 'encodec'})
+            if len(neural_codecs) > 0 and self.init_neural_codecs and 'shared_codec_weights' not in self.worker_kwargs:
+                # The workers map the weights of the parent instead of loading one copy of the model each
+                # (the files are kept for the pools started later, e.g. after `set_mode`)
+                self.worker_kwargs['shared_codec_weights'] = {codec: self.export_codec_weights(codec)
+                                                              for codec in neural_codecs}
+                self.worker_kwargs['init_neural_codecs'] = True
+            # spawn: the workers must not inherit the CUDA context of the parent process
+            self.pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_attack_worker,
+                                            initargs=(self.worker_kwargs,))
+            logger.info(f"Started {self.num_workers} attack worker processes for {sorted(self.pool_attacks)}")
+
+        device = audio.device
+        worker_future = self.pool.submit(_apply_attack_in_worker, audio.detach().cpu(), attack_type, kwargs, time.time())
+        future = Future()
+
+        def _done(worker_future: Future):
+            try:
+                distorted_audio, queue_wait, codec_stats = worker_future.result()
+                get_codec_service().merge_stats(codec_stats)
+                if attack_type in CODEC_FRAME_SIZES:
+                    # Waiting for a free worker process delays the codec as much as waiting for a codec slot
+                    get_codec_service().record(attack_type, wait_s=queue_wait)
+                if keys is not None:
+                    for b, key in enumerate(keys):
+                        self.cache.put(key, distorted_audio[b])
+                future.set_result(distorted_audio.to(device))
+            except BaseException as e:
+                future.set_exception(e)
+
+        worker_future.add_done_callback(_done)
+
+        return future
+
+    def close(
+        self
+    ):
+        """
+        Shut down the worker processes of `submit`, if any.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
 
     def forward(
         self,
         audio: torch.Tensor,
         attack_type: Optional[str] = None,
         return_attack_params: bool = False,
+        use_cache: bool = False,
         **kwargs
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, str, dict]]:
         """
         Apply a randomly selected or specified attack to the input audio.
+        All the items of a batch are distorted with the same attack type (and, in val and test
+        modes, with the same parameters).
 
         Args:
             audio: torch.Tensor
-                Input audio tensor.
+                Input audio tensor of shape (B, C, T) or (C, T).
             attack_type: str. optional
                 Specific attack to apply.
             return_attack_params: bool
                 Whether to return attack parameters.
+            use_cache: bool
+                Whether to look up the attacked audio in the attack cache (if any) before computing it.
+                Only used in val and test modes, for the attacks in `cached_attacks`.
 
         Returns:
             torch.Tensor or (torch.Tensor, str, dict): Distorted audio, and optionally attack type and parameters.
@@ -219,6 +621,26 @@ class AudioAttack(nn.Module):
         else:
             raise NotImplementedError('Composite attacks are not yet implemented.')
 
+        if use_cache and self.cache is not None and self.mode != 'train' and attack_type in self.cached_attacks:
+            distorted_audio, attack_params = self._forward_cached(audio, attack_type, **kwargs)
+
+            if return_attack_params:
+                return distorted_audio, attack_type, attack_params
+            else:
+                return distorted_audio
+
+        per_item = attack_type in self.per_item_attacks or (self.mode == 'train' and attack_type in self.per_item_train_attacks)
+        if audio.shape[0] > 1 and per_item:
+            outputs = [self.forward(audio[b:b+1], attack_type=attack_type, return_attack_params=True, **kwargs)
+                       for b in range(audio.shape[0])]
+            distorted_audio = torch.cat([output[0] for output in outputs], dim=0)
+            attack_type, attack_params = outputs[0][1], outputs[0][2]
+
+            if return_attack_params:
+                return distorted_audio, attack_type, attack_params
+            else:
+                return distorted_audio
+
         # Spectrogram-based attacks
         if attack_type in ['freq_mask', 'time_mask']:
             distorted_audio, attack_type, attack_params = self.apply_specaugment(audio=audio, 
@@ -228,15 +650,55 @@ class AudioAttack(nn.Module):
         else:
             distorted_audio, attack_type, attack_params = attack_fn(audio, **kwargs)
     
-        # Normalize the audio, if needed, except for gain attacks
-        if distorted_audio.abs().max() > 1 and attack_type != 'gain':
-            distorted_audio = distorted_audio / distorted_audio.abs().max()
+        # Normalize each item of the audio, if needed, except for gain attacks
+        if attack_type != 'gain':
+            peak = distorted_audio.abs().reshape(distorted_audio.shape[0], -1).amax(dim=1)
+            peak = peak.reshape(-1, *([1] * (distorted_audio.dim() - 1)))
+            distorted_audio = torch.where(peak > 1, distorted_audio / peak, distorted_audio)
 
         if return_attack_params:
             return distorted_audio, attack_type, attack_params
         else:
             return distorted_audio
 
+    def _forward_cached(
+        self,
+        audio: torch.Tensor,
+        attack_type: str,
+        **kwargs
+    ) -> Tuple[torch.Tensor, dict]:
+        """
+        Apply an attack through the attack cache: items found in the cache are loaded,
+        and the others are attacked together and stored.
+
+        Args:
+            audio: torch.Tensor
+                Input audio tensor of shape (B, C, T).
+            attack_type: str
+                Attack to apply.
+
+        Returns:
+            Tuple[torch.Tensor, dict]: Distorted audio and attack parameters.
+        """
+        keys = [self.cache.key(audio[b], self.sr, attack_type, kwargs) for b in range(audio.shape[0])]
+        outputs = [self.cache.get(key) for key in keys]
+        # Cached items are only stored with their given parameters
+        attack_params = dict(kwargs)
+
+        missing = [b for b, output in enumerate(outputs) if output is None]
+        if len(missing) > 0:
+            distorted_audio, _, attack_params = self.forward(audio[missing], 
+                                                             attack_type=attack_type,
+                                                             return_attack_params=True, 
+                                                             **kwargs)
+            for i, b in enumerate(missing):
+                self.cache.put(keys[b], distorted_audio[i])
+                outputs[b] = distorted_audio[i]
+
+        distorted_audio = torch.stack([output.to(audio.device) for output in outputs], dim=0)
+
+        return distorted_audio, attack_params
+
     def apply_specaugment(
         self,
         audio: torch.Tensor,
@@ -463,7 +925,10 @@ class AudioAttack(nn.Module):
             ffmpeg4codecs = self.ffmpeg4codecs
                     
         return ste(original=x, 
-                   compressed=mp3_wrapper(x, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)), 'mp3', {'bitrate': bitrate}
+                   compressed=mp3_wrapper(x, sr=self.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs, 
+                                          backend=self.codec_backend, batched=self.codec_batching, 
+                                          delay_table=self.codec_delay_table, cache_dir=self.codec_cache_dir,
+                                          cache_max_size_gb=self.codec_cache_max_size_gb)), 'mp3', {'bitrate': bitrate}
 
     def apply_vorbis(
         self, 
@@ -496,7 +961,10 @@ class AudioAttack(nn.Module):
             ffmpeg4codecs = self.ffmpeg4codecs
 
         return ste(original=x, 
-                   compressed=vorbis_wrapper(x, sr=self.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)), 'vorbis', {'bitrate': bitrate}
+                   compressed=vorbis_wrapper(x, sr=self.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs, 
+                                             backend=self.codec_backend, batched=self.codec_batching, 
+                                             delay_table=self.codec_delay_table, cache_dir=self.codec_cache_dir,
+                                             cache_max_size_gb=self.codec_cache_max_size_gb)), 'vorbis', {'bitrate': bitrate}
 
     def apply_aac(
         self, 
@@ -529,7 +997,10 @@ class AudioAttack(nn.Module):
             ffmpeg4codecs = self.ffmpeg4codecs
 
         return ste(original=x, 
-                   compressed=aac_wrapper(x, sr=self.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)), 'aac', {'bitrate': bitrate}
+                   compressed=aac_wrapper(x, sr=self.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs, 
+                                          backend=self.codec_backend, batched=self.codec_batching, 
+                                          delay_table=self.codec_delay_table, cache_dir=self.codec_cache_dir,
+                                          cache_max_size_gb=self.codec_cache_max_size_gb)), 'aac', {'bitrate': bitrate}
     
     # Filtering
     def apply_lowpass(
@@ -610,9 +1081,11 @@ class AudioAttack(nn.Module):
         """
         
         length = x.shape[-1]
+        # Builds the equalizer and its resamplers on first use
+        eq = self.eq
         if self.mode == 'train' and log_band_gains is None:
             log_band_gains = sample_from_intervals(intervals=self.config.eq.threshold_intervals, 
-                                                   num_samples=self.eq.num_bands)
+                                                   num_samples=eq.num_bands)
 
         
         elif self.mode in ['test', 'val'] and log_band_gains is None:
@@ -625,8 +1098,8 @@ class AudioAttack(nn.Module):
         else:
             x_eq = x
 
-        distorted = self.eq(x_eq, 
-                            log_gains=log_band_gains)
+        distorted = eq(x_eq, 
+                       log_gains=log_band_gains)
         
         if self.sr != self.config.eq.sr:
             distorted = self.eq_sr2model_sr(distorted)
@@ -923,15 +1396,8 @@ class AudioAttack(nn.Module):
         elif self.mode in ['test', 'val'] and rate is None:
             raise ValueError('rate should be provided in val and test modes.')
         
-        stretched_audio = time_stretch_wrapper(audio=x, rate=rate)
-
-        output_len = x.shape[-1]
-        output_tensor = torch.zeros_like(x, device=x.device)
-
-        if stretched_audio.shape[-1] > output_len:
-            output_tensor = stretched_audio[..., :output_len]
-        else:
-            output_tensor[..., :stretched_audio.shape[-1]] = stretched_audio
+        # Truncated or zero-padded to the input length
+        output_tensor = time_stretch_wrapper(audio=x, rate=rate, length=x.shape[-1])
         
         return output_tensor, 'time_stretch', {'rate': rate}
 
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from typing import Optional
+
+import numpy as np
+import torch
+from loguru import logger
+
+
+class AttackCache(object):
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size_gb: float = 20.0,
+        namespace: Optional[dict] = None,
+        dtype: str = 'float32'
+    ):
+        """
+        Content-addressed on-disk cache of attacked audio.
+
+        Entries are keyed by a SHA-256 hash of the input samples, the sample rate, the attack type,
+        the canonical (sorted JSON) attack parameters and a namespace describing everything else
+        the attack output depends on (ffmpeg binary, codec types, ...). Since the key does not depend
+        on the watermarking model, the attacked unwatermarked audio computed for one model is reused
+        by the others.
+
+        The total size is capped: when it exceeds `max_size_gb`, the least recently used entries
+        (by modification time, refreshed on every hit) are removed. Entries are written atomically,
+        so several processes can share the same cache directory.
+
+        Args:
+            cache_dir: str
+                Directory of the cache.
+            max_size_gb: float, optional
+                Maximum total size of the cache, in GB.
+            namespace: dict, optional
+                Additional JSON-serializable settings included in every key.
+            dtype: str, optional
+                Storage format of the entries: 'float32' (exact, .npy) or 'int16' (compressed 16-bit
+                samples with a scale factor, .npz), which is about 3x smaller for decoded codec outputs.
+        """
+        if dtype not in ('float32', 'int16'):
+            raise ValueError(f"dtype should be one of float32, int16, got {dtype}.")
+
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.suffix = '.npy' if dtype == 'float32' else '.npz'
+        self.max_size = int(max_size_gb * 1024**3)
+        self.namespace = json.dumps(namespace or {}, sort_keys=True, default=str)
+        self.num_hits = 0
+        self.num_misses = 0
+        # The cache may be used by several attack threads (see `pipeline.attack_workers`)
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+        logger.info(f"Attack cache at {self.cache_dir} ({self.size / 1024**3:.2f} GB / {max_size_gb:.2f} GB)")
+
+    def key(
+        self,
+        audio: torch.Tensor,
+        sr: int,
+        attack_type: str,
+        attack_params: dict
+    ) -> str:
+        """
+        Compute the key of an attacked audio.
+
+        Args:
+            audio: torch.Tensor
+                Input audio of the attack (a single item).
+            sr: int
+                Sample rate of the audio.
+            attack_type: str
+                Attack type.
+            attack_params: dict
+                Parameters of the attack.
+
+        Returns:
+            str: Hexadecimal SHA-256 digest.
+        """
+        h = hashlib.sha256()
+        h.update(audio.detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+        h.update(str(tuple(audio.shape)).encode('utf-8'))
+        h.update(json.dumps({'sr': sr,
+                             'attack_type': attack_type,
+                             'attack_params': attack_params,
+                             'namespace': self.namespace}, sort_keys=True, default=str).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(
+        self,
+        key: str
+    ) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}{self.suffix}")
+
+    def get(
+        self,
+        key: str
+    ) -> Optional[torch.Tensor]:
+        """
+        Look up an attacked audio.
+
+        Args:
+            key: str
+                Key of the entry (see `key`).
+
+        Returns:
+            torch.Tensor or None: Cached audio (on CPU), or None if the entry does not exist.
+        """
+        path = self._path(key)
+        try:
+            if self.dtype == 'float32':
+                audio = np.load(path)
+            else:
+                with np.load(path) as data:
+                    audio = self._dequantize(data['audio'], data['scale'])
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError, KeyError, zipfile.BadZipFile):
+            # Missing, evicted by another process, or partially written
+            with self._lock:
+                self.num_misses += 1
+            return None
+
+        with self._lock:
+            self.num_hits += 1
+        return torch.from_numpy(audio)
+
+    def put(
+        self,
+        key: str,
+        audio: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Store an attacked audio, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key: str
+                Key of the entry (see `key`).
+            audio: torch.Tensor
+                Attacked audio (a single item).
+
+        Returns:
+            torch.Tensor: Audio as stored (on CPU), i.e. exactly as `get` returns it. With int16 storage,
+                callers should use it instead of `audio`, so that cache misses and hits give the same output.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        audio = audio.detach().to('cpu', torch.float32).numpy()
+        with os.fdopen(fd, 'wb') as f:
+            if self.dtype == 'float32':
+                np.save(f, audio)
+            else:
+                # Decoded audio may overshoot [-1, 1], so the samples are scaled by the peak (if > 1)
+                scale = np.float32(max(1.0, float(np.abs(audio).max(initial=0.0))))
+                quantized = np.round(audio / scale * 32767).astype(np.int16)
+                np.savez_compressed(f, audio=quantized, scale=scale)
+                audio = self._dequantize(quantized, scale)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size += os.path.getsize(path)
+            is_full = self.size > self.max_size
+        if is_full:
+            self.evict()
+
+        return torch.from_numpy(audio)
+
+    @staticmethod
+    def _dequantize(
+        audio: np.ndarray,
+        scale: np.ndarray
+    ) -> np.ndarray:
+        """
+        Convert the 16-bit samples of an int16 entry back to float32.
+        """
+        return audio.astype(np.float32) * (scale / 32767)
+
+    def evict(
+        self
+    ):
+        """
+        Remove the least recently used entries until the cache uses at most 90% of its maximum size.
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            self.size = sum(size for _, _, size in entries)
+            target_size = int(0.9 * self.max_size)
+            num_removed = 0
+            for path, _, file_size in entries:
+                if self.size <= target_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self.size -= file_size
+                num_removed += 1
+
+        logger.debug(f"Attack cache: evicted {num_removed} entries ({self.size / 1024**3:.2f} GB left)")
+
+    def _entries(
+        self
+    ) -> list:
+        """
+        List the entries of the cache.
+
+        Returns:
+            list: (path, modification time, size) of every entry.
+        """
+        entries = []
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(self.suffix):
+                    try:
+                        stat = entry.stat()
+                        entries.append((entry.path, stat.st_mtime, stat.st_size))
+                    except FileNotFoundError:
+                        continue
+        return entries
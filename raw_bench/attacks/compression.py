@@ -1,17 +1,631 @@
+import atexit
+import functools
 import io
+import json
+import math
+import os
 import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import numpy as np
 import torch
 import torchaudio
-from typing import Literal, Optional, Tuple
+from typing import Callable, List, Literal, Optional, Tuple
+from loguru import logger
+
+from .cache import AttackCache
+
+# Container formats that ffmpeg writes to a non-seekable pipe exactly as to a file. MP3 is not one of them:
+# the Xing/LAME header, which signals the encoder delay and padding to the decoder, is only written to
+# seekable outputs, so a piped MP3 stream decodes with ~1105 extra leading samples (576 encoder + 529 decoder).
+STREAMABLE_FORMATS = {'adts', 'ogg'}
+
+# ffmpeg demuxer of the formats whose demuxer is not named after their muxer (ADTS streams are read by 'aac')
+DEMUXER_FORMATS = {'adts': 'aac'}
+
+# Frame size of each codec (samples per channel), the unit of the silence guards of a batched encoding.
+# Vorbis uses variable blocks, 2048 is the long block size of libvorbis.
+CODEC_FRAME_SIZES = {'mp3': 1152, 'aac': 1024, 'vorbis': 2048}
+
+# Version of the codec round-trips, part of the keys of the codec cache (see `cached_codec`). Bump it whenever
+# a round-trip changes its output (2: one encoder per item of a batched round-trip)
+CODEC_ROUNDTRIP_VERSION = 2
+
+# Codec backends: 'ffmpeg' runs the ffmpeg binary (ffmpeg4codecs) in a subprocess,
+# 'torchaudio' encodes and decodes in-process with the libav libraries linked to torchaudio
+CODEC_BACKENDS = ('ffmpeg', 'torchaudio')
+
+
+class CodecService(object):
+    """Execution service of the codec round-trips of a process.
+
+    At most `max_concurrency` round-trips (ffmpeg processes or in-process torchaudio sessions) run
+    at the same time, whatever the number of threads attacking rows (e.g. `pipeline.attack_workers`),
+    so the codecs do not oversubscribe the cores. Every thread gets its own scratch directory for the
+    temporary files of the codecs that need them, on `/dev/shm` when available so they never touch the disk.
+
+    For every codec, the service records the number of round-trips, the time spent waiting for a
+    free slot (queue wait) and the time spent encoding and decoding, to size `max_concurrency` and
+    the attack workers against the number of cores.
+    """
+    def __init__(self,
+                 max_concurrency: Optional[int] = None,
+                 scratch_root: Optional[str] = None):
+        """
+        Args:
+            max_concurrency (Optional[int]): Maximum number of concurrent round-trips (default: number of cores).
+            scratch_root (Optional[str]): Parent directory of the scratch directories
+                (default: `/dev/shm` if writable, otherwise the default temporary directory).
+        """
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        if scratch_root is None:
+            scratch_root = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+        self.scratch_root = scratch_root
+        self._scratch_dir = None
+        self._local = threading.local()
+
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def scratch_dir(self) -> str:
+        """Scratch directory of the calling thread, removed when the process exits."""
+        if getattr(self._local, 'scratch_dir', None) is None:
+            with self._lock:
+                if self._scratch_dir is None:
+                    self._scratch_dir = tempfile.mkdtemp(prefix=f'raw_bench_codecs_{os.getpid()}_', 
+                                                         dir=self.scratch_root)
+                    atexit.register(shutil.rmtree, self._scratch_dir, ignore_errors=True)
+            self._local.scratch_dir = tempfile.mkdtemp(prefix=f'{threading.get_ident()}_', dir=self._scratch_dir)
+        return self._local.scratch_dir
+
+    def run(self,
+            codec: str,
+            fn: Callable[..., torch.Tensor],
+            *args,
+            **kwargs) -> torch.Tensor:
+        """Run a codec round-trip `fn(*args, **kwargs)` once a slot is free.
+
+        Args:
+            codec (str): Name of the codec, for the statistics.
+            fn (Callable): Codec round-trip.
+
+        Returns:
+            torch.Tensor: Output of `fn`.
+        """
+        start = time.perf_counter()
+        with self._slots:
+            acquired = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(codec, calls=1, wait_s=acquired - start, run_s=time.perf_counter() - acquired)
+
+    def wrap(self,
+             codec: str,
+             fn: Callable[[torch.Tensor], torch.Tensor]) -> Callable[[torch.Tensor], torch.Tensor]:
+        """Return `fn` running through the service (see `run`)."""
+        return functools.partial(self.run, codec, fn)
+
+    def record(self,
+               codec: str,
+               calls: int = 0,
+               wait_s: float = 0.0,
+               run_s: float = 0.0):
+        """Add to the statistics of a codec."""
+        with self._lock:
+            stats = self._stats.setdefault(codec, {'calls': 0, 'wait_s': 0.0, 'run_s': 0.0})
+            stats['calls'] += calls
+            stats['wait_s'] += wait_s
+            stats['run_s'] += run_s
+
+    def merge_stats(self,
+                    stats: dict):
+        """Add the statistics of another process (see `pop_stats`)."""
+        for codec, codec_stats in stats.items():
+            self.record(codec, **codec_stats)
+
+    def pop_stats(self) -> dict:
+        """Return and reset the statistics, by codec."""
+        with self._lock:
+            stats, self._stats = self._stats, {}
+        return stats
+
+    def report(self) -> List[dict]:
+        """
+        Log and return the statistics of every codec: number of round-trips, mean queue wait and
+        mean encoding time. A queue wait comparable to the encoding time means that the codecs are
+        throttled by `max_concurrency` (or by the attack worker processes).
+
+        Returns:
+            List[dict]: Statistics of every codec.
+        """
+        with self._lock:
+            rows = [{'codec': codec, **stats} for codec, stats in sorted(self._stats.items())]
+        if len(rows) == 0:
+            return rows
+
+        logger.info(f"Codec round-trips (max concurrency per process: {self.max_concurrency}):")
+        for row in rows:
+            calls = max(row['calls'], 1)
+            logger.info(f"-codec: {row['codec']}, calls: {row['calls']}, "
+                        f"queue wait: {row['wait_s']:.1f} s ({1000 * row['wait_s'] / calls:.1f} ms/call), "
+                        f"encode: {row['run_s']:.1f} s ({1000 * row['run_s'] / calls:.1f} ms/call)")
+        return rows
+
+
+# Codec service of this process (see `configure_codec_service`)
+_CODEC_SERVICE = None
+
+
+def configure_codec_service(max_concurrency: Optional[int] = None,
+                            scratch_root: Optional[str] = None) -> CodecService:
+    """(Re)configure the codec service of this process. The statistics recorded so far are kept."""
+    global _CODEC_SERVICE
+    service = CodecService(max_concurrency=max_concurrency, scratch_root=scratch_root)
+    if _CODEC_SERVICE is not None:
+        service.merge_stats(_CODEC_SERVICE.pop_stats())
+    _CODEC_SERVICE = service
+    return service
+
+
+def get_codec_service() -> CodecService:
+    """Codec service of this process, built with the default settings on first use."""
+    if _CODEC_SERVICE is None:
+        configure_codec_service()
+    return _CODEC_SERVICE
+
+
+def _run_ffmpeg(command: List[str], 
+                input: bytes) -> bytes:
+    """Run ffmpeg with `input` on stdin and return its stdout."""
+    process = subprocess.run(command, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({' '.join(command)}): "
+                           f"{process.stderr.decode('utf-8', errors='replace').strip()[-1000:]}")
+    return process.stdout
+
+
+def ffmpeg_roundtrip(wav_tensor: torch.Tensor,
+                     sr: int,
+                     codec_args: List[str],
+                     container: str,
+                     ffmpeg4codecs: Optional[str] = None) -> torch.Tensor:
+    """Encode a mono signal with ffmpeg and decode it back.
+
+    For streamable containers (see `STREAMABLE_FORMATS`), raw float32 PCM is fed to the encoder over
+    stdin, and the compressed stream is decoded back to raw PCM over stdout, entirely in memory.
+    Other containers need a seekable output, so the signal goes through temporary files instead.
+
+    Args:
+        wav_tensor (torch.Tensor): Audio of shape (1, length), on CPU.
+        sr (int): Sampling rate of the audio.
+        codec_args (List[str]): Encoder arguments (e.g. ['-b:a', '128k', '-c:a', 'aac']).
+        container (str): ffmpeg format of the compressed stream (e.g. 'mp3', 'adts', 'ogg').
+        ffmpeg4codecs (Optional[str]): If None, use the default ffmpeg. Otherwise, use a specific ffmpeg.
+
+    Returns:
+        torch.Tensor: Decoded audio of shape (1, decoded_length).
+    """
+    ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs
+
+    if container not in STREAMABLE_FORMATS:
+        return _ffmpeg_roundtrip_tempfile(wav_tensor, sr, codec_args, container, ffmpeg)
+
+    pcm_args = ["-f", "f32le", "-ar", str(sr), "-ac", "1"]
+    encoded = _run_ffmpeg([ffmpeg, "-hide_banner", "-loglevel", "error", 
+                           *pcm_args, "-i", "pipe:0", 
+                           "-ar", str(sr), *codec_args, 
+                           "-f", container, "pipe:1"],
+                          input=wav_tensor.contiguous().numpy().astype('<f4').tobytes())
+    decoded = _run_ffmpeg([ffmpeg, "-hide_banner", "-loglevel", "error",
+                           "-f", DEMUXER_FORMATS.get(container, container), "-i", "pipe:0", 
+                           *pcm_args, "pipe:1"],
+                          input=encoded)
+
+    return torch.from_numpy(np.frombuffer(decoded, dtype='<f4').copy()).view(1, -1)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_audio_effector(container: str,
+                        encoder: str,
+                        bit_rate: int = -1,
+                        qscale: Optional[int] = None):
+    """AudioEffector of a codec, built once per process and reused across calls."""
+    from torchaudio.io import AudioEffector, CodecConfig
+
+    return AudioEffector(format=container,
+                         encoder=encoder,
+                         codec_config=CodecConfig(bit_rate=bit_rate, qscale=qscale))
+
+
+def _check_torchaudio_backend(lowpass_freq: Optional[int]):
+    if lowpass_freq is not None:
+        raise ValueError("lowpass_freq is only supported by the 'ffmpeg' codec backend")
+
+
+def torchaudio_roundtrip(wav_tensor: torch.Tensor,
+                         sr: int,
+                         container: str,
+                         encoder: str,
+                         bit_rate: int = -1,
+                         qscale: Optional[int] = None) -> torch.Tensor:
+    """Encode a mono signal and decode it back in-process, with torchaudio's StreamWriter/StreamReader.
+
+    Unlike `ffmpeg_roundtrip`, no process is spawned, but the libav libraries linked to torchaudio
+    are used instead of the `ffmpeg4codecs` binary, so the results may differ slightly between the
+    two backends if their encoder versions differ.
+
+    Args:
+        wav_tensor (torch.Tensor): Audio of shape (1, length), on CPU.
+        sr (int): Sampling rate of the audio.
+        container (str): ffmpeg format of the compressed stream (e.g. 'mp3', 'adts', 'ogg').
+        encoder (str): ffmpeg encoder (e.g. 'libmp3lame', 'aac', 'libvorbis').
+        bit_rate (int): Bitrate, in bits per second (-1: encoder default).
+        qscale (Optional[int]): Quality of variable bitrate encoders (e.g. -aq of libvorbis).
+
+    Returns:
+        torch.Tensor: Decoded audio of shape (1, decoded_length).
+    """
+    effector = _get_audio_effector(container, encoder, bit_rate, qscale)
+    # AudioEffector expects (time, channel)
+    return effector.apply(wav_tensor.t().contiguous(), sr).t()
+
+
+def _ffmpeg_roundtrip_tempfile(wav_tensor: torch.Tensor,
+                               sr: int,
+                               codec_args: List[str],
+                               container: str,
+                               ffmpeg: str) -> torch.Tensor:
+    """Encode and decode a signal with ffmpeg through temporary files (see `ffmpeg_roundtrip`)."""
+    scratch_dir = get_codec_service().scratch_dir()
+    with tempfile.NamedTemporaryFile(
+        suffix=".wav", dir=scratch_dir
+    ) as f_in, tempfile.NamedTemporaryFile(suffix=f".{container}", dir=scratch_dir) as f_out:
+        input_path, output_path = f_in.name, f_out.name
+
+        # Save the tensor as a WAV file
+        torchaudio.save(input_path, wav_tensor, sr)
+
+        command = [ffmpeg, "-y", "-i", input_path, "-ar", str(sr), *codec_args, "-f", container, output_path]
+
+        # Run FFmpeg and suppress output
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Load the compressed audio back into a tensor
+        compressed_tensor, _ = torchaudio.load(output_path)
+
+    return compressed_tensor
+
+
+def ffmpeg_roundtrip_batch(wav_tensors: List[torch.Tensor],
+                           sr: int,
+                           codec_args: List[str],
+                           container: str,
+                           ffmpeg4codecs: Optional[str] = None) -> List[torch.Tensor]:
+    """Encode several mono signals with ffmpeg, each with its own encoder, and decode them back.
+
+    The signals are sent to a single ffmpeg process, which splits them and encodes each one to its
+    own output, so no encoder state (e.g. the MP3 bit reservoir or the rate control) is shared between
+    them: every signal is encoded as by `ffmpeg_roundtrip` alone. The compressed streams are written
+    to temporary files (MP3 needs a seekable output, see `STREAMABLE_FORMATS`) and decoded by a
+    second ffmpeg process, so a batch costs two processes whatever its size.
+
+    Args:
+        wav_tensors (List[torch.Tensor]): Audio signals of shape (1, length), on CPU.
+        sr (int): Sampling rate of the audio.
+        codec_args (List[str]): Encoder arguments (e.g. ['-b:a', '128k', '-c:a', 'aac']).
+        container (str): ffmpeg format of the compressed streams (e.g. 'mp3', 'adts', 'ogg').
+        ffmpeg4codecs (Optional[str]): If None, use the default ffmpeg. Otherwise, use a specific ffmpeg.
+
+    Returns:
+        List[torch.Tensor]: Decoded audio of every signal, of shape (1, decoded_length).
+    """
+    ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs
+    num_signals = len(wav_tensors)
+    bounds = np.cumsum([0] + [wav_tensor.shape[-1] for wav_tensor in wav_tensors])
+
+    # Split the concatenated signals back with sample-exact trims, one encoder per output
+    splits = ''.join(f'[s{i}]' for i in range(num_signals))
+    trims = ';'.join(f'[s{i}]atrim=start_sample={bounds[i]}:end_sample={bounds[i + 1]},asetpts=PTS-STARTPTS[a{i}]'
+                     for i in range(num_signals))
+    pcm_args = ["-f", "f32le", "-ar", str(sr), "-ac", "1"]
+
+    with tempfile.TemporaryDirectory(dir=get_codec_service().scratch_dir()) as directory:
+        encoded_paths = [os.path.join(directory, f'{i}.{container}') for i in range(num_signals)]
+        decoded_paths = [os.path.join(directory, f'{i}.f32') for i in range(num_signals)]
+
+        command = [ffmpeg, "-hide_banner", "-loglevel", "error", *pcm_args, "-i", "pipe:0",
+                   "-filter_complex", f'[0:a]asplit={num_signals}{splits};{trims}']
+        for i, path in enumerate(encoded_paths):
+            command += ["-map", f"[a{i}]", "-ar", str(sr), *codec_args, "-f", container, path]
+        signals = torch.cat([wav_tensor.reshape(-1) for wav_tensor in wav_tensors])
+        _run_ffmpeg(command, input=signals.contiguous().numpy().astype('<f4').tobytes())
+
+        command = [ffmpeg, "-hide_banner", "-loglevel", "error"]
+        for path in encoded_paths:
+            command += ["-f", DEMUXER_FORMATS.get(container, container), "-i", path]
+        for i, path in enumerate(decoded_paths):
+            command += ["-map", f"{i}:a", *pcm_args, path]
+        _run_ffmpeg(command, input=b'')
+
+        return [torch.from_numpy(np.fromfile(path, dtype='<f4')).view(1, -1) for path in decoded_paths]
+
+
+def find_delay(reference: torch.Tensor,
+               signal: torch.Tensor,
+               max_delay: Optional[int] = None,
+               num_candidates: int = 8) -> int:
+    """Find the offset of `reference` within the longer `signal` (e.g. the encoder delay of a codec).
+
+    The offset minimizes the L1 distance between `reference` and the window of `signal` starting at
+    that offset. The squared L2 distance of every offset is computed at once from an FFT cross-correlation
+    and the running energy of `signal`, and the exact L1 distance is only evaluated for the
+    `num_candidates` offsets with the smallest L2 distance.
+
+    Args:
+        reference (torch.Tensor): Original audio, flattened to (length,).
+        signal (torch.Tensor): Decoded audio, flattened to (signal_length,) with signal_length >= length.
+        max_delay (Optional[int]): Largest offset searched. If None, all the offsets are searched.
+        num_candidates (int): Number of offsets whose L1 distance is evaluated.
+
+    Returns:
+        int: Offset of the best-matching window (the first one in case of a tie).
+    """
+    reference = reference.detach().reshape(-1).cpu().to(torch.float64)
+    signal = signal.detach().reshape(-1).cpu().to(torch.float64)
+    length = reference.shape[-1]
+
+    num_offsets = signal.shape[-1] - length + 1
+    if num_offsets < 1:
+        raise ValueError(f"signal ({signal.shape[-1]} samples) is shorter than reference ({length} samples)")
+    if max_delay is not None:
+        num_offsets = min(num_offsets, max_delay + 1)
+    signal = signal[:num_offsets + length - 1]
+
+    # Cross-correlation: xcorr[k] = sum_i signal[i + k] * reference[i]
+    n_fft = 1 << (signal.shape[-1] + length - 2).bit_length()
+    xcorr = torch.fft.irfft(torch.fft.rfft(signal, n=n_fft) * torch.fft.rfft(reference, n=n_fft).conj(), n=n_fft)
+    xcorr = xcorr[:num_offsets]
+
+    # Energy of every window of the signal
+    cumsum = torch.nn.functional.pad(torch.cumsum(signal**2, dim=0), (1, 0))
+    energy = cumsum[length:length + num_offsets] - cumsum[:num_offsets]
+
+    # ||window - reference||^2 up to the constant ||reference||^2
+    distance_l2 = energy - 2 * xcorr
+
+    candidates = torch.topk(distance_l2, k=min(num_candidates, num_offsets), largest=False).indices.sort().values
+    windows = signal.unfold(0, length, 1)[candidates]
+    distance_l1 = torch.sum(torch.abs(windows - reference), dim=-1)
+
+    return int(candidates[torch.argmin(distance_l1)])
+
+
+def batched_roundtrip(wav_tensor: torch.Tensor,
+                      roundtrip_fn: Callable[[List[torch.Tensor]], List[torch.Tensor]],
+                      frame_size: int,
+                      guard_frames: int = 2,
+                      search_delay: bool = False,
+                      max_delay: Optional[int] = None,
+                      delay: Optional[int] = None) -> torch.Tensor:
+    """Encode and decode every item of a batch with a single call of a batch round-trip.
+
+    Every item is laid out after `guard_frames` frames of silence and padded with silence up to a codec
+    frame boundary plus `guard_frames` frames, and `roundtrip_fn` encodes every padded item with its own
+    encoder (see `ffmpeg_roundtrip_batch`). Encoding the items one after the other in a single encoder
+    session is not enough: the MP3 bit reservoir and the rate control of the encoders carry over from an
+    item to the next, whatever the silence between them (see the codec_batching check of
+    scripts/attack_parity.py). The output of an item is therefore the output of the item alone, and does
+    not depend on the other items of the batch nor on their order.
+
+    Args:
+        wav_tensor (torch.Tensor): Batch of audio of shape (batch_size, channels, length).
+        roundtrip_fn (Callable): Encodes and decodes every signal of a list, each of shape (1, length) on CPU,
+            in its own encoder session.
+        frame_size (int): Frame size of the codec, in samples (see `CODEC_FRAME_SIZES`).
+        guard_frames (int): Number of frames of silence before and after every item.
+        search_delay (bool): Whether the decoded signal may start with an encoder delay that the container
+            does not signal (e.g. ADTS), in which case it is found with `find_delay` when the decoded
+            signal is longer than the input.
+        max_delay (Optional[int]): Largest encoder delay searched, in samples.
+        delay (Optional[int]): Known delay of the codec (see `codec_delay`), used instead of a search.
+
+    Returns:
+        torch.Tensor: Decoded batch, with the same shape as the input.
+    """
+    batch_size, channels, length = wav_tensor.shape
+    items = wav_tensor.detach().reshape(-1, length).cpu()
+
+    guard = guard_frames * frame_size
+    padded_length = guard + math.ceil(length / frame_size) * frame_size + guard
+    streams = [torch.nn.functional.pad(item, (guard, padded_length - guard - length)).view(1, -1) for item in items]
+
+    outputs = []
+    for stream, decoded in zip(streams, roundtrip_fn(streams)):
+        item_delay = delay
+        if item_delay is None:
+            item_delay = 0
+            if search_delay and decoded.shape[-1] > stream.shape[-1]:
+                item_delay = find_delay(stream, decoded, max_delay=max_delay)
+        outputs.append(remove_delay(decoded, item_delay, padded_length)[0, guard:guard + length])
+
+    return torch.stack(outputs).view(batch_size, channels, length)
+
+
+@functools.lru_cache(maxsize=None)
+def codec_identity(backend: str = 'ffmpeg',
+                   ffmpeg4codecs: Optional[str] = None) -> str:
+    """Identify the codec implementation used by a backend: the ffmpeg binary and its version,
+    or the libav libraries linked to torchaudio.
+
+    Args:
+        backend (str): Codec backend, 'ffmpeg' or 'torchaudio'.
+        ffmpeg4codecs (Optional[str]): ffmpeg binary of the 'ffmpeg' backend (None: default ffmpeg).
+
+    Returns:
+        str: Identity of the codec implementation.
+    """
+    if backend == 'torchaudio':
+        from torchaudio.utils import ffmpeg_utils
+        return f"torchaudio {torchaudio.__version__} {json.dumps(ffmpeg_utils.get_versions(), sort_keys=True, default=str)}"
+
+    ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs
+    version = subprocess.run([ffmpeg, "-version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return f"{os.path.realpath(ffmpeg) if os.path.exists(ffmpeg) else ffmpeg} {version.decode('utf-8', errors='replace').splitlines()[0]}"
+
+
+def measure_codec_delay(roundtrip_fn: Callable[[torch.Tensor], torch.Tensor],
+                        sr: int,
+                        max_delay: int = 8192) -> int:
+    """Measure the delay added by a codec round-trip with an impulse-like probe.
+
+    The probe is a short Hann-windowed noise burst (a single-sample impulse is smeared by
+    lossy codecs) after some silence. Its position in the decoded signal is found with `find_delay`.
+
+    Args:
+        roundtrip_fn (Callable): Encodes and decodes a signal of shape (1, length) on CPU.
+        sr (int): Sampling rate of the audio.
+        max_delay (int): Largest delay (in absolute value) that can be measured, in samples.
+
+    Returns:
+        int: Delay of the decoded signal, in samples (negative if it starts too early).
+    """
+    generator = torch.Generator().manual_seed(0)
+    burst_length = 512
+    probe = torch.zeros(1, max(sr, 4 * max_delay))
+    position = probe.shape[-1] // 4
+    probe[0, position:position + burst_length] = 0.5 * torch.hann_window(burst_length) * \
+        torch.randn(burst_length, generator=generator)
+
+    decoded = roundtrip_fn(probe)
+
+    # Pad both sides, so that negative delays and shortened outputs can be measured too
+    decoded = torch.nn.functional.pad(decoded, (max_delay, max(0, probe.shape[-1] + max_delay - decoded.shape[-1])))
+    return find_delay(probe, decoded, max_delay=2 * max_delay) - max_delay
+
+
+class CodecDelayTable(object):
+    def __init__(
+        self,
+        path: str
+    ):
+        """
+        On-disk table of codec delays, measured once per codec implementation, codec, bitrate and sample rate
+        (see `measure_codec_delay`), so that the codec attacks can remove the delay analytically.
+
+        The table is a JSON file shared by all the processes using the same `path`.
+
+        Args:
+            path: str
+                Path to the JSON file of the table.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.delays = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(
+        self,
+        key: dict,
+        measure_fn: Callable[[], int]
+    ) -> int:
+        """
+        Look up the delay of a codec setting, measuring and storing it if it is not in the table yet.
+
+        Args:
+            key: dict
+                JSON-serializable description of the codec setting (implementation, codec, bitrate, ...).
+            measure_fn: Callable
+                Function measuring the delay.
+
+        Returns:
+            int: Delay, in samples.
+        """
+        key = json.dumps(key, sort_keys=True)
+        with self._lock:
+            if key not in self.delays:
+                delay = int(measure_fn())
+                # Merge with the entries written by other processes in the meantime
+                self.delays = {**self._load(), **self.delays, key: delay}
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.delays, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+
+            return self.delays[key]
+
+
+# Delay tables of this process, by path
+_DELAY_TABLES = {}
+
+
+def codec_delay(delay_table: str,
+                codec: str,
+                bitrate: str,
+                sr: int,
+                roundtrip_fn: Callable[[torch.Tensor], torch.Tensor],
+                backend: str = 'ffmpeg',
+                ffmpeg4codecs: Optional[str] = None,
+                lowpass_freq: Optional[int] = None) -> int:
+    """Calibrated delay of a codec setting (see `CodecDelayTable`).
+
+    Args:
+        delay_table (str): Path to the JSON file of the delay table.
+        codec (str): Codec ('mp3', 'aac' or 'vorbis').
+        bitrate (str): Bitrate of the codec.
+        sr (int): Sampling rate of the audio.
+        roundtrip_fn (Callable): Encodes and decodes a signal of shape (1, length) with this setting.
+        backend (str): Codec backend, 'ffmpeg' or 'torchaudio'.
+        ffmpeg4codecs (Optional[str]): ffmpeg binary of the 'ffmpeg' backend.
+        lowpass_freq (Optional[int]): Cutoff of the encoder.
+
+    Returns:
+        int: Delay, in samples.
+    """
+    if delay_table not in _DELAY_TABLES:
+        _DELAY_TABLES[delay_table] = CodecDelayTable(delay_table)
+
+    key = {'identity': codec_identity(backend, ffmpeg4codecs),
+           'codec': codec,
+           'bitrate': bitrate,
+           'sr': sr,
+           'lowpass_freq': lowpass_freq}
+    return _DELAY_TABLES[delay_table].get(key, lambda: measure_codec_delay(roundtrip_fn, sr))
+
+
+def remove_delay(decoded: torch.Tensor,
+                 delay: int,
+                 length: int) -> torch.Tensor:
+    """Remove a known delay from a decoded signal and trim or pad it to `length` samples."""
+    if delay >= 0:
+        decoded = decoded[..., delay:]
+    else:
+        decoded = torch.nn.functional.pad(decoded, (-delay, 0))
+    decoded = decoded[..., :length]
+    return torch.nn.functional.pad(decoded, (0, length - decoded.shape[-1]))
 
 
 def get_mp3(wav_tensor: torch.Tensor, 
             sr: int, 
             bitrate: str = "128k",
             lowpass_freq: Optional[int] = None,
-            ffmpeg4codecs: Optional[str] = None) -> torch.Tensor:
+            ffmpeg4codecs: Optional[str] = None,
+            max_delay: Optional[int] = 8192,
+            backend: str = 'ffmpeg',
+            batched: bool = False,
+            delay_table: Optional[str] = None) -> torch.Tensor:
     """Convert a batch of audio files to MP3 format, maintaining the original shape.
 
     This function takes a batch of audio files represented as a PyTorch tensor, converts
@@ -23,6 +637,13 @@ def get_mp3(wav_tensor: torch.Tensor,
             Shape should be (batch_size, channels, length).
         sr (int): Sampling rate of the audio.
         bitrate (str): Bitrate for MP3 conversion, default is '128k'.
+        max_delay (Optional[int]): Largest codec delay searched in batched mode, in samples.
+        backend (str): Codec backend, 'ffmpeg' (subprocess) or 'torchaudio' (in-process).
+        batched (bool): Encode every item separately within a single encoder session (see `batched_roundtrip`).
+            Otherwise, the batch is flattened into a single signal.
+        delay_table (Optional[str]): Path to a codec delay table (see `CodecDelayTable`). If provided, the
+            calibrated codec delay is removed. Otherwise, the decoded signal is assumed to start without delay,
+            unless it is longer than the input in batched mode, in which case the delay is searched.
 
     Returns:
         torch.Tensor: Batch of audio files converted to MP3 format, with the same
@@ -30,6 +651,8 @@ def get_mp3(wav_tensor: torch.Tensor,
     """
     device = wav_tensor.device
     batch_size, channels, original_length = wav_tensor.shape
+    if backend not in CODEC_BACKENDS:
+        raise ValueError(f"Invalid codec backend (got {backend}, expected one of {CODEC_BACKENDS})")
 
     # Flatten tensor for conversion and move to CPU
     wav_tensor_flat = wav_tensor.view(1, -1).cpu()
@@ -43,37 +666,40 @@ def get_mp3(wav_tensor: torch.Tensor,
     else:
         raise ValueError(f"Invalid bitrate specified (got {bitrate})")
 
-    with tempfile.NamedTemporaryFile(
-        suffix=".wav"
-    ) as f_in, tempfile.NamedTemporaryFile(suffix=".mp3") as f_out:
-        input_path, output_path = f_in.name, f_out.name
+    codec_args = ["-b:a", f"{parsed_bitrate}k", "-c:a", "libmp3lame"]
+    if lowpass_freq is not None:
+        codec_args += ["-cutoff", str(lowpass_freq)]
 
-        # Save the tensor as a WAV file
-        torchaudio.save(input_path, wav_tensor_flat, sr)
-
-        # Prepare FFmpeg command for AAC conversion
-        ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs 
-        command = [
-            ffmpeg,
-            "-y",
-            "-i",
-            input_path,
-            "-ar",
-            str(sr),
-            "-b:a",
-            f"{parsed_bitrate}k",
-            "-c:a",
-            "libmp3lame",
-        ]
-        if lowpass_freq is not None:
-            command += ["-cutoff", str(lowpass_freq)]
-        command.append(output_path)
+    def encode_decode(stream: torch.Tensor) -> torch.Tensor:
+        if backend == 'torchaudio':
+            _check_torchaudio_backend(lowpass_freq)
+            return torchaudio_roundtrip(stream, sr, container="mp3", encoder="libmp3lame",
+                                        bit_rate=int(float(parsed_bitrate) * 1000))
+        return ffmpeg_roundtrip(stream, sr, codec_args, container="mp3", ffmpeg4codecs=ffmpeg4codecs)
 
-        # Run FFmpeg and suppress output
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Every stream with its own encoder (see `batched_roundtrip`)
+    def encode_decode_batch(streams: List[torch.Tensor]) -> List[torch.Tensor]:
+        if backend == 'torchaudio':
+            return [encode_decode(stream) for stream in streams]
+        return ffmpeg_roundtrip_batch(streams, sr, codec_args, container="mp3", ffmpeg4codecs=ffmpeg4codecs)
+
+    roundtrip = get_codec_service().wrap('mp3', encode_decode)
+
+    delay = None
+    if delay_table is not None:
+        delay = codec_delay(delay_table, 'mp3', bitrate, sr, roundtrip, backend=backend, 
+                            ffmpeg4codecs=ffmpeg4codecs, lowpass_freq=lowpass_freq)
 
-        # Load the AAC audio back into a tensor
-        mp3_tensor, _ = torchaudio.load(output_path)
+    if batched:
+        # Without calibration, a decoder that does not trim the encoder delay (e.g. no LAME header)
+        # returns a longer stream, whose delay is then searched
+        return batched_roundtrip(wav_tensor, get_codec_service().wrap('mp3', encode_decode_batch),
+                                 frame_size=CODEC_FRAME_SIZES['mp3'],
+                                 search_delay=True, max_delay=max_delay, delay=delay).to(device)
+
+    mp3_tensor = roundtrip(wav_tensor_flat)
+    if delay is not None:
+        mp3_tensor = remove_delay(mp3_tensor, delay, wav_tensor_flat.shape[-1])
 
     original_length_flat = batch_size * channels * original_length
     compressed_length_flat = mp3_tensor.shape[-1]
@@ -109,6 +735,10 @@ def get_aac(
     bitrate: str = "128k",
     lowpass_freq: Optional[int] = None,
     ffmpeg4codecs: Optional[str] = None,
+    max_delay: Optional[int] = 8192,
+    backend: str = 'ffmpeg',
+    batched: bool = False,
+    delay_table: Optional[str] = None,
 ) -> torch.Tensor:
     """Converts a batch of audio tensors to AAC format and then back to tensors.
 
@@ -122,6 +752,12 @@ def get_aac(
         bitrate (str): Bitrate for AAC conversion, default is '128k'.
         lowpass_freq (Optional[int]): Frequency for a low-pass filter. If None, no filter is applied.
         ffmpeg4codecs: (Optional[str]) = If none, use a defulat ffmpeg. Otherwise, use a specific ffmpeg.
+        max_delay (Optional[int]): Largest encoder delay searched, in samples. If None, all the offsets are searched.
+        backend (str): Codec backend, 'ffmpeg' (subprocess) or 'torchaudio' (in-process).
+        batched (bool): Encode every item separately within a single encoder session (see `batched_roundtrip`).
+            Otherwise, the batch is flattened into a single signal.
+        delay_table (Optional[str]): Path to a codec delay table (see `CodecDelayTable`). If provided, the
+            calibrated encoder delay is removed instead of being searched for every signal.
 
     Returns:
         torch.Tensor: Batch of audio files converted to AAC and back, with the same
@@ -129,6 +765,8 @@ def get_aac(
     """
     device = wav_tensor.device
     batch_size, channels, original_length = wav_tensor.shape
+    if backend not in CODEC_BACKENDS:
+        raise ValueError(f"Invalid codec backend (got {backend}, expected one of {CODEC_BACKENDS})")
 
     # Parse the bitrate value from the string
     match = re.search(r"\d+(\.\d+)?", bitrate)
@@ -142,61 +780,48 @@ def get_aac(
     # Flatten tensor for conversion and move to CPU
     wav_tensor_flat = wav_tensor.view(1, -1).cpu() # one vary large audio file...
 
-    with tempfile.NamedTemporaryFile(
-        suffix=".wav"
-    ) as f_in, tempfile.NamedTemporaryFile(suffix=".aac") as f_out:
-        input_path, output_path = f_in.name, f_out.name
+    # Raw AAC stream (ADTS), as written by ffmpeg to a .aac file
+    codec_args = ["-b:a", f"{parsed_bitrate}k", "-c:a", "aac"]
+    if lowpass_freq is not None:
+        codec_args += ["-cutoff", str(lowpass_freq)]
 
-        # Save the tensor as a WAV file
-        torchaudio.save(input_path, wav_tensor_flat, sr)
-
-        # Prepare FFmpeg command for AAC conversion
-        ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs 
-        command = [
-            ffmpeg,
-            "-y",
-            "-i",
-            input_path,
-            "-ar",
-            str(sr),
-            "-b:a",
-            f"{parsed_bitrate}k",
-            "-c:a",
-            "aac",
-        ]
-        if lowpass_freq is not None:
-            command += ["-cutoff", str(lowpass_freq)]
-        command.append(output_path)
+    def encode_decode(stream: torch.Tensor) -> torch.Tensor:
+        if backend == 'torchaudio':
+            _check_torchaudio_backend(lowpass_freq)
+            return torchaudio_roundtrip(stream, sr, container="adts", encoder="aac",
+                                        bit_rate=int(float(parsed_bitrate) * 1000))
+        return ffmpeg_roundtrip(stream, sr, codec_args, container="adts", ffmpeg4codecs=ffmpeg4codecs)
 
-        # Run FFmpeg and suppress output
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Every stream with its own encoder (see `batched_roundtrip`)
+    def encode_decode_batch(streams: List[torch.Tensor]) -> List[torch.Tensor]:
+        if backend == 'torchaudio':
+            return [encode_decode(stream) for stream in streams]
+        return ffmpeg_roundtrip_batch(streams, sr, codec_args, container="adts", ffmpeg4codecs=ffmpeg4codecs)
+
+    roundtrip = get_codec_service().wrap('aac', encode_decode)
+
+    delay = None
+    if delay_table is not None:
+        delay = codec_delay(delay_table, 'aac', bitrate, sr, roundtrip, backend=backend, 
+                            ffmpeg4codecs=ffmpeg4codecs, lowpass_freq=lowpass_freq)
+
+    if batched:
+        # ADTS does not signal the encoder delay, so without calibration it is searched over the whole stream
+        return batched_roundtrip(wav_tensor, get_codec_service().wrap('aac', encode_decode_batch),
+                                 frame_size=CODEC_FRAME_SIZES['aac'],
+                                 search_delay=True, max_delay=max_delay, delay=delay).to(device)
 
-        # Load the AAC audio back into a tensor
-        aac_tensor, _ = torchaudio.load(output_path)
+    aac_tensor = roundtrip(wav_tensor_flat)
+    if delay is not None:
+        aac_tensor = remove_delay(aac_tensor, delay, wav_tensor_flat.shape[-1])
 
     original_length_flat = batch_size * channels * original_length
     compressed_length_flat = aac_tensor.shape[-1]
 
-    # # Trim excess frames
+    # Remove the encoder delay
     if compressed_length_flat > original_length_flat:
-        min_distance = float('inf')
-        min_index = -1
-        length = wav_tensor.shape[-1]
-
-        # Iterate over possible indices
-        for index in range(aac_tensor.shape[-1] - length + 1):  # Sliding window
-            # Extract the window from aac_tensor
-            aac_window = aac_tensor[..., index:index+length].squeeze() 
-            
-            # Compute L1 distance
-            l1_distance = torch.sum(torch.abs(aac_window - wav_tensor.cpu().squeeze()))
-            
-            # Update minimum distance and index
-            if l1_distance < min_distance:
-                min_distance = l1_distance
-                min_index = index
-            
-        aac_tensor = aac_tensor[:, min_index:min_index+length]
+        delay = find_delay(wav_tensor_flat, aac_tensor, max_delay=max_delay)
+        aac_tensor = aac_tensor[:, delay:delay + original_length_flat]
 
     # Pad the shortened frames
     elif compressed_length_flat < original_length_flat:
@@ -225,6 +850,10 @@ def get_vorbis(
     bitrate: str = '128k',
     lowpass_freq: Optional[int] = None,
     ffmpeg4codecs: Optional[str] = None,
+    max_delay: Optional[int] = 8192,
+    backend: str = 'ffmpeg',
+    batched: bool = False,
+    delay_table: Optional[str] = None,
  ) -> torch.Tensor:
      # see quality: https://en.wikipedia.org/wiki/Vorbis
     def convert_bitrate_to_quality(bitrate: str) -> int:
@@ -239,48 +868,48 @@ def get_vorbis(
         else:
             raise ValueError(f"Invalid bitrate: {bitrate}")
 
-    import tempfile
-    import subprocess
-
     device = wav_tensor.device
     batch_size, channels, original_length = wav_tensor.shape
+    if backend not in CODEC_BACKENDS:
+        raise ValueError(f"Invalid codec backend (got {backend}, expected one of {CODEC_BACKENDS})")
 
     quality = convert_bitrate_to_quality(bitrate)
 
     # Flatten tensor for conversion and move to CPU
     wav_tensor_flat = wav_tensor.view(1, -1).cpu() # one vary large audio file...
 
-    with tempfile.NamedTemporaryFile(
-        suffix=".wav"
-    ) as f_in, tempfile.NamedTemporaryFile(suffix=".ogg") as f_out:
-        input_path, output_path = f_in.name, f_out.name
+    codec_args = ["-aq", str(quality), "-c:a", "libvorbis"]
+    if lowpass_freq is not None:
+        codec_args += ["-cutoff", str(lowpass_freq)]
 
-        # Save the tensor as a WAV file
-        torchaudio.save(input_path, wav_tensor_flat, sr)
-
-        # Prepare FFmpeg command for AAC conversion
-        ffmpeg = "ffmpeg" if ffmpeg4codecs is None else ffmpeg4codecs
-        command = [
-            ffmpeg,
-            "-y",
-            "-i",
-            input_path,
-            "-ar",
-            str(sr),
-            "-aq",
-            str(quality),
-            "-c:a",
-            "libvorbis",
-        ]
-        if lowpass_freq is not None:
-            command += ["-cutoff", str(lowpass_freq)]
-        command.append(output_path)
+    def encode_decode(stream: torch.Tensor) -> torch.Tensor:
+        if backend == 'torchaudio':
+            _check_torchaudio_backend(lowpass_freq)
+            return torchaudio_roundtrip(stream, sr, container="ogg", encoder="libvorbis", qscale=quality)
+        return ffmpeg_roundtrip(stream, sr, codec_args, container="ogg", ffmpeg4codecs=ffmpeg4codecs)
 
-        # Run FFmpeg and suppress output
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Every stream with its own encoder (see `batched_roundtrip`)
+    def encode_decode_batch(streams: List[torch.Tensor]) -> List[torch.Tensor]:
+        if backend == 'torchaudio':
+            return [encode_decode(stream) for stream in streams]
+        return ffmpeg_roundtrip_batch(streams, sr, codec_args, container="ogg", ffmpeg4codecs=ffmpeg4codecs)
 
-        # Load the AAC audio back into a tensor
-        vorbis_tensor, _ = torchaudio.load(output_path)
+    roundtrip = get_codec_service().wrap('vorbis', encode_decode)
+
+    delay = None
+    if delay_table is not None:
+        delay = codec_delay(delay_table, 'vorbis', bitrate, sr, roundtrip, backend=backend, 
+                            ffmpeg4codecs=ffmpeg4codecs, lowpass_freq=lowpass_freq)
+
+    if batched:
+        # As for MP3, the delay is searched if the decoder did not trim it (see `get_mp3`)
+        return batched_roundtrip(wav_tensor, get_codec_service().wrap('vorbis', encode_decode_batch),
+                                 frame_size=CODEC_FRAME_SIZES['vorbis'],
+                                 search_delay=True, max_delay=max_delay, delay=delay).to(device)
+
+    vorbis_tensor = roundtrip(wav_tensor_flat)
+    if delay is not None:
+        vorbis_tensor = remove_delay(vorbis_tensor, delay, wav_tensor_flat.shape[-1])
 
     original_length_flat = batch_size * channels * original_length
     compressed_length_flat = vorbis_tensor.shape[-1]
@@ -311,24 +940,106 @@ def get_vorbis(
 
 
 
+# Codec caches of this process, by directory
+_CODEC_CACHES = {}
+
+
+def cached_codec(codec_fn: Callable[..., torch.Tensor],
+                 codec: str,
+                 wav_tensor: torch.Tensor,
+                 sr: int,
+                 bitrate: str,
+                 cache_dir: Optional[str] = None,
+                 cache_max_size_gb: float = 10.0,
+                 ffmpeg4codecs: Optional[str] = None,
+                 backend: str = 'ffmpeg',
+                 batched: bool = False,
+                 delay_table: Optional[str] = None) -> torch.Tensor:
+    """Apply a codec round-trip through an on-disk cache of decoded outputs.
+
+    Codec attacks are deterministic for a given input, setting and codec build, so their outputs are
+    keyed by a hash of the input samples, the codec, the bitrate, the sample rate, the options changing
+    the output and the codec implementation (see `codec_identity`, which includes `ffmpeg -version`).
+    Outputs are stored as compressed 16-bit samples, and the least recently used entries are evicted
+    beyond `cache_max_size_gb` (see `AttackCache`).
+
+    Args:
+        codec_fn (Callable): Codec round-trip (`get_mp3`, `get_aac` or `get_vorbis`).
+        codec (str): Codec name ('mp3', 'aac' or 'vorbis').
+        wav_tensor (torch.Tensor): Batch of audio of shape (batch_size, channels, length).
+        sr (int): Sampling rate of the audio.
+        bitrate (str): Bitrate of the codec.
+        cache_dir (Optional[str]): Directory of the cache. If None, the cache is disabled.
+        cache_max_size_gb (float): Maximum total size of the cache, in GB.
+        ffmpeg4codecs, backend, batched, delay_table: Options of `codec_fn`.
+
+    Returns:
+        torch.Tensor: Decoded batch, with the same shape as the input.
+    """
+    def compute():
+        return codec_fn(wav_tensor, sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs, backend=backend,
+                        batched=batched, delay_table=delay_table)
+
+    if cache_dir is None:
+        return compute()
+
+    if cache_dir not in _CODEC_CACHES:
+        _CODEC_CACHES[cache_dir] = AttackCache(cache_dir, max_size_gb=cache_max_size_gb, 
+                                               namespace={'kind': 'codec'}, dtype='int16')
+    cache = _CODEC_CACHES[cache_dir]
+
+    key = cache.key(wav_tensor, sr, codec, {'bitrate': bitrate,
+                                            'identity': codec_identity(backend, ffmpeg4codecs),
+                                            'version': CODEC_ROUNDTRIP_VERSION,
+                                            'batched': batched,
+                                            'delay_calibration': delay_table is not None})
+    output = cache.get(key)
+    if output is None:
+        # The output as stored (16-bit), so that a miss gives the same output as the following hits
+        output = cache.put(key, compute())
+
+    return output.to(wav_tensor.device)
+
+
 def mp3_wrapper(wav_tensor: torch.Tensor, 
                 sr: int = 44100,
                 bitrate = '64k', # 128k, 256k
-                ffmpeg4codecs: str = None):
+                ffmpeg4codecs: str = None,
+                backend: str = 'ffmpeg',
+                batched: bool = False,
+                delay_table: str = None,
+                cache_dir: str = None,
+                cache_max_size_gb: float = 10.0):
     
-    return get_mp3(wav_tensor, sr=sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)
+    return cached_codec(get_mp3, 'mp3', wav_tensor, sr=sr, bitrate=bitrate, 
+                        cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb,
+                        ffmpeg4codecs=ffmpeg4codecs, backend=backend, batched=batched, delay_table=delay_table)
 
 
 def aac_wrapper(wav_tensor: torch.Tensor, 
                 sr: int,
                 bitrate = '64k', # 128k, 256k
-                ffmpeg4codecs: str = None):
-    return get_aac(wav_tensor, sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)
+                ffmpeg4codecs: str = None,
+                backend: str = 'ffmpeg',
+                batched: bool = False,
+                delay_table: str = None,
+                cache_dir: str = None,
+                cache_max_size_gb: float = 10.0):
+    return cached_codec(get_aac, 'aac', wav_tensor, sr=sr, bitrate=bitrate, 
+                        cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb,
+                        ffmpeg4codecs=ffmpeg4codecs, backend=backend, batched=batched, delay_table=delay_table)
 
 
 def vorbis_wrapper(wav_tensor: torch.Tensor, 
                    sr: int,
                    bitrate: str = '64k',
-                   ffmpeg4codecs: str = None):
+                   ffmpeg4codecs: str = None,
+                   backend: str = 'ffmpeg',
+                   batched: bool = False,
+                   delay_table: str = None,
+                   cache_dir: str = None,
+                   cache_max_size_gb: float = 10.0):
 
-    return get_vorbis(wav_tensor, sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg4codecs)
+    return cached_codec(get_vorbis, 'vorbis', wav_tensor, sr=sr, bitrate=bitrate, 
+                        cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb,
+                        ffmpeg4codecs=ffmpeg4codecs, backend=backend, batched=batched, delay_table=delay_table)
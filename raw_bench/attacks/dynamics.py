@@ -1,9 +1,155 @@
-from pydub.effects import compress_dynamic_range
-from pydub.utils import audioop, db_to_float, ratio_to_db
+import math
+
+import numpy as np
+from numba import njit
 
 import torch
 
-from ..utils import convert_torch_to_pydub, convert_pydub_to_torch
+
+# The dynamics processors operate on 16-bit samples, as pydub does (full scale: `max_possible_amplitude`)
+INT16_FULL_SCALE = 32768
+
+
+@njit(cache=True)
+def _dynamics_gains(sum_squares: np.ndarray,
+                    num_samples: np.ndarray,
+                    thresh_rms: float,
+                    coef: float,
+                    attack_frames: float,
+                    release_frames: float) -> np.ndarray:
+    """Gain of every frame of the dynamics processors, with the semantics of pydub's `compress_dynamic_range`.
+
+    The level of frame i is the (truncated) RMS of the `num_samples[i]` samples before it, whose sum of
+    squares is `sum_squares[b, i]`. While the level is over the threshold, the gain reduction (in dB) moves
+    towards `coef` times the level over the threshold, by 1/attack_frames of it per frame. Otherwise, it
+    moves back towards 0 by 1/release_frames of it per frame.
+    """
+    gains = np.ones(sum_squares.shape)
+    for b in range(sum_squares.shape[0]):
+        reduction = 0.0
+        for i in range(sum_squares.shape[1]):
+            rms = 0.0
+            if num_samples[i] > 0:
+                rms = math.floor(math.sqrt(sum_squares[b, i] / num_samples[i]))
+            db_over_threshold = 0.0
+            if rms > 0:
+                db_over_threshold = max(20 * (math.log(rms / thresh_rms) / math.log(10)), 0.0)
+            max_reduction = coef * db_over_threshold
+
+            if rms > thresh_rms and reduction <= max_reduction:
+                reduction = min(reduction + max_reduction / attack_frames, max_reduction)
+            else:
+                reduction = max(reduction - max_reduction / release_frames, 0.0)
+
+            if reduction != 0.0:
+                gains[b, i] = 10 ** (-reduction / 20)
+    return gains
+
+
+def process_int16(samples: torch.Tensor,
+                  threshold: float,
+                  coef: float,
+                  sr: int,
+                  attack: float = 5.0,
+                  release: float = 50.0) -> torch.Tensor:
+    """Applies a feed-forward dynamics processor to 16-bit samples, with the semantics of pydub's `compress_dynamic_range`
+
+    The level is the RMS over the `attack` ms before each frame (computed for all the frames at once with
+    cumulative sums), and the gain reduction follows an attack/release recurrence (see `_dynamics_gains`).
+    The output is rounded as `audioop.mul`, so it matches the pydub implementation.
+    
+    Parameters
+    ----------
+    samples: torch.Tensor
+        The 16-bit samples, of shape (B, C, T).
+
+    threshold: float
+        The threshold level (in dBFS).
+
+    coef: float
+        The gain reduction is `coef` times the level over the threshold (in dB), once settled.
+
+    sr: int
+        The sample rate of the audio signal.
+
+    attack: float
+        The attack time (in ms), also the duration of the RMS window.
+
+    release: float
+        The release time (in ms).
+   
+    Returns
+    -------
+    processed_samples: torch.Tensor
+        The processed 16-bit samples, of shape (B, C, T) (float64).
+    """
+    num_channels, length = samples.shape[-2:]
+
+    # Sum of squares of the samples of the `look_frames` frames before each frame
+    look_frames = int(attack * sr / 1000)
+    cumsum = torch.nn.functional.pad(samples.long().pow(2).sum(dim=1).cumsum(dim=-1), (1, 0))
+    frames = torch.arange(length, device=samples.device)
+    start = (frames - look_frames).clamp(min=0)
+    sum_squares = cumsum[:, frames] - cumsum[:, start]
+    num_samples = (frames - start) * num_channels
+
+    gains = _dynamics_gains(sum_squares.double().cpu().numpy(),
+                            num_samples.cpu().numpy(),
+                            thresh_rms=INT16_FULL_SCALE * 10 ** (float(threshold) / 20),
+                            coef=float(coef),
+                            attack_frames=attack * sr / 1000,
+                            release_frames=release * sr / 1000)
+    gains = torch.from_numpy(gains).to(samples.device).unsqueeze(1)
+
+    # Gains rounded towards minus infinity, as `audioop.mul`
+    return torch.floor(samples.double() * gains).clamp(-INT16_FULL_SCALE, INT16_FULL_SCALE - 1)
+
+
+def apply_dynamics(audio: torch.Tensor,
+                   threshold: float,
+                   coef: float,
+                   sr: int,
+                   **kwargs) -> torch.Tensor:
+    """Peak-normalizes each item, then applies a dynamics processor to its 16-bit samples (see `process_int16`)
+
+    Samples are quantized as `convert_torch_to_pydub` does, so the output matches the pydub implementation.
+    
+    Parameters
+    ----------
+    audio: torch.Tensor
+        The input audio signal, of shape (B, C, T) or (C, T).
+
+    threshold: float
+        The threshold level (in dBFS).
+
+    coef: float
+        The gain reduction is `coef` times the level over the threshold (in dB), once settled.
+
+    sr: int
+        The sample rate of the audio signal.
+
+    **kwargs:
+        `attack` and `release` times (in ms).
+   
+    Returns
+    -------
+    processed_audio: torch.Tensor
+        The processed audio signal, of the shape of the input.
+    """
+    shape = audio.shape
+    audio = audio.reshape(-1, *shape[-2:])
+
+    # Peak-normalize each item and quantize it to 16 bits (truncation, as `convert_torch_to_pydub`)
+    max_val = audio.abs().amax(dim=(1, 2), keepdim=True)
+    samples = (audio / max_val * (INT16_FULL_SCALE - 1)).to(torch.int16)
+
+    processed = process_int16(samples, threshold=threshold, coef=coef, sr=sr, **kwargs)
+    processed_audio = processed.float() / (INT16_FULL_SCALE - 1)
+
+    # De-normalize the processed audio signal
+    processed_audio *= max_val
+
+    return processed_audio.reshape(shape)
 
 
 def dynamic_range_compression(audio: torch.Tensor,
@@ -11,43 +157,37 @@ def dynamic_range_compression(audio: torch.Tensor,
                               ratio: float = 4.0,
                               sr: int = 44100,
                               **kwargs) -> torch.Tensor:
-    """Wrapper for applying dynamic compression to an audio signal with pydub
+    """Applies dynamic compression to an audio signal, batched over its items
     
+    Each item is peak-normalized, compressed as with pydub's `compress_dynamic_range` and de-normalized.
+
     Parameters
     ----------
     audio: torch.Tensor
-        The input audio signal.
+        The input audio signal, of shape (B, C, T) or (C, T).
     
     threshold: float
         The threshold level for compression (in dB).
 
+    ratio: float
+        The compression ratio (torch.inf for a limiter).
+
     sr: int
         The sample rate of the audio signal.
+
+    **kwargs:
+        `attack` and `release` times (in ms), see `process_int16`.
    
     Returns
     -------
     compressed_audio: torch.Tensor
         The compressed audio signal.
     """
-    init_device = audio.device
-
-
-    # Peak-normalize the audio signal
-    max_val = torch.max(torch.abs(audio))
-    audio_norm = audio / max_val
-    audio_seg = convert_torch_to_pydub(audio=audio_norm, sr=sr)
-    
-    compressed_audio_seg = compress_dynamic_range(audio_seg,
-                                                  ratio=ratio, 
-                                                  threshold=threshold,
-                                                  **kwargs)
-    
-    compressed_audio = convert_pydub_to_torch(compressed_audio_seg).to(init_device)
-
-    # De-normalize the compressed audio signal
-    compressed_audio *= max_val
-
-    return compressed_audio
+    return apply_dynamics(audio, 
+                          threshold=threshold, 
+                          coef=1 - 1 / ratio, 
+                          sr=sr, 
+                          **kwargs)
 
 
 def dynamic_range_expansion(audio: torch.Tensor,
@@ -55,25 +195,37 @@ def dynamic_range_expansion(audio: torch.Tensor,
                             ratio: float = 4.0,
                             sr: int = 44100,
                             **kwargs) -> torch.Tensor:
-    init_device = audio.device
+    """Applies dynamic range expansion to an audio signal, batched over its items
 
-    # Peak-normalize the audio signal
-    max_val = torch.max(torch.abs(audio))
-    audio_norm = audio / max_val
+    Each item is peak-normalized, processed as with `expand_dynamic_range` and de-normalized.
 
-    audio_seg = convert_torch_to_pydub(audio=audio_norm,
-                                       sr=sr)
+    Parameters
+    ----------
+    audio: torch.Tensor
+        The input audio signal, of shape (B, C, T) or (C, T).
     
-    expanded_audio_seg = expand_dynamic_range(audio_seg,
-                                              ratio=ratio, 
-                                              threshold=threshold,
-                                              **kwargs)
-    expanded_audio = convert_pydub_to_torch(expanded_audio_seg).to(init_device)
+    threshold: float
+        The threshold level for expansion (in dB).
 
-    # De-normalize the expanded audio signal
-    expanded_audio *= max_val
+    ratio: float
+        The expansion ratio.
 
-    return expanded_audio
+    sr: int
+        The sample rate of the audio signal.
+
+    **kwargs:
+        `attack` and `release` times (in ms), see `process_int16`.
+   
+    Returns
+    -------
+    expanded_audio: torch.Tensor
+        The expanded audio signal.
+    """
+    return apply_dynamics(audio, 
+                          threshold=threshold, 
+                          coef=ratio - 1, 
+                          sr=sr, 
+                          **kwargs)
 
 
 def expand_dynamic_range(seg, 
@@ -102,53 +254,26 @@ def expand_dynamic_range(seg,
             Release in milliseconds. How long it should take for the compressor
             to stop compressing after the audio has falled below the threshold.
 
+    The level over the attack window is computed with cumulative sums and the gain recurrence
+    runs in a compiled loop (see `process_int16`), in O(N) for N frames. Only 16-bit segments are supported.
     
     For an overview of Dynamic Range Compression, and more detailed explanation
     of the related terminology, see: 
 
         http://en.wikipedia.org/wiki/Dynamic_range_compression
     """
-
-    thresh_rms = seg.max_possible_amplitude * db_to_float(threshold)
-    
-    look_frames = int(seg.frame_count(ms=attack))
-    def rms_at(frame_i):
-        return seg.get_sample_slice(frame_i - look_frames, frame_i).rms
-    def db_over_threshold(rms):
-        if rms == 0: return 0.0
-        db = ratio_to_db(rms / thresh_rms)
-        return max(db, 0)
-
-    output = []
-
-    # amount to reduce the volume of the audio by (in dB)
-    amplification = 0.0
+    assert seg.sample_width == 2, 'only 16-bit audio segments are supported'
     
-    attack_frames = seg.frame_count(ms=attack)
-    release_frames = seg.frame_count(ms=release)
-    for i in range(int(seg.frame_count())):
-        rms_now = rms_at(i)
-        
-        # with a ratio of 4.0 this means the volume will exceed the threshold by
-        # 1/4 the amount (of dB) that it would otherwise
-        max_amplification  = (ratio - 1) * db_over_threshold(rms_now)
-        
-        amplification_inc = max_amplification / attack_frames
-        amplification_dec = max_amplification / release_frames
-        
-        if rms_now > thresh_rms and amplification <= max_amplification:
-            amplification += amplification_inc
-            amplification = min(amplification, max_amplification)
-        else:
-            amplification -= amplification_dec
-            amplification = max(amplification, 0)
-        
-        frame = seg.get_frame(i)
-        if amplification != 0.0:
-            frame = audioop.mul(frame,
-                                seg.sample_width,
-                                db_to_float(-amplification))
-        
-        output.append(frame)
+    # Interleaved samples to (1, C, T)
+    samples = torch.from_numpy(np.array(seg.get_array_of_samples(), dtype=np.int16))
+    samples = samples.view(-1, seg.channels).T.unsqueeze(0)
+
+    expanded = process_int16(samples, 
+                             threshold=threshold, 
+                             coef=ratio - 1, 
+                             sr=seg.frame_rate, 
+                             attack=attack, 
+                             release=release)
+    expanded = expanded[0].T.reshape(-1).numpy().astype(np.int16)
     
-    return seg._spawn(data=b''.join(output))
+    return seg._spawn(data=expanded.tobytes())
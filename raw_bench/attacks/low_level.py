@@ -1,4 +1,7 @@
-from librosa.effects import time_stretch 
+import math
+from typing import Optional, Sequence, Union
+
+import numpy as np
 from torchinterp1d.interp1d import interp1d as tinterp
 import torch
 
@@ -93,27 +96,147 @@ def inverse_polarity(audio: torch.Tensor):
     
     return inverted_audio
 
-def time_stretch_wrapper(audio: torch.Tensor, 
-                         rate: float) -> torch.Tensor:
-    """Wrapper for time stretching an audio signal using librosa.
+
+def phase_vocoder(stft: torch.Tensor,
+                  rate: float,
+                  hop_length: int) -> torch.Tensor:
+    """Speeds up an STFT by `rate` without changing the pitch, as `librosa.phase_vocoder`.
+
+    Same vectorized formulation as `torchaudio.functional.phase_vocoder` (all the output frames at once, 
+    phases accumulated with a cumulative sum), but with the time steps of librosa (`torch.arange` rounds
+    some steps, e.g. 30 * 0.7, to the next integer, which selects other frames) and phases accumulated in
+    float64, so the output follows librosa.
+    
+    Parameters
+    ----------
+    stft: torch.Tensor
+        The complex STFT, of shape (..., freq, frames).
+
+    rate: float
+        The speed-up factor.
+
+    hop_length: int
+        The hop length of the STFT.
+
+    Returns
+    -------
+    torch.Tensor
+        The stretched STFT, of shape (..., freq, ceil(frames / rate)).
+    """
+    time_steps = torch.from_numpy(np.arange(0, stft.shape[-1], rate, dtype=np.float64)).to(stft.device)
+    alphas = time_steps % 1.0
+
+    # Expected phase advance of each frequency bin over a hop
+    phase_advance = torch.linspace(0, math.pi, stft.shape[-2], dtype=torch.float64, device=stft.device)[..., None]
+    phase_advance = hop_length * phase_advance
+
+    # Pad 2 frames to simplify boundary logic
+    padded = torch.nn.functional.pad(stft.to(torch.complex128), (0, 2))
+    columns_0 = padded.index_select(-1, time_steps.long())
+    columns_1 = padded.index_select(-1, time_steps.long() + 1)
+    mag = (1 - alphas) * columns_0.abs() + alphas * columns_1.abs()
+
+    # Phase advance wrapped to [-pi, pi], accumulated from the phase of the first frame
+    dphase = columns_1.angle() - columns_0.angle() - phase_advance
+    dphase = dphase - 2 * math.pi * torch.round(dphase / (2 * math.pi))
+    phase = torch.cat([padded[..., :1].angle(), (phase_advance + dphase)[..., :-1]], dim=-1)
+    
+    return torch.polar(mag, phase.cumsum(dim=-1)).to(stft.dtype)
+
+
+def time_stretch(audio: torch.Tensor,
+                 rate: float,
+                 n_fft: int = 2048,
+                 hop_length: int = 512) -> torch.Tensor:
+    """Time stretches an audio signal with a phase vocoder, as `librosa.effects.time_stretch`.
+
+    The STFT (Hann window, zero-padded centered frames), the phase vocoder (see `phase_vocoder`) and 
+    the inverse STFT run in torch, on the device of the signal and for all its items and channels at once.
     
     Parameters
     ----------
     audio: torch.Tensor
-        The input audio signal.
+        The input audio signal, of shape (..., T).
     
     rate: float
-        The rate at which to stretch the audio signal.
+        The rate at which to stretch the audio signal (> 1: faster).
+
+    n_fft: int
+        The FFT size of the STFT.
+
+    hop_length: int
+        The hop length of the STFT.
         
     Returns
     -------
     torch.Tensor
-        The time-stretched audio signal.
+        The time-stretched audio signal, of shape (..., round(T / rate)).
     """
-    if audio.dim() == 3:
-        audio = audio.squeeze(0)
-    audio = audio.squeeze(1)
-    stretched = time_stretch(audio.detach().cpu().numpy(),
-                             rate=rate)
+    if rate <= 0:
+        raise ValueError(f'rate must be a positive number, got {rate}.')
+
+    shape = audio.shape
+    audio = audio.reshape(-1, shape[-1])
+    window = torch.hann_window(n_fft, dtype=audio.dtype, device=audio.device)
+
+    stft = torch.stft(audio, 
+                      n_fft=n_fft, 
+                      hop_length=hop_length, 
+                      window=window, 
+                      center=True, 
+                      pad_mode='constant', 
+                      return_complex=True)
+    
+    stft_stretch = phase_vocoder(stft, rate=rate, hop_length=hop_length)
+
+    length = int(round(shape[-1] / rate))
+    stretched = torch.istft(stft_stretch, 
+                            n_fft=n_fft, 
+                            hop_length=hop_length, 
+                            window=window, 
+                            center=True, 
+                            length=length)
 
-    return torch.tensor(stretched).to(audio.device).unsqueeze(0)
\ No newline at end of file
+    return stretched.reshape(*shape[:-1], length)
+
+
+def time_stretch_wrapper(audio: torch.Tensor, 
+                         rate: Union[float, Sequence[float]],
+                         length: Optional[int] = None) -> torch.Tensor:
+    """Wrapper for time stretching a batch of audio signals (see `time_stretch`).
+    
+    Parameters
+    ----------
+    audio: torch.Tensor
+        The input audio signal, of shape (B, C, T).
+    
+    rate: float or sequence of float
+        The rate at which to stretch the audio signal, or the rate of each item. Items with the same
+        rate are stretched together.
+
+    length: int, optional
+        Length of the output: the stretched signals are truncated or zero-padded at the end to it.
+        Required for items with different rates (default: the stretched length).
+        
+    Returns
+    -------
+    torch.Tensor
+        The time-stretched audio signal, of shape (B, C, length).
+    """
+    if isinstance(rate, (int, float)):
+        stretched = time_stretch(audio, rate=rate)
+        if length is None:
+            return stretched
+        if stretched.shape[-1] >= length:
+            return stretched[..., :length]
+        return torch.nn.functional.pad(stretched, (0, length - stretched.shape[-1]))
+
+    rates = [float(r) for r in rate]
+    assert len(rates) == audio.shape[0], 'one rate per item is expected'
+    assert length is not None, 'length must be provided for items with different rates'
+    stretched = torch.zeros(*audio.shape[:-1], length, dtype=audio.dtype, device=audio.device)
+    for r in sorted(set(rates)):
+        items = [b for b, item_rate in enumerate(rates) if item_rate == r]
+        stretched[items] = time_stretch_wrapper(audio[items], rate=r, length=length)
+
+    return stretched
@@ -1,12 +1,74 @@
+import atexit
+import contextlib
+import hashlib
+import inspect
+import itertools
 import math
+import os
 import random
+import tempfile
+import threading
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 from audiotools import AudioSignal
 from dac.utils import download
 from dac import DAC
-from transformers import EncodecModel
-from typing import List
+from loguru import logger
+from torch.nn.utils import parametrize
+from torch.nn.utils.weight_norm import WeightNorm
+from transformers import EncodecConfig, EncodecModel
+from typing import Dict, List
+
+
+# Inference modes of the codec models: fp32 (reference), bf16 autocast, int8 dynamic quantization
+# of the linear and recurrent layers, and compiled encoder and decoder graphs (see `NeuralCodecWrapper.optimize_inference`)
+INFERENCE_MODES = ('fp32', 'bf16', 'int8', 'compile')
+
+
+def _remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _weight_norms(module: nn.Module) -> Dict[str, torch.Tensor]:
+    """Weight-normalized tensors of a module (`weight_norm` hooks or parametrizations), by name."""
+    # The attribute set by a `weight_norm` hook is only updated at the next call, so it is recomputed here
+    weights = {hook.name: hook.compute_weight(module) 
+               for hook in module._forward_pre_hooks.values() if isinstance(hook, WeightNorm)}
+    if parametrize.is_parametrized(module):
+        weights.update({name: getattr(module, name) for name in module.parametrizations.keys()})
+    return weights
+
+
+def _folded_tensors(model: nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    All the parameters and buffers (including non-persistent ones) of a model, with the weight-normalized
+    tensors folded into plain weights (see `_remove_weight_norms`).
+    """
+    tensors = {}
+    for module_name, module in model.named_modules():
+        if module_name.endswith('parametrizations') or '.parametrizations.' in f'.{module_name}':
+            continue
+        prefix = f'{module_name}.' if module_name else ''
+        folded = set()
+        for name, weight in _weight_norms(module).items():
+            tensors[prefix + name] = weight.detach().cpu()
+            folded.update([f'{name}_g', f'{name}_v'])
+        for name, tensor in itertools.chain(module._parameters.items(), module._buffers.items()):
+            if tensor is not None and name not in folded:
+                tensors[prefix + name] = tensor.detach().cpu()
+    return tensors
+
+
+def _remove_weight_norms(model: nn.Module):
+    """Replace the weight-normalized tensors of a model by plain weights (computed once instead of at every call)."""
+    for module in model.modules():
+        for hook in [hook for hook in module._forward_pre_hooks.values() if isinstance(hook, WeightNorm)]:
+            nn.utils.remove_weight_norm(module, hook.name)
+        if parametrize.is_parametrized(module):
+            for name in list(module.parametrizations.keys()):
+                parametrize.remove_parametrizations(module, name, leave_parametrized=True)
 
 
 class NeuralCodecWrapper(nn.Module):
@@ -17,6 +79,11 @@ class NeuralCodecWrapper(nn.Module):
                  supported_n_codebooks: List[int] = None, 
                  downsampling_ratio: float = None, 
                  n_codebooks: int = None,
+                 code_cache_size: int = 8,
+                 window_seconds: float = None,
+                 overlap_seconds: float = 0.1,
+                 max_batch_windows: int = 8,
+                 inference: str = 'fp32',
                  device: str = 'cuda'):
         """
         Initializes the NeuralCodecWrapper with the given parameters.
@@ -40,14 +107,39 @@ class NeuralCodecWrapper(nn.Module):
 
         n_codebooks : int
             The number of the  maximum codebooks that codec has.
+
+        code_cache_size : int
+            The number of inputs whose codes are kept (see `get_codes`). 0 disables the cache.
+
+        window_seconds : float, optional
+            The duration of the windows of longer inputs (see `encode_codes`). If None, inputs are
+            encoded in a single call.
+
+        overlap_seconds : float
+            The overlap of consecutive windows, crossfaded at decoding.
+
+        max_batch_windows : int
+            The maximum number of windows processed in a single call, which bounds the memory of the model.
+
+        inference : str
+            The inference mode of the model, one of `INFERENCE_MODES` (see `optimize_inference`).
         """
         super(NeuralCodecWrapper, self).__init__()
+        assert inference in INFERENCE_MODES, f'inference({inference}) must be one of {INFERENCE_MODES}'
         self.codec_sr = codec_sr
         self.model_sr = model_sr
         self.supported_bandwidths = supported_bandwidths
         self.supported_n_codebooks = supported_n_codebooks
         self.downsampling_ratio = downsampling_ratio
         self.n_codebooks = n_codebooks
+        self.code_cache_size = code_cache_size
+        self.code_cache = OrderedDict()
+        # The codec may be called by several attack threads (see `pipeline.attack_workers`)
+        self.code_cache_lock = threading.Lock()
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.max_batch_windows = max_batch_windows
+        self.inference = inference
         self.device = device
 
     def validate_properties(self):
@@ -66,6 +158,318 @@ class NeuralCodecWrapper(nn.Module):
         assert self.downsampling_ratio, "downsampling_ratio must be set"
         assert self.n_codebooks, "n_codebooks must be set"
 
+    def optimize_inference(self):
+        """
+        Applies the inference mode to the loaded model. Called by the subclasses once `self.model` is loaded.
+
+        - fp32: the model is unchanged (reference).
+        - bf16: the model runs under bfloat16 autocast (see `inference_context`).
+        - int8: the linear and LSTM layers are dynamically quantized to int8 (CPU only). Convolutions
+          are not supported by dynamic quantization, so a fully convolutional model such as DAC raises
+          a ValueError instead of silently running in fp32.
+        - compile: the encoder and decoder are compiled with `torch.compile`. The first calls of every
+          new input shape are slow.
+
+        The modes other than fp32 trade exactness for speed: see scripts/codec_inference_report.py to
+        measure their effect on the reconstructed audio and on watermark detection.
+        """
+        if self.inference in ['fp32', 'bf16']:
+            return
+
+        self.model.eval()
+        if self.inference == 'int8':
+            if torch.device(self.device).type != 'cpu':
+                raise ValueError(f"int8 inference is only supported on CPU, got device {self.device}.")
+            layers = [module for module in self.model.modules() if isinstance(module, (nn.Linear, nn.LSTM))]
+            if len(layers) == 0:
+                raise ValueError(f"int8 inference is not supported by {self.__class__.__name__}: it has no linear or LSTM "
+                                 f"layers to quantize (dynamic quantization does not support convolutions).")
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+            logger.info(f"{self.__class__.__name__}: {len(layers)} linear/LSTM layers quantized to int8.")
+
+        elif self.inference == 'compile':
+            self.model.encoder = torch.compile(self.model.encoder, dynamic=True)
+            self.model.decoder = torch.compile(self.model.decoder, dynamic=True)
+
+    def model_config(self) -> dict:
+        """
+        Returns the constructor arguments of `self.model` (see `export_weights`).
+        """
+        raise NotImplementedError
+
+    def build_empty_model(self, config: dict) -> nn.Module:
+        """
+        Builds the codec model from the arguments returned by `model_config`, without loading its weights.
+        """
+        raise NotImplementedError
+
+    def export_weights(self, directory: str = None) -> str:
+        """
+        Saves the weights of the model to a file that other processes attach with `attach_weights`.
+
+        The file is written to `directory` (default: `/dev/shm` if writable, otherwise the default temporary
+        directory) and removed when this process exits.
+        
+        Parameters
+        ----------
+        directory : str, optional
+            The directory of the file.
+        
+        Returns
+        -------
+        str
+            The path of the file.
+        """
+        assert self.inference in ['fp32', 'bf16'], f'the weights of an {self.inference} model cannot be exported'
+        if directory is None:
+            directory = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+        # Non-persistent buffers are included, since the attached model is built without initializing them.
+        # Weight norms are folded, so that the attached model uses the shared weights as they are.
+        tensors = _folded_tensors(self.model)
+        path = os.path.join(directory, f'raw_bench_{type(self).__name__}_{os.getpid()}_{id(self)}.pt')
+        torch.save({'config': self.model_config(), 'tensors': tensors}, path)
+        atexit.register(_remove_file, path)
+        return path
+
+    def attach_weights(self, path: str) -> nn.Module:
+        """
+        Builds the codec model with the weights saved by `export_weights`.
+
+        The weights are memory-mapped rather than copied: every process attaching the same file shares
+        the same physical pages (read-only), so the resident memory does not grow with the number of processes.
+        The model has no weight norms (they are folded into the exported weights).
+        
+        Parameters
+        ----------
+        path : str
+            The path of the file written by `export_weights`.
+        
+        Returns
+        -------
+        nn.Module
+            The codec model, on CPU.
+        """
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+        with torch.device('meta'):
+            model = self.build_empty_model(checkpoint['config'])
+            _remove_weight_norms(model)
+
+        for name, tensor in checkpoint['tensors'].items():
+            module_name, _, tensor_name = name.rpartition('.')
+            module = model.get_submodule(module_name)
+            if tensor_name in module._parameters:
+                module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[tensor_name] = tensor
+
+        missing = [name for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers()) 
+                   if tensor.is_meta]
+        assert len(missing) == 0, f'{path} has no weights for {missing}'
+        return model.eval()
+
+    def inference_context(self):
+        """
+        Returns the context in which the model is called (bfloat16 autocast in bf16 mode).
+        """
+        if self.inference == 'bf16':
+            return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def encode_window(self, x: torch.Tensor) -> dict:
+        """
+        Encodes a batch of audio into the codes of all the codebooks of the residual quantizer, in one model call.
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        
+        Returns
+        -------
+        dict
+            The codes and everything needed to decode them (see `decode_window`).
+        """
+        raise NotImplementedError
+
+    def decode_window(self, codes: dict, n_codebook: int) -> torch.Tensor:
+        """
+        Decodes a batch of audio from the codes of the first `n_codebook` codebooks, in one model call.
+        
+        Parameters
+        ----------
+        codes : dict
+            The codes returned by `encode_window`.
+        n_codebook : int
+            The number of codebooks to use for reconstruction.
+        
+        Returns
+        -------
+        torch.Tensor
+            The reconstructed audio tensor, with the length of the encoded audio.
+        """
+        raise NotImplementedError
+
+    def windows(self, length: int) -> tuple:
+        """
+        Returns the window and hop sizes (in samples of `model_sr`) used for an input of `length` samples,
+        or None if the input is encoded in a single call.
+        """
+        if self.window_seconds is None:
+            return None
+        window = int(round(self.window_seconds * self.model_sr))
+        overlap = int(round(self.overlap_seconds * self.model_sr))
+        assert 0 <= overlap < window, f'overlap_seconds({self.overlap_seconds}) must be smaller than window_seconds({self.window_seconds})'
+        if length <= window:
+            return None
+        return window, window - overlap
+
+    def encode_codes(self, x: torch.Tensor) -> dict:
+        """
+        Encodes audio into the codes of all the codebooks of the residual quantizer.
+
+        If `window_seconds` is set, longer inputs are split into overlapping windows, encoded by batches
+        of at most `max_batch_windows` windows, so the memory used by the model does not grow with the duration.
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        
+        Returns
+        -------
+        dict
+            The codes of every batch of windows and the layout of the windows (see `decode_codes`).
+        """
+        batch_size, channels, length = x.shape
+        windows = self.windows(length)
+        if windows is None:
+            with self.inference_context():
+                return {'batches': [self.encode_window(x)], 'windows': None, 'shape': x.shape}
+
+        window, hop = windows
+        num_windows = math.ceil((length - window) / hop) + 1
+        x = torch.nn.functional.pad(x, (0, (num_windows - 1) * hop + window - length))
+        # (batch_size * num_windows, channels, window)
+        frames = x.unfold(-1, window, hop).permute(0, 2, 1, 3).reshape(-1, channels, window)
+        with self.inference_context():
+            batches = [self.encode_window(frames[i:i + self.max_batch_windows]) 
+                       for i in range(0, frames.shape[0], self.max_batch_windows)]
+        return {'batches': batches,
+                'windows': (window, hop, num_windows),
+                'shape': (batch_size, channels, length)}
+
+    def decode_codes(self, codes: dict, n_codebook: int) -> torch.Tensor:
+        """
+        Decodes audio from the codes of the first `n_codebook` codebooks.
+
+        Windowed codes (see `encode_codes`) are decoded by batches of windows, and the decoded windows
+        are overlap-added with complementary raised-cosine crossfades over their overlap.
+        
+        Parameters
+        ----------
+        codes : dict
+            The codes returned by `encode_codes`.
+        n_codebook : int
+            The number of codebooks to use for reconstruction.
+        
+        Returns
+        -------
+        torch.Tensor
+            The reconstructed audio tensor, with the length of the encoded audio.
+        """
+        with self.inference_context():
+            frames = torch.cat([self.decode_window(batch_codes, n_codebook) for batch_codes in codes['batches']], dim=0)
+        frames = frames.float()
+        if codes['windows'] is None:
+            return frames
+
+        window, hop, num_windows = codes['windows']
+        batch_size, channels, length = codes['shape']
+        overlap = window - hop
+
+        # Fade in and out over the overlaps, except at the edges of the signal
+        fade_in = torch.sin(0.5 * math.pi * (torch.arange(overlap, device=frames.device) + 0.5) / max(overlap, 1)) ** 2
+        weights = torch.ones(num_windows, window, device=frames.device)
+        weights[1:, :overlap] = fade_in
+        weights[:-1, window - overlap:] = fade_in.flip(0)
+
+        # Overlap-add: (batch_size * channels, window, num_windows) -> (batch_size * channels, 1, 1, padded_length)
+        frames = frames.reshape(batch_size, num_windows, channels, window).permute(0, 2, 3, 1)
+        frames = frames * weights.t()
+        padded_length = (num_windows - 1) * hop + window
+        output = torch.nn.functional.fold(frames.reshape(batch_size * channels, window, num_windows),
+                                          output_size=(1, padded_length), kernel_size=(1, window), stride=(1, hop))
+        # The crossfades sum to one, up to rounding
+        norm = torch.nn.functional.fold(weights.t().unsqueeze(0),
+                                        output_size=(1, padded_length), kernel_size=(1, window), stride=(1, hop))
+        output = output / norm
+        return output.reshape(batch_size, channels, padded_length)[..., :length]
+
+    def get_codes(self, x: torch.Tensor) -> dict:
+        """
+        Returns the codes of `x`, encoding it only if it is not among the last `code_cache_size` inputs.
+
+        With a residual quantizer, the codes of the first codebooks do not depend on the number of
+        codebooks used, so the codes of an input serve every budget: a sweep over the budgets of a
+        chunk costs a single encoder pass.
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        
+        Returns
+        -------
+        dict
+            The codes of the input (see `encode_codes`).
+        """
+        if self.code_cache_size <= 0:
+            return self.encode_codes(x)
+
+        h = hashlib.sha256()
+        h.update(x.detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+        h.update(str(tuple(x.shape)).encode('utf-8'))
+        key = h.hexdigest()
+
+        with self.code_cache_lock:
+            codes = self.code_cache.get(key)
+            if codes is not None:
+                self.code_cache.move_to_end(key)
+                return codes
+
+        # Encoded outside of the lock, so that the threads encode different inputs concurrently
+        codes = self.encode_codes(x)
+        with self.code_cache_lock:
+            self.code_cache[key] = codes
+            while len(self.code_cache) > self.code_cache_size:
+                self.code_cache.popitem(last=False)
+        return codes
+
+    def reconstruct_sweep(self, x: torch.Tensor, n_codebooks: List[int] = None) -> Dict[int, torch.Tensor]:
+        """
+        Reconstructs audio for several numbers of codebooks with a single encoder pass.
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        n_codebooks : list of int, optional
+            The numbers of codebooks to use for reconstruction. Default is all the supported ones.
+        
+        Returns
+        -------
+        dict of int to torch.Tensor
+            The reconstructed audio tensor for every number of codebooks.
+        """
+        if n_codebooks is None:
+            n_codebooks = self.supported_n_codebooks
+        for n_codebook in n_codebooks:
+            assert n_codebook in self.supported_n_codebooks, f'n_codebook({n_codebook}) must be in self.supported_n_codebooks({self.supported_n_codebooks})'
+
+        codes = self.get_codes(x)
+        return {n_codebook: self.decode_codes(codes, n_codebook) for n_codebook in n_codebooks}
+
     def print_internal_variables(self):
         """
         Prints all internal variables of the NeuralCodecWrapper.
@@ -83,6 +487,12 @@ class DACWrapper(NeuralCodecWrapper):
                  model_sr: int = 44100,
                  codec_type: str = '44khz', 
                  verbose : bool = False,
+                 code_cache_size: int = 8,
+                 window_seconds: float = None,
+                 overlap_seconds: float = 0.1,
+                 max_batch_windows: int = 8,
+                 inference: str = 'fp32',
+                 shared_weights: str = None,
                  device: str = 'cuda'):
         """
         Initializes the Wrapper of DAC with the given model sample rate and codec type.
@@ -97,8 +507,23 @@ class DACWrapper(NeuralCodecWrapper):
 
         verbose : bool
             Whether you want to print warning msg etc or not
+
+        code_cache_size : int
+            The number of inputs whose codes are kept (see `NeuralCodecWrapper.get_codes`).
+
+        window_seconds, overlap_seconds, max_batch_windows : float, float, int
+            The windowing of long inputs (see `NeuralCodecWrapper.encode_codes`).
+
+        inference : str
+            The inference mode of the model (see `NeuralCodecWrapper.optimize_inference`).
+
+        shared_weights : str, optional
+            The file of weights exported by another process (see `NeuralCodecWrapper.export_weights`).
+            If provided, the weights are memory-mapped from it instead of being downloaded and loaded.
         """
-        super(DACWrapper, self).__init__(device=device)
+        super(DACWrapper, self).__init__(code_cache_size=code_cache_size, window_seconds=window_seconds, 
+                                         overlap_seconds=overlap_seconds, max_batch_windows=max_batch_windows, 
+                                         inference=inference, device=device)
         self.model_sr = model_sr
         self.verbose  = verbose 
         
@@ -108,9 +533,12 @@ class DACWrapper(NeuralCodecWrapper):
         self.codec_sr = type_to_sr[codec_type]
         assert self.model_sr == self.codec_sr, f"currently model_sr({self.model_sr}) must be the same as codec_sr({self.codec_sr})" 
 
-        # Download and load the pretrained model
-        model_path = download(model_type=codec_type)
-        self.model = DAC.load(model_path).to(self.device)
+        # Download and load the pretrained model, or attach the weights shared by another process
+        if shared_weights is None:
+            model_path = download(model_type=codec_type)
+            self.model = DAC.load(model_path).to(self.device)
+        else:
+            self.model = self.attach_weights(shared_weights).to(self.device)
         
         # Calculate the codebook size and downsampling ratio
         self.codebook_size = self.model.codebook_size
@@ -136,6 +564,9 @@ class DACWrapper(NeuralCodecWrapper):
 
         # Validate properties
         self.validate_properties()
+
+        # Apply the inference mode (bf16, int8, compile)
+        self.optimize_inference()
         
     def forward(self, x: torch.Tensor, target_n_codebook=None, target_bandwidth=None) -> torch.Tensor:
         """
@@ -234,12 +665,64 @@ class DACWrapper(NeuralCodecWrapper):
         """
         if self.verbose :
             print(f'Reconstruct the audio using {n_codebook} codebooks')
+        assert n_codebook in self.supported_n_codebooks, f'n_codebook({n_codebook}) must be in self.supported_n_codebooks({self.supported_n_codebooks})'        
+        return self.decode_codes(self.get_codes(x), n_codebook)
+
+    def model_config(self) -> dict:
+        """
+        Returns the constructor arguments of the DAC model.
+        """
+        class_keys = inspect.signature(DAC).parameters.keys()
+        return {key: value for key, value in self.model.metadata['kwargs'].items() if key in class_keys}
+
+    def build_empty_model(self, config: dict) -> nn.Module:
+        """
+        Builds the DAC model from its constructor arguments, without loading its weights.
+        """
+        return DAC(**config)
+
+    def encode_window(self, x: torch.Tensor) -> dict:
+        """
+        Encodes audio into the codes of all the codebooks of DAC.
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        
+        Returns
+        -------
+        dict
+            The codes (B x n_codebooks x frames) and the length of the input audio.
+        """
         self.model.eval()
         with torch.inference_mode():
-            length = x.shape[-1]
-            assert n_codebook in self.supported_n_codebooks, f'n_codebook({n_codebook}) must be in self.supported_n_codebooks({self.supported_n_codebooks})'        
             assert x.shape[1] == 1, 'DAC only supporst monaural audio input'
-            return self.model(x, n_quantizers=n_codebook)['audio'][..., :length]
+            length = x.shape[-1]
+            audio_data = self.model.preprocess(x, self.codec_sr)
+            _, codes, _, _, _ = self.model.encode(audio_data)
+        return {'codes': codes, 'length': length}
+
+    def decode_window(self, codes: dict, n_codebook: int) -> torch.Tensor:
+        """
+        Decodes audio from the codes of the first `n_codebook` codebooks of DAC.
+        
+        Parameters
+        ----------
+        codes : dict
+            The codes returned by `encode_window`.
+        n_codebook : int
+            The number of codebooks to use for reconstruction.
+        
+        Returns
+        -------
+        torch.Tensor
+            The reconstructed audio tensor.
+        """
+        self.model.eval()
+        with torch.inference_mode():
+            z, _, _ = self.model.quantizer.from_codes(codes['codes'][:, :n_codebook])
+            return self.model.decode(z)[..., :codes['length']]
 
 
 class EncodecWrapper(NeuralCodecWrapper):
@@ -247,6 +730,12 @@ class EncodecWrapper(NeuralCodecWrapper):
                  model_sr: int = 44100, 
                  codec_type: str = 'facebook/encodec_32khz', 
                  verbose : bool = False,
+                 code_cache_size: int = 8,
+                 window_seconds: float = None,
+                 overlap_seconds: float = 0.1,
+                 max_batch_windows: int = 8,
+                 inference: str = 'fp32',
+                 shared_weights: str = None,
                  device: str = 'cuda'):
         """
         Initializes the Wrapper of DAC with the given model sample rate and codec type.
@@ -259,8 +748,19 @@ class EncodecWrapper(NeuralCodecWrapper):
             The type of codec to use. Default is facebook/encodec_32khz. encodec_48khz it not supported
         verbose : bool
             Whether you want to print warning msg etc or not
+        code_cache_size : int
+            The number of inputs whose codes are kept (see `NeuralCodecWrapper.get_codes`).
+        window_seconds, overlap_seconds, max_batch_windows : float, float, int
+            The windowing of long inputs (see `NeuralCodecWrapper.encode_codes`).
+        inference : str
+            The inference mode of the model (see `NeuralCodecWrapper.optimize_inference`).
+        shared_weights : str, optional
+            The file of weights exported by another process (see `NeuralCodecWrapper.export_weights`).
+            If provided, the weights are memory-mapped from it instead of being downloaded and loaded.
         """
-        super(EncodecWrapper, self).__init__(device=device)
+        super(EncodecWrapper, self).__init__(code_cache_size=code_cache_size, window_seconds=window_seconds, 
+                                             overlap_seconds=overlap_seconds, max_batch_windows=max_batch_windows, 
+                                             inference=inference, device=device)
         self.model_sr = model_sr
         self.verbose  = verbose 
         
@@ -272,8 +772,11 @@ class EncodecWrapper(NeuralCodecWrapper):
         }
         self.codec_sr = type_to_sr[codec_type]
 
-        # Download and load the pretrained model
-        self.model = EncodecModel.from_pretrained(codec_type).to(self.device)
+        # Download and load the pretrained model, or attach the weights shared by another process
+        if shared_weights is None:
+            self.model = EncodecModel.from_pretrained(codec_type).to(self.device)
+        else:
+            self.model = self.attach_weights(shared_weights).to(self.device)
         
         # Calculate the codebook size and downsampling ratio
         self.codebook_size = self.model.config.codebook_size
@@ -297,6 +800,9 @@ class EncodecWrapper(NeuralCodecWrapper):
         self.requires_resampling = (self.model_sr != self.codec_sr)
         # Validate properties
         self.validate_properties()
+
+        # Apply the inference mode (bf16, int8, compile)
+        self.optimize_inference()
         
     def forward(self, x: torch.Tensor, target_n_codebook=None, target_bandwidth=None) -> torch.Tensor:
         """
@@ -377,6 +883,35 @@ class EncodecWrapper(NeuralCodecWrapper):
                 print(f'Instead of bandwidth {bandwidth}, we use {closest_bandwidth} that model supports')
             print(f'Reconstruct the audio using {self.bandwith_to_ncodebook[closest_bandwidth]} codebooks for bandwidth of {closest_bandwidth}')
 
+        return self.decode_codes(self.get_codes(x), self.bandwith_to_ncodebook[closest_bandwidth])
+
+    def model_config(self) -> dict:
+        """
+        Returns the configuration of the Encodec model.
+        """
+        return self.model.config.to_dict()
+
+    def build_empty_model(self, config: dict) -> nn.Module:
+        """
+        Builds the Encodec model from its configuration, without loading its weights.
+        """
+        return EncodecModel(EncodecConfig.from_dict(config))
+
+    def encode_window(self, x: torch.Tensor) -> dict:
+        """
+        Encodes audio into the codes of all the codebooks of Encodec (at the highest supported bandwidth).
+        
+        Parameters
+        ----------
+        x : torch.Tensor
+            The input audio tensor.
+        
+        Returns
+        -------
+        dict
+            The codes (chunks x B x n_codebooks x frames), their scales, the padding mask and
+            the length of the input audio.
+        """
         self.model.eval()
         with torch.inference_mode():
             length = x.shape[-1]
@@ -391,7 +926,33 @@ class EncodecWrapper(NeuralCodecWrapper):
                 if self.verbose:
                     print("compress audio with audio codec")
 
-            x = self.model(x, bandwidth=closest_bandwidth/1000.)['audio_values'] # / 1000. for bps -> kbps
+            padding_mask = torch.ones_like(x).bool()
+            encoder_outputs = self.model.encode(x, padding_mask, bandwidth=max(self.supported_bandwidths)/1000.) # / 1000. for bps -> kbps
+        return {'codes': encoder_outputs.audio_codes, 
+                'scales': encoder_outputs.audio_scales, 
+                'padding_mask': padding_mask,
+                'length': length}
+
+    def decode_window(self, codes: dict, n_codebook: int) -> torch.Tensor:
+        """
+        Decodes audio from the codes of the first `n_codebook` codebooks of Encodec.
+        
+        Parameters
+        ----------
+        codes : dict
+            The codes returned by `encode_window`.
+        n_codebook : int
+            The number of codebooks to use for reconstruction.
+        
+        Returns
+        -------
+        torch.Tensor
+            The reconstructed audio tensor.
+        """
+        self.model.eval()
+        with torch.inference_mode():
+            length = codes['length']
+            x = self.model.decode(codes['codes'][:, :, :n_codebook], codes['scales'], codes['padding_mask'])[0]
             
             if self.requires_resampling:
                 if self.verbose:
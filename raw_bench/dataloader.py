@@ -1,5 +1,7 @@
 import argparse
 import os
+from collections import OrderedDict
+from typing import Iterator, List
 
 import numpy as np
 import pandas as pd
@@ -8,6 +10,7 @@ import torchaudio
 import torch.utils.data as data
 from loguru import logger
 
+from .results import result_key, row_shard_index
 from .utils import AVERAGE_ENERGY_VCTK, read_test_df, split_test_chunks
 
 
@@ -60,7 +63,8 @@ class AudioDataset(data.Dataset):
         self.allow_missing_dataset = allow_missing_dataset
         self.all_the_datasets_loaded = self._init_dataset_params()
         self.datasets_keys = sorted(list(set(self.datasets)))       
-        self.cache = {}
+        self.cache = OrderedDict()
+        self.cache_size = config.get("chunk_cache_size", 64)
         self.num_files = len(self.audio_filepaths)
         self.random_start_frame = random_start_frame and not self.mode == 'test'
        
@@ -75,6 +79,92 @@ class AudioDataset(data.Dataset):
         """
         return self.num_files
         
+    def row_key(
+        self,
+        file_idx: int
+    ) -> tuple:
+        """
+        Key of a test row, matching the keys of the evaluation results (see `raw_bench.results.result_key`).
+
+        Args:
+            file_idx: int
+                Index of the row.
+
+        Returns:
+            tuple: (dataset, relative_filepath, chunk_index, attack_type, attack_params)
+        """
+        return result_key(self.datasets[file_idx],
+                          self.relative_filepaths[file_idx],
+                          self.chunk_indices[file_idx],
+                          self.attack_types[file_idx],
+                          self.attack_params[file_idx])
+
+    def exclude_rows(
+        self,
+        keys: set
+    ) -> int:
+        """
+        Remove the rows whose keys are in `keys`, e.g. rows already evaluated by a previous run.
+
+        Args:
+            keys: set
+                Keys of the rows to remove (see `row_key`).
+
+        Returns:
+            int: Number of removed rows.
+        """
+        keep = [idx for idx in range(self.num_files) if self.row_key(idx) not in keys]
+        return self._keep_rows(keep)
+
+    def select_shard(
+        self,
+        shard_index: int,
+        num_shards: int
+    ) -> int:
+        """
+        Keep only the rows assigned to the shard `shard_index` out of `num_shards`
+        (see `raw_bench.results.row_shard_index`).
+
+        Args:
+            shard_index: int
+                Index of the shard to keep.
+            num_shards: int
+                Total number of shards.
+
+        Returns:
+            int: Number of removed rows.
+        """
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"shard_index must be in [0, {num_shards}), got {shard_index}.")
+
+        keep = [idx for idx in range(self.num_files)
+                if row_shard_index(self.row_key(idx), num_shards) == shard_index]
+        return self._keep_rows(keep)
+
+    def _keep_rows(
+        self,
+        keep: List[int]
+    ) -> int:
+        """
+        Keep only the given rows of the test set.
+
+        Args:
+            keep: List[int]
+                Indices of the rows to keep, in order.
+
+        Returns:
+            int: Number of removed rows.
+        """
+        for name in ['audio_filepaths', 'relative_filepaths', 'attack_types', 'attack_params', 'chunk_indices',
+                     'start_times', 'durations', 'datasets']:
+            values = getattr(self, name)
+            setattr(self, name, [values[idx] for idx in keep])
+
+        num_removed = self.num_files - len(keep)
+        self.num_files = len(keep)
+
+        return num_removed
+
     def load_audio_chunk(
         self,
         path: str,
@@ -97,7 +187,8 @@ class AudioDataset(data.Dataset):
         """
         num_samples = int((orig_sr / self.sr) * self.num_samples) if orig_sr != self.sr else self.num_samples
         if self.mode == 'test':
-            if (path, start_idx, num_samples) not in self.cache:
+            cache_key = (path, start_idx, num_samples)
+            if cache_key not in self.cache:
                 audio_chunk, orig_sr = torchaudio.load(path, 
                                                        frame_offset=start_idx, 
                                                        num_frames=num_samples)
@@ -114,10 +205,14 @@ class AudioDataset(data.Dataset):
                     audio_chunk = audio_chunk.repeat(1, repeat_factor)[..., :expected_len]
                     assert audio_chunk.shape[-1] == expected_len
 
-                self.cache[(path, start_idx, num_samples)] = audio_chunk
+                self.cache[cache_key] = audio_chunk
+                # Keep only the most recently used chunks (rows of a chunk are consecutive with eval_order=chunk)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
 
             else:
-                audio_chunk = self.cache[path]
+                audio_chunk = self.cache[cache_key]
+                self.cache.move_to_end(cache_key)
 
         else:
             audio_chunk, orig_sr = torchaudio.load(path, 
@@ -132,7 +227,8 @@ class AudioDataset(data.Dataset):
             audio_chunk = torch.mean(audio_chunk, dim=0, keepdim=True)  # Average channels to make mono
 
         # TODO: Do we really need this?
-        audio_chunk *= torch.sqrt(AVERAGE_ENERGY_VCTK / torch.mean(audio_chunk**2))
+        # Not in-place, the chunk may be shared with the cache
+        audio_chunk = audio_chunk * torch.sqrt(AVERAGE_ENERGY_VCTK / torch.mean(audio_chunk**2))
         # Ensure `audio` is a 2D tensor by adding a batch dimension if necessary
         audio_chunk = audio_chunk.unsqueeze(0) if audio_chunk.dim() == 1 else audio_chunk
         
@@ -199,6 +295,8 @@ class AudioDataset(data.Dataset):
         dataset_name = df_dataset['dataset_name'].to_list()
         rel_filepaths = df_dataset['audio_filepath'].tolist()
         self.audio_filepaths = [f'{self.datapath[d]}/{r}' for d, r in zip(dataset_name, rel_filepaths)]
+        # Paths relative to the dataset roots, which identify the rows independently of `datapath`
+        self.relative_filepaths = rel_filepaths
 
         assert all([os.path.exists(file) for file in self.audio_filepaths]), \
             "Some audio files do not exist in the specified paths. check if you set configs/datapath.yaml properly."
@@ -206,7 +304,8 @@ class AudioDataset(data.Dataset):
             assert os.path.exists(file), f"File does not exist: {i}:{file}"
 
         self.attack_types = df_dataset['attack_type'].tolist()
-        self.attack_params = df_dataset['attack_params'].tolist()
+        # Empty attack_params are read as NaN; use None so that they can be grouped and collated
+        self.attack_params = [None if pd.isna(param) else param for param in df_dataset['attack_params'].tolist()]
         self.chunk_indices = df_dataset['chunk_idx'].tolist()
         self.start_times = df_dataset['start'].tolist()
         self.durations = df_dataset['duration'].tolist()
@@ -256,3 +355,179 @@ class AudioDataset(data.Dataset):
 
         else:
             return audio, carrier_filepath, dataset, attack_type, attack_param, chunk_idx, start_time
+
+
+def relative_filepath(
+    audio_filepath: str,
+    dataset: str,
+    datapath: dict
+) -> str:
+    """
+    Path of an audio file of the test set relative to the root of its dataset, i.e. the `audio_filepath`
+    column of the test manifest.
+
+    Args:
+        audio_filepath: str
+            Path to the audio file, as built by `AudioDataset`.
+        dataset: str
+            Dataset name.
+        datapath: dict
+            Root directory of each dataset.
+
+    Returns:
+        str: Path relative to `datapath[dataset]`.
+    """
+    root = f'{datapath[dataset]}/'
+    if not str(audio_filepath).startswith(root):
+        raise ValueError(f"{audio_filepath} is not in the root directory of the dataset {dataset}: {root}")
+
+    return str(audio_filepath)[len(root):]
+
+
+def chunk_key(
+    dataset: str,
+    relative_filepath: str,
+    start_time: float
+) -> tuple:
+    """
+    Key of the audio chunk of a test row. Rows of the manifest that only differ by their
+    attack share the same chunk key. The audio file is identified by its dataset and its path
+    relative to the dataset root, so that the key does not depend on `datapath`.
+
+    Args:
+        dataset: str
+            Dataset name.
+        relative_filepath: str
+            Path to the audio file, relative to the root of its dataset.
+        start_time: float
+            Start time of the chunk in the audio file, in seconds.
+
+    Returns:
+        tuple: (dataset, relative_filepath, start_time rounded to the microsecond)
+    """
+    return (str(dataset), str(relative_filepath), round(float(start_time), 6))
+
+
+class GroupedBatchSampler(data.Sampler):
+    def __init__(
+        self,
+        dataset: AudioDataset,
+        batch_size: int,
+        drop_last: bool = False
+    ):
+        """
+        Batch sampler for the test manifest that only puts rows sharing the same group key
+        (see `group_key`) into a batch.
+
+        Groups are visited in the order of their first appearance in the manifest,
+        and rows within a group keep their manifest order.
+
+        Args:
+            dataset: AudioDataset
+                Test dataset (mode='test').
+            batch_size: int
+                Maximum number of rows per batch.
+            drop_last: bool, optional
+                Whether to drop the last incomplete batch of each group.
+        """
+        if dataset.mode == 'train':
+            raise ValueError(f"{self.__class__.__name__} is only available for val and test datasets.")
+
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+        groups = OrderedDict()
+        for idx in range(len(dataset)):
+            groups.setdefault(self.group_key(dataset, idx), []).append(idx)
+
+        self.batches = []
+        for indices in groups.values():
+            for i in range(0, len(indices), batch_size):
+                batch = indices[i:i + batch_size]
+                if len(batch) < batch_size and self.drop_last:
+                    continue
+                self.batches.append(batch)
+
+    def group_key(
+        self,
+        dataset: AudioDataset,
+        idx: int
+    ) -> tuple:
+        """
+        Key of the group of a row.
+
+        Args:
+            dataset: AudioDataset
+                Test dataset.
+            idx: int
+                Index of the row.
+
+        Returns:
+            tuple: Group key of the row.
+        """
+        raise NotImplementedError
+
+    def __iter__(
+        self
+    ) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self.batches)
+
+
+class AttackGroupedBatchSampler(GroupedBatchSampler):
+    """
+    Batch sampler that only puts rows sharing the same (attack_type, attack_params) into a batch,
+    so that `AudioAttack` can process the whole batch with a single parameter set.
+    """
+    def group_key(
+        self,
+        dataset: AudioDataset,
+        idx: int
+    ) -> tuple:
+        return (dataset.attack_types[idx], dataset.attack_params[idx])
+
+
+class ChunkGroupedBatchSampler(GroupedBatchSampler):
+    """
+    Chunk-major batch sampler: all the attack rows of an audio chunk are visited consecutively,
+    so that the chunk is loaded and watermarked once and then fanned out to every attack
+    (see `Solver.embed_chunks`).
+    """
+    def group_key(
+        self,
+        dataset: AudioDataset,
+        idx: int
+    ) -> tuple:
+        return chunk_key(dataset.datasets[idx], dataset.relative_filepaths[idx], dataset.start_times[idx])
+
+
+def collate_test_batch(
+    batch: list
+) -> tuple:
+    """
+    Collate function for val and test datasets.
+
+    Audio chunks are stacked into a (B, C, T) tensor, chunk indices and start times are
+    converted to tensors, and the remaining fields (including `attack_params`, which can be
+    None) are kept as lists.
+
+    Args:
+        batch: list
+            List of samples returned by `AudioDataset.__getitem__` in test mode.
+
+    Returns:
+        tuple: (audio_chunks, audio_filepaths, datasets, attack_types, attack_params, chunk_indices, start_times)
+    """
+    audio, filepaths, datasets, attack_types, attack_params, chunk_indices, start_times = zip(*batch)
+
+    return (torch.stack(audio),
+            list(filepaths),
+            list(datasets),
+            list(attack_types),
+            list(attack_params),
+            torch.tensor(chunk_indices),
+            torch.tensor(start_times, dtype=torch.float64))
@@ -0,0 +1,275 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List, Optional
+
+import torch
+from loguru import logger
+
+# Marks the end of the stream in the queues between stages
+_END = object()
+
+
+class Stage(object):
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Any],
+        num_workers: int = 1
+    ):
+        """
+        Stage of an evaluation pipeline.
+
+        Args:
+            name: str
+                Name of the stage, used in the utilisation report.
+            fn: Callable
+                Function applied to every item. It returns the item passed to the next stage
+                (None drops the item).
+            num_workers: int, optional
+                Number of threads running the stage. Stages using a model on a single device
+                should keep 1 worker; CPU-bound stages (ffmpeg subprocesses, ...) can use more.
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers of stage {name} must be >= 1, got {num_workers}.")
+
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.reset_stats()
+
+    def reset_stats(
+        self
+    ):
+        """
+        Reset the timing statistics of the stage.
+        """
+        self.num_items = 0
+        self.busy_time = 0.0
+        self.wait_in_time = 0.0
+        self.wait_out_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_stats(
+        self,
+        busy_time: float = 0.0,
+        wait_in_time: float = 0.0,
+        wait_out_time: float = 0.0,
+        num_items: int = 0
+    ):
+        with self._lock:
+            self.busy_time += busy_time
+            self.wait_in_time += wait_in_time
+            self.wait_out_time += wait_out_time
+            self.num_items += num_items
+
+
+class Pipeline(object):
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 4,
+        load_stage_name: str = 'load'
+    ):
+        """
+        Run the stages of the evaluation (e.g. load, embed, attack, detect, metrics) concurrently.
+
+        Stages are connected with bounded queues, so that a slow stage applies back-pressure
+        instead of accumulating items in memory. Each worker runs under `torch.inference_mode`,
+        which is thread-local. Items may leave a multi-worker stage out of order.
+
+        Args:
+            stages: List[Stage]
+                Stages applied to every item, in order.
+            queue_size: int, optional
+                Maximum number of items waiting between two stages.
+            load_stage_name: str, optional
+                Name of the stage reading the items from the source iterable.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.load_stage = Stage(load_stage_name, fn=None)
+        self.wall_time = 0.0
+
+    def run(
+        self,
+        source: Iterable
+    ):
+        """
+        Feed the items of `source` through all the stages and wait until they are processed.
+
+        Args:
+            source: Iterable
+                Items of the first stage, e.g. a DataLoader.
+
+        Raises:
+            Exception: The first exception raised by a stage, after all the threads are stopped.
+        """
+        for stage in [self.load_stage] + self.stages:
+            stage.reset_stats()
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages))]
+        stop = threading.Event()
+        errors = []
+
+        def put(q: queue.Queue, item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def load():
+            try:
+                iterator = iter(source)
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    t1 = time.perf_counter()
+                    put(queues[0], item)
+                    self.load_stage.add_stats(busy_time=t1 - t0,
+                                              wait_out_time=time.perf_counter() - t1,
+                                              num_items=1)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(queues[0], _END)
+
+        def work(index: int, stage: Stage, finished: List[int], lock: threading.Lock):
+            q_in = queues[index]
+            q_out = queues[index + 1] if index + 1 < len(queues) else None
+            try:
+                with torch.inference_mode():
+                    while not stop.is_set():
+                        t0 = time.perf_counter()
+                        try:
+                            item = q_in.get(timeout=0.1)
+                        except queue.Empty:
+                            stage.add_stats(wait_in_time=time.perf_counter() - t0)
+                            continue
+                        if item is _END:
+                            # Let the other workers of this stage see the end of the stream
+                            put(q_in, _END)
+                            stage.add_stats(wait_in_time=time.perf_counter() - t0)
+                            break
+                        t1 = time.perf_counter()
+                        output = stage.fn(item)
+                        t2 = time.perf_counter()
+                        if q_out is not None and output is not None:
+                            put(q_out, output)
+                        stage.add_stats(busy_time=t2 - t1,
+                                        wait_in_time=t1 - t0,
+                                        wait_out_time=time.perf_counter() - t2,
+                                        num_items=1)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                with lock:
+                    finished[0] += 1
+                    last_worker = finished[0] == stage.num_workers
+                if last_worker and q_out is not None:
+                    put(q_out, _END)
+
+        threads = [threading.Thread(target=load, name='pipeline-load', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            finished, lock = [0], threading.Lock()
+            for worker in range(stage.num_workers):
+                threads.append(threading.Thread(target=work,
+                                                args=(index, stage, finished, lock),
+                                                name=f'pipeline-{stage.name}-{worker}',
+                                                daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_time = time.perf_counter() - start
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def report(
+        self
+    ) -> List[dict]:
+        """
+        Log and return the utilisation of every stage: the fraction of the wall time its workers
+        spent processing items, and the time spent waiting for inputs (starved) or for space in the
+        next queue (blocked). The stage with the highest utilisation is the bottleneck.
+
+        Returns:
+            List[dict]: Statistics of every stage.
+        """
+        stats = []
+        for stage in [self.load_stage] + self.stages:
+            num_workers = 1 if stage.fn is None else stage.num_workers
+            total_time = max(self.wall_time * num_workers, 1e-9)
+            stats.append({'stage': stage.name,
+                          'workers': num_workers,
+                          'items': stage.num_items,
+                          'busy_s': stage.busy_time,
+                          'utilisation': stage.busy_time / total_time,
+                          'starved': stage.wait_in_time / total_time,
+                          'blocked': stage.wait_out_time / total_time})
+
+        bottleneck = max(stats, key=lambda row: row['utilisation'])
+        logger.info(f"Pipeline stage utilisation (wall time: {self.wall_time:.1f} s):")
+        for row in stats:
+            logger.info(f"-stage: {row['stage']} (x{row['workers']}), items: {row['items']}, "
+                        f"busy: {row['busy_s']:.1f} s, utilisation: {row['utilisation']:.1%}, "
+                        f"starved: {row['starved']:.1%}, blocked: {row['blocked']:.1%}")
+        logger.info(f"Bottleneck stage: {bottleneck['stage']}")
+
+        return stats
+
+
+def run_stages(
+    source: Iterable,
+    stages: List[Stage],
+    pipelined: bool = False,
+    queue_size: int = 4,
+    progress: Optional[Callable[[Iterable], Iterable]] = None
+) -> Optional[Pipeline]:
+    """
+    Apply the stages to every item of `source`, either one item at a time in the calling thread,
+    or concurrently with a `Pipeline`.
+
+    Args:
+        source: Iterable
+            Items of the first stage, e.g. a DataLoader.
+        stages: List[Stage]
+            Stages applied to every item, in order.
+        pipelined: bool, optional
+            Whether to run the stages concurrently.
+        queue_size: int, optional
+            Maximum number of items waiting between two stages (pipelined mode).
+        progress: Callable, optional
+            Wrapper of the source reporting the progress (e.g. qqdm).
+
+    Returns:
+        Pipeline or None: The pipeline, to report stage utilisation (None in sequential mode).
+    """
+    if progress is not None:
+        source = progress(source)
+
+    if not pipelined:
+        with torch.inference_mode():
+            for item in source:
+                for stage in stages:
+                    item = stage.fn(item)
+                    if item is None:
+                        break
+        return None
+
+    pipeline = Pipeline(stages, queue_size=queue_size)
+    pipeline.run(source)
+    pipeline.report()
+
+    return pipeline
@@ -0,0 +1,368 @@
+import csv
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+from datetime import datetime
+from typing import Optional, Set, Tuple
+
+import pandas as pd
+from loguru import logger
+
+
+# Columns identifying a test row, followed by the per-row metrics
+ID_COLUMNS = ['audio_filepath', 'relative_filepath', 'dataset', 'attack_type', 'attack_params', 'chunk_index']
+
+# Columns used as the key of a finished test row. The audio file is identified by its dataset and its path
+# relative to the dataset root, so that the keys do not depend on the `datapath` of each machine.
+KEY_COLUMNS = ['dataset', 'relative_filepath', 'chunk_index', 'attack_type', 'attack_params']
+
+
+def result_key(
+    dataset: str,
+    relative_filepath: str,
+    chunk_index: int,
+    attack_type: str,
+    attack_params: Optional[str]
+) -> Tuple[str, str, int, str, str]:
+    """
+    Build the key of a test row, used to find out which rows were already evaluated.
+
+    Args:
+        dataset: str
+            Dataset name.
+        relative_filepath: str
+            Path to the audio file, relative to the root of its dataset.
+        chunk_index: int
+            Index of the chunk within the audio file.
+        attack_type: str
+            Attack type of the row.
+        attack_params: str or None
+            JSON-encoded attack parameters (None or NaN if empty).
+
+    Returns:
+        Tuple[str, str, int, str, str]: Normalized key of the row.
+    """
+    if attack_params is None or (isinstance(attack_params, float) and math.isnan(attack_params)):
+        attack_params = ''
+
+    return (str(dataset), str(relative_filepath), int(chunk_index), str(attack_type), str(attack_params))
+
+
+def row_shard_index(
+    key: Tuple[str, str, int, str, str],
+    num_shards: int
+) -> int:
+    """
+    Deterministically assign a test row to one of `num_shards` evaluation shards.
+
+    The assignment only depends on the key of the row, so that every process (and machine)
+    computes the same partition of the rows produced by `split_test_chunks`.
+
+    Args:
+        key: Tuple[str, str, int, str, str]
+            Key of the row (see `result_key`).
+        num_shards: int
+            Number of evaluation shards.
+
+    Returns:
+        int: Index of the shard in [0, num_shards).
+    """
+    digest = hashlib.md5('|'.join(str(k) for k in key).encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_identity_path(
+    shard_path: str
+) -> str:
+    """
+    Path of the JSON file storing the identity of a result shard, next to the shard.
+
+    Args:
+        shard_path: str
+            Path to the shard file.
+
+    Returns:
+        str: Path to the identity file.
+    """
+    return shard_path[:-len('.csv')] + '.identity.json'
+
+
+class ResultShardWriter(object):
+    def __init__(
+        self,
+        shard_dir: str,
+        prefix: str,
+        delimiter: str = '|',
+        identity: Optional[dict] = None
+    ):
+        """
+        Append-only CSV shard of per-row evaluation results.
+
+        Every row is flushed and fsync'd as soon as it is written, so that the rows finished
+        before a crash or pre-emption can be recovered by `load_result_shards`.
+        Each writer creates its own shard file, so that several runs never write to the same file.
+
+        Args:
+            shard_dir: str
+                Directory where the shards are stored.
+            prefix: str
+                Prefix of the shard files, e.g. 'test_results_strict'.
+            delimiter: str, optional
+                Delimiter used in the CSV file.
+            identity: dict, optional
+                Everything the results depend on besides the rows (model, checkpoint, attacks, ...),
+                stored next to the shard (see `shard_identity_path`) and checked by `load_result_shards`.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(shard_dir, f"{prefix}.{timestamp}-{os.getpid()}.csv")
+        self.identity = None if identity is None else {key: str(value) for key, value in identity.items()}
+        self.delimiter = delimiter
+        self.columns = None
+        self.num_rows = 0
+        self._file = None
+        self._writer = None
+
+    def write(
+        self,
+        row: dict
+    ):
+        """
+        Append a row to the shard. The header is written with the first row.
+
+        Args:
+            row: dict
+                Mapping from column names to values.
+        """
+        if self._file is None:
+            if self.identity is not None:
+                with open(shard_identity_path(self.path), 'w') as f:
+                    json.dump(self.identity, f, indent=2)
+            self.columns = list(row.keys())
+            self._file = open(self.path, 'a', newline='')
+            self._writer = csv.writer(self._file, delimiter=self.delimiter)
+            self._writer.writerow(self.columns)
+
+        if list(row.keys()) != self.columns:
+            raise ValueError(f"Columns of the row {list(row.keys())} do not match the shard columns {self.columns}.")
+
+        self._writer.writerow(['' if value is None else value for value in row.values()])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.num_rows += 1
+
+    def close(
+        self
+    ):
+        """
+        Close the shard file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+
+def list_result_shards(
+    shard_dir: str,
+    prefix: str
+) -> list:
+    """
+    List the shard files with the given prefix.
+
+    Args:
+        shard_dir: str
+            Directory where the shards are stored.
+        prefix: str
+            Prefix of the shard files.
+
+    Returns:
+        list: Sorted list of shard file paths.
+    """
+    return sorted(glob.glob(os.path.join(glob.escape(shard_dir), f"{glob.escape(prefix)}.*.csv")))
+
+
+def load_result_shards(
+    shard_dir: str,
+    prefix: str,
+    delimiter: str = '|',
+    identity: Optional[dict] = None,
+    strict: bool = False
+) -> pd.DataFrame:
+    """
+    Load and concatenate all the shards with the given prefix.
+
+    Rows that appear in several shards are only kept once, from the most recent shard, and a
+    partially written last line (e.g. after a crash) is skipped.
+
+    Args:
+        shard_dir: str
+            Directory where the shards are stored.
+        prefix: str
+            Prefix of the shard files.
+        delimiter: str, optional
+            Delimiter used in the CSV files.
+        identity: dict, optional
+            If given, shards written with a different (or without) identity are ignored
+            (see `ResultShardWriter`).
+        strict: bool, optional
+            If True, raise an error when shards exist but none of them matches the identity.
+
+    Returns:
+        pd.DataFrame: Results of all the finished rows (empty if there is no shard).
+    """
+    if identity is not None:
+        identity = {key: str(value) for key, value in identity.items()}
+
+    shard_paths = list_result_shards(shard_dir, prefix)
+    num_matching = 0
+    df_shards = []
+    for shard_path in shard_paths:
+        if identity is not None:
+            identity_path = shard_identity_path(shard_path)
+            shard_identity = None
+            if os.path.isfile(identity_path):
+                with open(identity_path, 'r') as f:
+                    shard_identity = json.load(f)
+            if shard_identity != identity:
+                logger.warning(f"Ignoring result shard {shard_path} written with a different configuration: "
+                               f"{shard_identity} (expected {identity})")
+                continue
+        num_matching += 1
+
+        with open(shard_path, 'r', newline='') as f:
+            content = f.read()
+        # Every row ends with a newline, so anything after the last newline is a partially written row
+        content = content[:content.rfind('\n') + 1]
+        if content.count('\n') < 2:
+            continue
+        df_shard = pd.read_csv(io.StringIO(content), delimiter=delimiter)
+        if not set(KEY_COLUMNS).issubset(df_shard.columns):
+            logger.warning(f"Ignoring result shard {shard_path} written without the key columns {KEY_COLUMNS}")
+            continue
+        df_shards.append(df_shard)
+
+    if strict and len(shard_paths) > 0 and num_matching == 0:
+        raise ValueError(f"None of the {len(shard_paths)} result shards in {shard_dir} was written with the "
+                         f"current configuration {identity}. Pass the same overrides as the evaluation shards.")
+
+    if len(df_shards) == 0:
+        return pd.DataFrame(columns=ID_COLUMNS)
+
+    df_result = pd.concat(df_shards, ignore_index=True)
+    keys = [result_key(*row) for row in df_result[KEY_COLUMNS].itertuples(index=False)]
+    # Shard names start with their creation time, so the last result of a row is the most recent one
+    df_result = df_result[~pd.Series(keys).duplicated(keep='last').values].reset_index(drop=True)
+    logger.info(f"Loaded {len(df_result)} rows from {len(df_shards)} result shards in {shard_dir}")
+
+    return df_result
+
+
+def finished_keys(
+    df_result: pd.DataFrame
+) -> Set[Tuple[str, str, int, str, str]]:
+    """
+    Get the keys of the rows in a result DataFrame.
+
+    Args:
+        df_result: pd.DataFrame
+            Results loaded by `load_result_shards`.
+
+    Returns:
+        set: Keys of the finished rows (see `result_key`).
+    """
+    return {result_key(*row) for row in df_result[KEY_COLUMNS].itertuples(index=False)}
+
+
+class CleanMetricsMemo(object):
+    def __init__(
+        self,
+        identity: dict,
+        path: Optional[str] = None
+    ):
+        """
+        Per-chunk memo of the attack-independent metrics (e.g. 'bitwise/clean' and
+        'bitwise/no_watermark_clean'), which only depend on the chunk and its message.
+
+        If `path` is given, entries are appended to a JSON lines file as soon as they are
+        computed, and entries of previous runs with the same `identity` are loaded back.
+
+        Args:
+            identity: dict
+                Everything the metrics depend on besides the chunk (model, checkpoint, seed, ...).
+                Entries persisted with a different identity are ignored.
+            path: str, optional
+                Path to the JSON lines file used to persist the memo across runs.
+        """
+        self.identity = {key: str(value) for key, value in identity.items()}
+        self.path = path
+        self.entries = {}
+        self._file = None
+
+        if self.path is not None and os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                content = f.read()
+            # Skip a partially written last line
+            for line in content[:content.rfind('\n') + 1].splitlines():
+                entry = json.loads(line)
+                if entry['identity'] == self.identity:
+                    self.entries[tuple(entry['key'])] = entry['metrics']
+            logger.info(f"Loaded {len(self.entries)} memoized clean metrics from {self.path}")
+
+    def __contains__(
+        self,
+        key: tuple
+    ) -> bool:
+        return key in self.entries
+
+    def get(
+        self,
+        key: tuple
+    ) -> Optional[dict]:
+        """
+        Get the memoized metrics of a chunk.
+
+        Args:
+            key: tuple
+                Chunk key (see `raw_bench.dataloader.chunk_key`).
+
+        Returns:
+            dict or None: Memoized metrics, or None if the chunk was not evaluated yet.
+        """
+        return self.entries.get(key)
+
+    def put(
+        self,
+        key: tuple,
+        metrics: dict
+    ):
+        """
+        Memoize the metrics of a chunk (and persist them if a path was given).
+
+        Args:
+            key: tuple
+                Chunk key (see `raw_bench.dataloader.chunk_key`).
+            metrics: dict
+                Attack-independent metrics of the chunk.
+        """
+        self.entries[key] = metrics
+
+        if self.path is not None:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps({'identity': self.identity, 'key': list(key), 'metrics': metrics}) + '\n')
+            self._file.flush()
+
+    def close(
+        self
+    ):
+        """
+        Close the persisted memo file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,3 +1,4 @@
 from .audioseal import SolverAudioSeal
 from .silentcipher import SolverSilentCipher
 from .wavmark import SolverWavMark
+from .multi import MultiSolver
@@ -1,21 +1,19 @@
 import os
-import json
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
-import pandas as pd
 import torch
 
 from loguru import logger
 from omegaconf import DictConfig, OmegaConf
 from pathlib import Path
-from qqdm import qqdm
-from torchmetrics.audio.snr import ScaleInvariantSignalNoiseRatio
 
 from .base import Solver
 from ..utils import compute_bit_acc
 
 class SolverAudioSeal(Solver):
+    supports_batched_eval = True
+
     def __init__(
         self, 
         config: Union[Path, DictConfig]
@@ -65,108 +63,179 @@ class SolverAudioSeal(Solver):
             Tuple[pd.DataFrame, dict]: DataFrame of results and dictionary of current loss logs.
         """        
 
-        if self.config.test_suffix is not None:
-            csv_suffix = '_' + self.config.test_suffix 
-        self.eval_mode()
+        self.prepare_eval()
         logger.info("Start evaluation.")
         
-        if self.audio_attack is not None:
-            self.audio_attack.set_mode('test')
+        self.seed_everything(self.config.random_seed_for_eval)
+        self.run_eval_stages(embed_fn=self.embed_batch,
+                             attack_fn=self.attack_batch,
+                             detect_fn=self.detect_batch,
+                             metrics_fn=self.write_batch_metrics)
 
-        res_list = []
-        column_names = ['audio_filepath', 
-                        'dataset', 
-                        'attack_type', 
-                        'attack_params', 
-                        'chunk_index']
+        df_result = self.finalize_results(epoch_num=epoch_num, write_to_disk=write_to_disk)
 
-        sisnr_f = ScaleInvariantSignalNoiseRatio().to(self.device)
-        
-        self.seed_everything(self.config.random_seed_for_eval)
-        with torch.inference_mode():
-            num_items = 0  # Keep track of the number of batches proczessed
-            for ret in qqdm(self.test_loader):
-                audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
-                y = audio_chunks.to(self.device)
-                message = self.random_message(self.nbits, batch_size=y.shape[0]).to(self.device)
-                watermark = self.model["generator"].get_watermark(y, message=message, sample_rate=self.sample_rate)
-                y_wm = y + watermark
-                
-                y_wm_dirty = torch.zeros_like(y_wm)
-                y_dirty = torch.zeros_like(y)
-
-                # currently we only support single batch for evaluation: b must be always 0
-                for b in range(y_wm_dirty.shape[0]):
-                    cur_losses_log = {}
-                    args = {} if attack_params[b] is None else json.loads(attack_params[b])
-                    
-                    if att_types[b] == 'phase_shift':
-                        # During test and validation, the phase shift parameter is in seconds.
-                        args['shift'] = int(args['shift'] * self.sample_rate)   
-                    
-                    length = y[b, ...].shape[-1]
-                    y_wm_dirty[b, ...] = self.audio_attack(y_wm[b, ...], attack_type=att_types[b], **args)[..., :length]
-                    y_dirty[b, ...] = self.audio_attack(y[b, ...], attack_type=att_types[b], **args)[..., :length]
-
-                    # now the each attack can handle device by itself
-                    # we do not need this the line below          
-                    y_wm_decoded = self.detect_watermark(y_wm[b, ...].unsqueeze(0))
-                    y_wm_dirty_decoded = self.detect_watermark(y_wm_dirty[b, ...].unsqueeze(0))
-                    y_decoded = self.detect_watermark(y[b, ...].unsqueeze(0))
-                    y_dirty_decoded = self.detect_watermark(y_dirty[b, ...].unsqueeze(0))
-
-                    cur_losses_log['bitwise/clean'] = compute_bit_acc(y_wm_decoded, message[b]).item()
-                    cur_losses_log['bitwise/distorted'] = compute_bit_acc(y_wm_dirty_decoded, message[b]).item()
-                    cur_losses_log['bitwise/no_watermark_clean'] = compute_bit_acc(y_decoded, message[b]).item()
-                    cur_losses_log['bitwise/no_watermark_distorted'] = compute_bit_acc(y_dirty_decoded, message[b]).item()
-                        
-                    hard_metics = {key.replace('bitwise/', 'hard/'): int(value == 1.0) for key, value in cur_losses_log.items()}
-                    cur_losses_log.update(hard_metics)
+        return df_result, self.cur_losses_log
 
-                    if self.config.full_perceptual:
-                        perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=audio_filepaths[b],
-                                                                            start_time=start_times[b],
-                                                                            audio_duration=self.config.dataset.eval_seg_duration,
-                                                                            watermarked_audio=y_wm[b, ...],
-                                                                            distorted_audio=y_dirty[b, ...])
+    def embed_batch(self, ret: tuple) -> dict:
+        """
+        Watermark a batch of the test loader.
 
-                        cur_losses_log.update(perceptual_metrics)
+        Args:
+            ret (tuple): Batch returned by the test loader.
 
-                    cur_losses_log['sisnr_wm'] =  sisnr_f(y_wm[b], y[b]).item()
-                    cur_losses_log['sisnr_attack'] =  sisnr_f(y_dirty[b], y[b]).item()
+        Returns:
+            dict: State of the batch passed to the following stages.
+        """
+        audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
+        y = audio_chunks.to(self.device)
+        keys = [self.row_chunk_key(f, d, t) for f, d, t in zip(audio_filepaths, datasets, start_times.tolist())]
+        message = torch.cat([self.random_message(self.nbits, batch_size=1, generator=self.chunk_generator(key))
+                             for key in keys]).to(self.device)
+
+        # Each unique chunk is watermarked once and shared between its attack rows
+        def embed_fn(indices):
+            watermark = self.model["generator"].get_watermark(y[indices], 
+                                                              message=message[indices], 
+                                                              sample_rate=self.sample_rate)
+            return y[indices] + watermark
+
+        y_wm = self.embed_chunks(keys, embed_fn)
+
+        return {'audio_filepaths': audio_filepaths, 
+                'datasets': datasets, 
+                'att_types': att_types, 
+                'attack_params': attack_params,
+                'chunk_indices': chunk_indices, 
+                'start_times': start_times, 
+                'keys': keys,
+                'message': message, 
+                'y': y, 
+                'y_wm': y_wm}
+
+    def attack_batch(self, batch: dict) -> dict:
+        """
+        Attack the watermarked and the original audio of a batch.
 
-                    log_dir = {f"{att_types[b]}/{key}": val for key, val in cur_losses_log.items()}
-                    self.exp_logger.log_metric(log_dir, step=num_items)
-                        
-                    num_items += 1
-                    res_list.append(
-                        [audio_filepaths[b], 
-                         datasets[b], 
-                         att_types[b], 
-                         attack_params[b], 
-                         chunk_indices[b].item()] + [val for val in cur_losses_log.values()]
-                    )
-            column_names += list(cur_losses_log.keys())    
-            df_result = pd.DataFrame(res_list, columns=column_names)
-        
-        key_columns = ['bitwise/clean', 'bitwise/distorted', 'hard/clean', 'hard/distorted', 'sisnr_wm', 'sisnr_attack']
-
-        # per chunk aggregation
-        self.compute_agg(df_result, cur_losses_log.keys(), csv_suffix, key_columns, prefix='chunklv')
-
-        # write raw results to disk
-        if write_to_disk:
-            os.makedirs(self.test_results_dir, exist_ok=True)
-            if epoch_num is not None:
-                output_csv_filename = f'test_results_epoch{csv_suffix}{epoch_num}.csv'
-            else:
-                output_csv_filename = f'test_results{csv_suffix}.csv'
-        
-            df_result.to_csv(os.path.join(self.test_results_dir, output_csv_filename), 
-                             sep=self.csv_delimiter,
-                             index=False)
+        Args:
+            batch (dict): State of the batch (see `embed_batch`).
 
-        return df_result, cur_losses_log
+        Returns:
+            dict: State of the batch with the attacked audio.
+        """
+        y, y_wm = batch['y'], batch['y_wm']
+        att_types, attack_params = batch['att_types'], batch['attack_params']
+        batch_size, length = y.shape[0], y.shape[-1]
+
+        if (batch_size > 1 and len(set(zip(att_types, attack_params))) == 1 
+                and att_types[0] not in self.audio_attack.per_item_attacks):
+            # Attack-homogeneous batch (eval_order=attack): attack the whole batch at once
+            args = self.parse_attack_params(att_types[0], attack_params[0])
+            y_wm_dirty = self.audio_attack.submit(y_wm, attack_type=att_types[0], **args)
+            y_dirty = self.attack_clean(y, tuple(batch['keys']), att_types[0], attack_params[0], 
+                                        shared=batch.get('shared_attacks'), **args)
+            y_wm_dirty, y_dirty = y_wm_dirty.result()[..., :length], y_dirty.result()[..., :length]
+
+        else:
+            # Rows of a batch have different attacks (or an item-wise attack), so the attacks are applied
+            # row by row. With attack_pool_workers > 0, the rows are attacked in parallel.
+            futures = []
+            for b in range(batch_size):
+                args = self.parse_attack_params(att_types[b], attack_params[b])
+                futures.append((self.audio_attack.submit(y_wm[b, ...], attack_type=att_types[b], **args),
+                                 self.attack_clean(y[b, ...], batch['keys'][b], att_types[b], attack_params[b], 
+                                                   shared=batch.get('shared_attacks'), **args)))
+
+            y_wm_dirty = torch.zeros_like(y_wm)
+            y_dirty = torch.zeros_like(y)
+            for b, (y_wm_dirty_b, y_dirty_b) in enumerate(futures):
+                y_wm_dirty[b, ...] = y_wm_dirty_b.result()[..., :length]
+                y_dirty[b, ...] = y_dirty_b.result()[..., :length]
+
+        batch.update({'y_wm_dirty': y_wm_dirty, 'y_dirty': y_dirty})
+        return batch
+
+    def detect_batch(self, batch: dict) -> dict:
+        """
+        Detect the watermarks of the attacked audio of a batch (and of the clean audio,
+        for the chunks whose clean metrics are not memoized yet).
+
+        Args:
+            batch (dict): State of the batch (see `attack_batch`).
+
+        Returns:
+            dict: State of the batch with the decoded messages.
+        """
+        y, y_wm, keys, message = batch['y'], batch['y_wm'], batch['keys'], batch['message']
+        batch_size = y.shape[0]
+
+        # The clean decodes do not depend on the attack, so they only run for the first row of each chunk
+        first_rows = {}
+        for b, key in enumerate(keys):
+            if key not in self.clean_metrics_memo:
+                first_rows.setdefault(key, b)
+        clean_rows = list(first_rows.values())
+
+        # now the each attack can handle device by itself
+        # Run the detector once over the attacked variants of the whole batch and the missing clean variants
+        decoded = self.detect_watermark(torch.cat([batch['y_wm_dirty'], batch['y_dirty'], y_wm[clean_rows], y[clean_rows]], dim=0))
+        y_wm_dirty_decoded, y_dirty_decoded, y_wm_decoded, y_decoded = decoded.split(
+            [batch_size, batch_size, len(clean_rows), len(clean_rows)], dim=0)
+
+        for i, b in enumerate(clean_rows):
+            self.clean_metrics_memo.put(keys[b], {
+                'bitwise/clean': compute_bit_acc(y_wm_decoded[i:i+1], message[b]).item(),
+                'bitwise/no_watermark_clean': compute_bit_acc(y_decoded[i:i+1], message[b]).item()
+            })
+
+        batch.update({'y_wm_dirty_decoded': y_wm_dirty_decoded, 
+                      'y_dirty_decoded': y_dirty_decoded,
+                      'clean_metrics': [self.clean_metrics_memo.get(key) for key in keys]})
+        return batch
+
+    def write_batch_metrics(self, batch: dict):
+        """
+        Compute, log and write the metrics of every row of a batch.
+
+        Args:
+            batch (dict): State of the batch (see `detect_batch`).
+        """
+        y, y_wm, y_dirty, message = batch['y'], batch['y_wm'], batch['y_dirty'], batch['message']
+        att_types = batch['att_types']
+
+        for b in range(y.shape[0]):
+            clean_metrics = batch['clean_metrics'][b]
+            cur_losses_log = {}
+            cur_losses_log['bitwise/clean'] = clean_metrics['bitwise/clean']
+            cur_losses_log['bitwise/distorted'] = compute_bit_acc(batch['y_wm_dirty_decoded'][b:b+1], message[b]).item()
+            cur_losses_log['bitwise/no_watermark_clean'] = clean_metrics['bitwise/no_watermark_clean']
+            cur_losses_log['bitwise/no_watermark_distorted'] = compute_bit_acc(batch['y_dirty_decoded'][b:b+1], message[b]).item()
+                
+            hard_metics = {key.replace('bitwise/', 'hard/'): int(value == 1.0) for key, value in cur_losses_log.items()}
+            cur_losses_log.update(hard_metics)
+
+            if self.config.full_perceptual:
+                perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=batch['audio_filepaths'][b],
+                                                                    start_time=batch['start_times'][b],
+                                                                    audio_duration=self.config.dataset.eval_seg_duration,
+                                                                    watermarked_audio=y_wm[b, ...],
+                                                                    distorted_audio=y_dirty[b, ...])
+
+                cur_losses_log.update(perceptual_metrics)
+
+            cur_losses_log['sisnr_wm'] =  self.sisnr_f(y_wm[b], y[b]).item()
+            cur_losses_log['sisnr_attack'] =  self.sisnr_f(y_dirty[b], y[b]).item()
+
+            log_dir = {f"{att_types[b]}/{key}": val for key, val in cur_losses_log.items()}
+            self.exp_logger.log_metric(log_dir, step=self.num_items)
+                
+            self.num_items += 1
+            self.write_result(audio_filepath=batch['audio_filepaths'][b],
+                              dataset=batch['datasets'][b],
+                              attack_type=att_types[b],
+                              attack_params=batch['attack_params'][b],
+                              chunk_index=batch['chunk_indices'][b].item(),
+                              metrics=cur_losses_log)
+            self.cur_losses_log = cur_losses_log
 
     def build_model(self):
         """
@@ -295,9 +364,10 @@ class SolverAudioSeal(Solver):
     # Copyright (c) Meta Platforms, Inc. and affiliates.
     @staticmethod
     def random_message(nbits: int,
-                       batch_size: int) -> torch.Tensor:
+                       batch_size: int,
+                       generator: Optional[torch.Generator] = None) -> torch.Tensor:
         """Return random message as 0/1 tensor."""
         if nbits == 0:
             return torch.tensor([])
         
-        return torch.randint(0, 2, (batch_size, nbits))
+        return torch.randint(0, 2, (batch_size, nbits), generator=generator)
@@ -1,8 +1,13 @@
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
+import hashlib
 import io
+import json
 from mel_cepstral_distance import compare_audio_files
 from loguru import logger
 import numpy as np
+import pandas as pd
 from omegaconf import DictConfig, OmegaConf
 import os
 from pathlib import Path
@@ -10,14 +15,20 @@ import random
 import soundfile as sf
 import torch
 import torchaudio
+from qqdm import qqdm
 from torch.utils.data import DataLoader
-from typing import Dict, Union
+from torchmetrics.audio.snr import ScaleInvariantSignalNoiseRatio
+from typing import Callable, Dict, List, Optional, Set, Union
 import wandb
 
-from ..attacks import AudioAttack
+from ..attacks import ATTACK_IMPLEMENTATION_VERSION, AudioAttack
+from ..attacks.cache import AttackCache
+from ..attacks.compression import codec_identity, get_codec_service
 from ..custom_stft import STFT
-from ..dataloader import AudioDataset
+from ..dataloader import AttackGroupedBatchSampler, AudioDataset, ChunkGroupedBatchSampler, chunk_key, collate_test_batch, relative_filepath
 from ..logger import ExperimentLogger
+from ..pipeline import Stage, run_stages
+from ..results import ID_COLUMNS, CleanMetricsMemo, ResultShardWriter, finished_keys, load_result_shards, row_shard_index
 from ..utils import compute_mean_by_group, init_worker
 
 
@@ -27,6 +38,16 @@ class Solver(object):
 
     Handles data loading, logging, and many utility functions for the evaluation.
     """    
+    # Whether `eval` can consume more than one row per DataLoader step.
+    # Subclasses that process the whole batch at once should set this to True.
+    supports_batched_eval = False
+
+    # Attacks applied in the STFT domain of the solver, whose output depends on the model's STFT settings
+    stft_attacks = ('time_mask', 'freq_mask')
+
+    # Number of chunks whose reference audio (see `load_reference`) is kept in memory
+    reference_cache_size = 8
+
     def __init__(self, 
                  config: Union[Path, DictConfig]):
         """
@@ -52,38 +73,7 @@ class Solver(object):
         if str(self.device) != str(config.device):
             logger.info(f"Using device: {self.device} (requested: {config.device})")
         
-        # Set model_type
-        try:
-            self.model_type = config.model_type
-            if self.model_type is None:
-                raise ValueError("config.model_type is set to None. This value must be provided.")
-        except AttributeError:
-            raise AttributeError("config must include a 'model_type' field. This value is required.")
-    
-        # Create a run_dir with model name and timestamp, if not available
-        self.run_dir = config.get("run_dir")
-        if self.run_dir is None:
-            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            self.run_dir = f"{self.model_type}/{timestamp}"
-
-        self.test_results_dir = os.path.join(self.run_dir, 'results')
-        os.makedirs(self.test_results_dir, exist_ok=True)
-        
-        attack_level = config.get("test_suffix", "unknown")
-        random_seed = config.get("random_seed_for_eval", 42)
-        
-        if not hasattr(config, "exp_name") or config.exp_name is None:
-            self.config.exp_name = f"{self.model_type}_{attack_level}_seed{random_seed}"
-
-        exp_name = self.config.exp_name
-
-        self.exp_logger = ExperimentLogger(self.run_dir, 
-                           use_wandb=config.wandb,
-                           project_name=config.get("project_name", "raw-benchmark"),
-                           exp_name=exp_name)
-        
-        self.csv_delimiter = config.get("csv_delimiter", "|")
-        self.test_path = config.dataset.test_path
+        self._init_experiment(config)
 
         if config.full_perceptual:
             self.init_visqol()
@@ -116,8 +106,34 @@ class Solver(object):
                                         mode='test',
                                         config=config.attack,
                                         ffmpeg4codecs=config.ffmpeg4codecs,
-                                        device=self.device)
+                                        codec_backend=config.get("codec_backend", "ffmpeg"),
+                                        codec_batching=config.get("codec_batching", False),
+                                        codec_delay_table=config.get("codec_delay_table"),
+                                        **self.build_codec_cache(),
+                                        codec_max_concurrency=config.get("codec_service", {}).get("max_concurrency"),
+                                        codec_scratch_dir=config.get("codec_service", {}).get("scratch_dir"),
+                                        device=self.device,
+                                        num_workers=config.get("attack_pool_workers", 0),
+                                        pool_attacks=self.attack_pool_attacks(),
+                                        neural_codec_window=self.neural_codec_window(),
+                                        neural_codec_inference=config.get("neural_codec_inference", "fp32"),
+                                        **self.build_attack_cache())
         
+        # Watermarked audio of the last embedded chunk, reused by the following rows of the same chunk
+        self._embedded_chunk = {}
+
+        # 16 kHz reference audio of the last chunks, shared between the models of a `MultiSolver`
+        self.reference_cache = OrderedDict()
+
+        # Attack-independent metrics of each chunk ('bitwise/clean', 'bitwise/no_watermark_clean', ...),
+        # optionally persisted across runs with the same model, checkpoint and seed
+        self.clean_metrics_memo = CleanMetricsMemo(identity={'model_type': self.model_type,
+                                                             'checkpoint': config.get("checkpoint"),
+                                                             'random_seed_for_eval': config.get("random_seed_for_eval", 42),
+                                                             'sample_rate': self.sample_rate,
+                                                             'eval_seg_duration': self.eval_seg_duration},
+                                                   path=config.get("clean_metrics_memo"))
+
         # Set number of data loading workers (default: 4)
         self.num_workers = config.get("num_workers", 4)
 
@@ -127,9 +143,162 @@ class Solver(object):
         os.makedirs(self.run_dir + '/logs', exist_ok=True)
         logger.add(os.path.join(self.run_dir + '/logs', "stdout.log"))
 
-    def build_dataloaders(self):
+    def _init_experiment(self,
+                         config: DictConfig):
+        """
+        Set up the run directory, the experiment logger and the result shards.
+
+        This is the part of the initialization shared with `merge_results`, which does not
+        need models, attacks or data loaders.
+
+        Args:
+            config (DictConfig): Configuration object for the experiment.
+        """
+        # Set model_type
+        try:
+            self.model_type = config.model_type
+            if self.model_type is None:
+                raise ValueError("config.model_type is set to None. This value must be provided.")
+        except AttributeError:
+            raise AttributeError("config must include a 'model_type' field. This value is required.")
+    
+        # Create a run_dir with model name and timestamp, if not available
+        self.run_dir = config.get("run_dir")
+        if self.run_dir is None:
+            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            self.run_dir = f"{self.model_type}/{timestamp}"
+
+        self.test_results_dir = os.path.join(self.run_dir, 'results')
+        os.makedirs(self.test_results_dir, exist_ok=True)
+        
+        attack_level = config.get("test_suffix", "unknown")
+        random_seed = config.get("random_seed_for_eval", 42)
+        
+        if not hasattr(config, "exp_name") or config.exp_name is None:
+            self.config.exp_name = f"{self.model_type}_{attack_level}_seed{random_seed}"
+
+        exp_name = self.config.exp_name
+
+        self.exp_logger = ExperimentLogger(self.run_dir, 
+                           use_wandb=config.wandb,
+                           project_name=config.get("project_name", "raw-benchmark"),
+                           exp_name=exp_name)
+        
+        self.csv_delimiter = config.get("csv_delimiter", "|")
+        self.csv_suffix = '' if config.get("test_suffix") is None else '_' + config.test_suffix
+        self.test_path = config.dataset.test_path
+
+        # Per-row results are appended to shards, so that a restarted run can skip finished rows
+        self.result_shard_dir = os.path.join(self.test_results_dir, 'shards')
+        self.result_prefix = f'test_results{self.csv_suffix}'
+        self.resume = config.get("resume", False)
+        # Everything the per-row results depend on besides the rows themselves. Shards written with
+        # a different identity (e.g. another checkpoint in the same run_dir) are not resumed nor merged
+        self.result_identity = {'model_type': self.model_type,
+                                'checkpoint': config.get("checkpoint"),
+                                'random_seed_for_eval': config.get("random_seed_for_eval", 42),
+                                'sample_rate': config.sample_rate,
+                                'eval_seg_duration': config.dataset.eval_seg_duration,
+                                'attack': OmegaConf.to_container(config.attack, resolve=True),
+                                # The perceptual metrics add columns to the shards
+                                'full_perceptual': config.get("full_perceptual", False),
+                                **self.attack_identity()}
+        self.result_writer = None
+        self.num_finished_rows = 0
+
+        # Evaluation shards: this process only evaluates the rows assigned to `shard_index`
+        self.shard_index = config.get("shard_index", 0)
+        self.num_shards = config.get("num_shards", 1)
+        if not 0 <= self.shard_index < self.num_shards:
+            raise ValueError(f"shard_index must be in [0, num_shards={self.num_shards}), got {self.shard_index}.")
+
+    def attack_identity(self) -> dict:
+        """
+        Settings besides the input audio and the attack parameters that the attacked audio depends on,
+        shared by the attack cache namespace and the identity of the result shards.
+
+        Returns:
+            dict: Settings of the attack implementations, codecs and neural codecs.
+        """
+        attack_cfg = self.config.attack
+        codec_backend = self.config.get("codec_backend", "ffmpeg")
+        return {'attack_implementation': ATTACK_IMPLEMENTATION_VERSION,
+                'codec_identity': codec_identity(codec_backend, self.config.get("ffmpeg4codecs")),
+                'codec_backend': codec_backend,
+                'codec_batching': self.config.get("codec_batching", False),
+                'codec_delay_calibration': self.config.get("codec_delay_table") is not None,
+                'dac': OmegaConf.to_container(attack_cfg.dac, resolve=True),
+                'encodec': OmegaConf.to_container(attack_cfg.encodec, resolve=True),
+                'neural_codec_window': self.neural_codec_window(),
+                'neural_codec_inference': self.config.get("neural_codec_inference", "fp32")}
+
+    def build_attack_cache(self) -> dict:
+        """
+        Build the on-disk cache of attacked unwatermarked audio, shared by all the models evaluated
+        with the same `attack_cache.dir`.
+
+        Returns:
+            dict: Keyword arguments of `AudioAttack` for the cache (empty if the cache is disabled).
+        """
+        cache_cfg = self.config.get("attack_cache", None)
+        if cache_cfg is None or cache_cfg.get("dir") is None:
+            return {}
+
+        cache = AttackCache(cache_cfg.dir, 
+                            max_size_gb=cache_cfg.get("max_size_gb", 20.0),
+                            namespace=self.attack_identity())
+        cached_attacks = cache_cfg.get("attacks", None)
+
+        return {'cache': cache,
+                'cached_attacks': None if cached_attacks is None else list(cached_attacks)}
+
+    def attack_pool_attacks(self) -> Optional[List[str]]:
+        """
+        Attacks run by the worker processes of the attack pool.
+
+        Returns:
+            Optional[List[str]]: `attack_pool_attacks` of the config (None: default attacks of `AudioAttack`).
+        """
+        pool_attacks = self.config.get("attack_pool_attacks", None)
+        return None if pool_attacks is None else list(pool_attacks)
+
+    def neural_codec_window(self) -> dict:
+        """
+        Windowing of the neural codecs (see `neural_codec_window` in configs/eval.yaml).
+
+        Returns:
+            dict: Keyword arguments of the neural codec wrappers (empty if the inputs are not windowed).
+        """
+        window_cfg = self.config.get("neural_codec_window", None)
+        if window_cfg is None or window_cfg.get("window_seconds") is None:
+            return {}
+        return OmegaConf.to_container(window_cfg, resolve=True)
+
+    def build_codec_cache(self) -> dict:
+        """
+        Build the `AudioAttack` arguments of the on-disk cache of codec outputs (MP3, AAC and Vorbis).
+
+        Unlike `attack_cache`, the codec cache stores every codec output, watermarked or not, and its
+        keys include the codec build (`ffmpeg -version`), so it can be shared by all the models and runs.
+
+        Returns:
+            dict: Keyword arguments of `AudioAttack` for the codec cache (empty if the cache is disabled).
+        """
+        cache_cfg = self.config.get("codec_cache", None)
+        if cache_cfg is None or cache_cfg.get("dir") is None:
+            return {}
+
+        return {'codec_cache_dir': cache_cfg.dir,
+                'codec_cache_max_size_gb': cache_cfg.get("max_size_gb", 10.0)}
+
+    def build_dataloaders(self,
+                          exclude_keys: Optional[Set[tuple]] = None):
         """
         Build PyTorch DataLoaders for test dataset based on configuration.
+
+        Args:
+            exclude_keys (Set[tuple], optional): Keys of the rows to skip (see `raw_bench.results.result_key`).
+                Defaults to the rows already written to the result shards when `resume` is enabled.
         """
         if self.test_path is not None:
             assert os.path.isfile(self.test_path), f"Test path {self.test_path} does not a valid file."
@@ -143,23 +312,73 @@ class Solver(object):
                 allow_missing_dataset=self.config.allow_missing_dataset
             )
 
-            if self.config.dataset.eval_batch_size > 1:
-                logger.warning("Currently, we only support batch size of 1 for test DataLoader. ")
+            if self.num_shards > 1:
+                test.select_shard(self.shard_index, self.num_shards)
+                logger.info(f"Evaluating shard {self.shard_index}/{self.num_shards} ({len(test)} rows).")
+
+            if exclude_keys is None and self.resume:
+                exclude_keys = self.finished_keys()
+            if exclude_keys:
+                self.num_finished_rows = test.exclude_rows(exclude_keys)
+                if self.num_finished_rows > 0:
+                    logger.info(f"Resuming evaluation: {self.num_finished_rows} finished rows are skipped.")
+
+            batch_size = self.config.dataset.get("eval_batch_size", 1)
+            if batch_size > 1 and not self.supports_batched_eval:
+                logger.warning(f"{self.__class__.__name__} only supports batch size of 1 for test DataLoader. "
+                               f"eval_batch_size={batch_size} is ignored.")
+                batch_size = 1
+
+            # 'row': manifest order, 'attack': batches share the same attack type and parameters,
+            # 'chunk': the attack rows of each chunk are consecutive
+            eval_order = self.config.dataset.get("eval_order", "row")
+            if eval_order == 'row':
+                sampler_kwargs = {'batch_size': batch_size, 'shuffle': False}
+            elif eval_order == 'attack':
+                sampler_kwargs = {'batch_sampler': AttackGroupedBatchSampler(test, batch_size=batch_size)}
+            elif eval_order == 'chunk':
+                sampler_kwargs = {'batch_sampler': ChunkGroupedBatchSampler(test, batch_size=batch_size)}
+            else:
+                raise ValueError(f"Entered eval_order {eval_order} not supported!")
 
             self.test_loader = DataLoader(
                 test,
-                batch_size=1,  # self.config.dataset.eval_batch_size
-                shuffle=False,
                 num_workers=self.num_workers,
-                worker_init_fn=init_worker
+                worker_init_fn=init_worker,
+                collate_fn=collate_test_batch,
+                **sampler_kwargs
             )
 
-            logger.info(f"Test loader built with {len(test)} samples.")
+            logger.info(f"Test loader built with {len(test)} samples "
+                        f"(batch size: {batch_size}, order: {eval_order}).")
 
         else:
             logger.error("No test path specified. Test DataLoader cannot be created.")
             raise ValueError("Missing required test_path.")
 
+    def finished_keys(self) -> Set[tuple]:
+        """
+        Keys of the rows already written to the result shards of this run.
+
+        Returns:
+            Set[tuple]: Keys of the finished rows (see `raw_bench.results.result_key`).
+        """
+        df_finished = load_result_shards(self.result_shard_dir, self.result_prefix, self.csv_delimiter,
+                                         identity=self.result_identity)
+        return finished_keys(df_finished)
+
+    def prepare_eval(self):
+        """
+        Set the models and the attacks to evaluation mode and reset the state of the evaluation loop.
+        """
+        self.eval_mode()
+        if self.audio_attack is not None:
+            self.audio_attack.set_mode('test')
+
+        self.cur_losses_log = {}
+        self.sisnr_f = ScaleInvariantSignalNoiseRatio().to(self.device)
+        self.num_items = self.num_finished_rows  # Keep track of the number of rows processed (including resumed ones)
+
     def close_eval(self):
         """
         Close the solver, releasing any resources or handles.
@@ -167,8 +386,330 @@ class Solver(object):
         logger.info("Evaluation was done successfully. Closing solver and releasing resources.")
         if hasattr(self, 'exp_logger'):
             self.exp_logger.close()
+        self.clean_metrics_memo.close()
+        self.audio_attack.close()
+        self.audio_attack.release()
         if not self.test_loader.dataset.all_the_datasets_loaded:
             logger.warning("This test is only done for the partial datasets (allow_missing_dataset=True) option")
+
+    def write_result(self,
+                     audio_filepath: str,
+                     dataset: str,
+                     attack_type: str,
+                     attack_params: str,
+                     chunk_index: int,
+                     metrics: Dict[str, float]):
+        """
+        Append the result of a test row to the result shard of this run.
+
+        Args:
+            audio_filepath (str): Path to the audio file.
+            dataset (str): Dataset name.
+            attack_type (str): Attack type of the row.
+            attack_params (str): JSON-encoded attack parameters of the row (or None).
+            chunk_index (int): Index of the chunk within the audio file.
+            metrics (Dict[str, float]): Metrics of the row.
+        """
+        if self.result_writer is None:
+            self.result_writer = ResultShardWriter(self.result_shard_dir, self.result_prefix, self.csv_delimiter,
+                                                   identity=self.result_identity)
+            logger.info(f"Writing per-row results to {self.result_writer.path}")
+
+        self.result_writer.write({'audio_filepath': audio_filepath,
+                                  'relative_filepath': relative_filepath(audio_filepath, dataset, self.config.datapath),
+                                  'dataset': dataset,
+                                  'attack_type': attack_type,
+                                  'attack_params': attack_params,
+                                  'chunk_index': chunk_index,
+                                  **metrics})
+
+    def finalize_results(self,
+                         epoch_num: int = None,
+                         write_to_disk: bool = True) -> pd.DataFrame:
+        """
+        Rebuild the results of all the finished rows from the shards (including rows of
+        previous runs), compute the aggregates and write the raw results to disk.
+
+        Args:
+            epoch_num (int, optional): Epoch number for naming output files.
+            write_to_disk (bool): Whether to write raw results to disk.
+
+        Returns:
+            pd.DataFrame: DataFrame of results.
+        """
+        if self.result_writer is not None:
+            self.result_writer.close()
+            self.result_writer = None
+
+        df_result = load_result_shards(self.result_shard_dir, self.result_prefix, self.csv_delimiter,
+                                       identity=self.result_identity)
+        if self.num_shards > 1:
+            # The other shards may still be running, the aggregation is done once by `merge_results`
+            logger.info(f"Shard {self.shard_index}/{self.num_shards} finished. Run scripts/eval.py with merge=true "
+                        f"once all the shards are done to aggregate the results.")
+            return df_result
+
+        self.aggregate_results(df_result, epoch_num=epoch_num, write_to_disk=write_to_disk)
+
+        return df_result
+
+    def aggregate_results(self,
+                          df_result: pd.DataFrame,
+                          epoch_num: int = None,
+                          write_to_disk: bool = True):
+        """
+        Compute the aggregates of the per-row results and write the raw results to disk.
+
+        Args:
+            df_result (pd.DataFrame): Per-row results (see `finalize_results`).
+            epoch_num (int, optional): Epoch number for naming output files.
+            write_to_disk (bool): Whether to write raw results to disk.
+        """
+        if len(df_result) == 0:
+            logger.warning("No results were found. Skipping the aggregation.")
+            return
+
+        metrics = [col for col in df_result.columns if col not in ID_COLUMNS]
+        key_columns = ['bitwise/clean', 'bitwise/distorted', 'hard/clean', 'hard/distorted', 'sisnr_wm', 'sisnr_attack']
+
+        # per chunk aggregation
+        self.compute_agg(df_result, metrics, self.csv_suffix, key_columns, prefix='chunklv')
+
+        # write raw results to disk
+        if write_to_disk:
+            os.makedirs(self.test_results_dir, exist_ok=True)
+            if epoch_num is not None:
+                output_csv_filename = f'test_results_epoch{self.csv_suffix}{epoch_num}.csv'
+            else:
+                output_csv_filename = f'test_results{self.csv_suffix}.csv'
+        
+            df_result.to_csv(os.path.join(self.test_results_dir, output_csv_filename), 
+                             sep=self.csv_delimiter,
+                             index=False)
+
+    @classmethod
+    def merge_results(cls,
+                      config: DictConfig) -> pd.DataFrame:
+        """
+        Merge the result shards written by all the evaluation shards of a run (`shard_index`/`num_shards`)
+        and compute the aggregates once over their union.
+
+        Shards evaluated on other machines must be copied to `<run_dir>/results/shards` beforehand.
+        Models, attacks and audio are not loaded.
+
+        Args:
+            config (DictConfig): Configuration of the evaluation (same `run_dir` and `test_suffix` as the shards).
+
+        Returns:
+            pd.DataFrame: DataFrame of the merged results.
+        """
+        solver = cls.__new__(cls)
+        solver.config = config
+        solver._init_experiment(config)
+
+        df_result = load_result_shards(solver.result_shard_dir, solver.result_prefix, solver.csv_delimiter,
+                                       identity=solver.result_identity, strict=True)
+
+        # Check that every row of the test set was evaluated by one of the shards
+        if solver.test_path is not None:
+            test = AudioDataset(solver.test_path,
+                                config.datapath,
+                                config.dataset,
+                                num_samples=int(config.dataset.eval_seg_duration * config.sample_rate),
+                                mode='test',
+                                allow_missing_dataset=config.allow_missing_dataset)
+            num_rows = len(test)
+            test.exclude_rows(finished_keys(df_result))
+            if len(test) > 0:
+                missing = pd.Series([row_shard_index(test.row_key(idx), solver.num_shards)
+                                     for idx in range(len(test))]).value_counts().sort_index()
+                logger.warning(f"{len(test)}/{num_rows} rows of the test set have no result. "
+                               f"Missing rows per shard (num_shards={solver.num_shards}): {missing.to_dict()}")
+
+        solver.aggregate_results(df_result, write_to_disk=True)
+        solver.exp_logger.close()
+
+        return df_result
+
+    def parse_attack_params(self,
+                            attack_type: str,
+                            attack_params: str) -> dict:
+        """
+        Parse the attack parameters of a test row into keyword arguments for `AudioAttack`.
+
+        Args:
+            attack_type (str): Attack type of the row.
+            attack_params (str): JSON-encoded attack parameters of the row (or None).
+
+        Returns:
+            dict: Keyword arguments for the attack.
+        """
+        args = {} if attack_params is None else json.loads(attack_params)
+
+        if attack_type == 'phase_shift':
+            # During test and validation, the phase shift parameter is in seconds.
+            args['shift'] = int(args['shift'] * self.sample_rate)
+
+        return args
+
+    def run_eval_stages(self,
+                        embed_fn: Callable,
+                        attack_fn: Callable,
+                        detect_fn: Callable,
+                        metrics_fn: Callable):
+        """
+        Run the evaluation over the test loader as a sequence of stages: load, embed, attack, detect and metrics.
+
+        With `pipeline.enabled=true`, the stages run concurrently in threads connected by bounded queues,
+        so that CPU-bound attacks (ffmpeg codecs, dynamics, time stretching) overlap with model inference, and the
+        utilisation of every stage is reported at the end. Otherwise, each batch goes through all the
+        stages before the next one is loaded.
+
+        Args:
+            embed_fn (Callable): Watermarks a batch returned by the test loader.
+            attack_fn (Callable): Attacks the watermarked and the original audio of a batch.
+            detect_fn (Callable): Decodes the messages of a batch.
+            metrics_fn (Callable): Computes and writes the metrics of every row of a batch.
+        """
+        pipeline_cfg = self.config.get("pipeline", None) or {}
+        pipelined = pipeline_cfg.get("enabled", False)
+        # Only the attacks run in several threads, the models are used by a single thread each
+        attack_workers = pipeline_cfg.get("attack_workers", 4) if pipelined else 1
+
+        stages = [Stage('embed', embed_fn),
+                  Stage('attack', attack_fn, num_workers=attack_workers),
+                  Stage('detect', detect_fn),
+                  Stage('metrics', metrics_fn)]
+
+        run_stages(self.test_loader,
+                   stages,
+                   pipelined=pipelined,
+                   queue_size=pipeline_cfg.get("queue_size", 4),
+                   progress=qqdm)
+        get_codec_service().report()
+
+    def attack_clean(self,
+                     audio: torch.Tensor,
+                     key: tuple,
+                     attack_type: str,
+                     attack_params: str,
+                     shared: Optional[dict] = None,
+                     **kwargs) -> Future:
+        """
+        Attack the original (unwatermarked) audio of a row.
+
+        The clean path does not depend on the model, so within a multi-model evaluation
+        (see `raw_bench.solver.multi.MultiSolver`) it is computed by the first model and
+        reused by the others through `shared`.
+
+        Args:
+            audio (torch.Tensor): Original audio of the row.
+            key (tuple): Chunk key of the row (see `raw_bench.dataloader.chunk_key`).
+            attack_type (str): Attack type of the row.
+            attack_params (str): JSON-encoded attack parameters of the row (or None).
+            shared (dict, optional): Attacked original audio of the current batch, shared between models.
+            **kwargs: Parsed attack parameters (see `parse_attack_params`).
+
+        Returns:
+            Future: Future of the attacked audio.
+        """
+        if shared is None:
+            return self.audio_attack.submit(audio, attack_type=attack_type, use_cache=True, **kwargs)
+
+        shared_key = (key, attack_type, attack_params)
+        if attack_type in self.stft_attacks:
+            shared_key += (str(self.config.get("stft")),)
+        if shared_key not in shared:
+            shared[shared_key] = self.audio_attack.submit(audio, attack_type=attack_type, use_cache=True, **kwargs)
+
+        return shared[shared_key]
+
+    def row_chunk_key(self,
+                      audio_filepath: str,
+                      dataset: str,
+                      start_time: float) -> tuple:
+        """
+        Chunk key of a row of a test batch.
+
+        Args:
+            audio_filepath (str): Path to the audio file, as returned by the test loader.
+            dataset (str): Dataset name.
+            start_time (float): Start time of the chunk in the audio file, in seconds.
+
+        Returns:
+            tuple: Chunk key (see `raw_bench.dataloader.chunk_key`).
+        """
+        return chunk_key(dataset, relative_filepath(audio_filepath, dataset, self.config.datapath), start_time)
+
+    def chunk_generator(self,
+                        key: tuple) -> torch.Generator:
+        """
+        Random generator for the message of a chunk, seeded from the chunk key and `random_seed_for_eval`.
+
+        All the attack rows of a chunk get the same message, whatever the evaluation order,
+        sharding or resumption, so the watermarked chunk can be shared between them.
+
+        Args:
+            key (tuple): Chunk key (see `raw_bench.dataloader.chunk_key`).
+
+        Returns:
+            torch.Generator: CPU generator seeded for this chunk.
+        """
+        digest = hashlib.md5('|'.join(str(k) for k in key).encode('utf-8')).hexdigest()
+        seed = (int(digest, 16) + self.config.get("random_seed_for_eval", 42)) % (2**63)
+        return torch.Generator().manual_seed(seed)
+
+    def embed_chunks(self,
+                     chunk_keys: List[tuple],
+                     embed_fn: Callable[[List[int]], torch.Tensor]) -> torch.Tensor:
+        """
+        Watermark each unique chunk of a batch only once and share the result between its rows.
+
+        The last chunk of the batch is kept for the next batch, so that with `eval_order=chunk`
+        a chunk is embedded once for all its attack rows, even when they span several batches.
+
+        Args:
+            chunk_keys (List[tuple]): Chunk key of each row of the batch.
+            embed_fn (Callable): Function mapping a list of row indices of the batch to the
+                watermarked audio of these rows, stacked along the first dimension.
+
+        Returns:
+            torch.Tensor: Watermarked audio of every row of the batch, stacked along the first dimension.
+        """
+        first_rows = OrderedDict()
+        for b, key in enumerate(chunk_keys):
+            first_rows.setdefault(key, b)
+
+        embedded = dict(self._embedded_chunk)
+        new_keys = [key for key in first_rows if key not in embedded]
+        if len(new_keys) > 0:
+            y_wm_new = embed_fn([first_rows[key] for key in new_keys])
+            embedded.update(zip(new_keys, y_wm_new))
+
+        self._embedded_chunk = {chunk_keys[-1]: embedded[chunk_keys[-1]]}
+
+        return torch.stack([embedded[key] for key in chunk_keys])
+
+    def clean_metrics(self,
+                      key: tuple,
+                      compute_fn: Callable[[], Dict[str, float]]) -> Dict[str, float]:
+        """
+        Get the attack-independent metrics of a chunk, computing them only for the first attack row of the chunk.
+
+        Args:
+            key (tuple): Chunk key (see `raw_bench.dataloader.chunk_key`).
+            compute_fn (Callable): Function computing the metrics of the chunk.
+
+        Returns:
+            Dict[str, float]: Attack-independent metrics of the chunk.
+        """
+        metrics = self.clean_metrics_memo.get(key)
+        if metrics is None:
+            metrics = compute_fn()
+            self.clean_metrics_memo.put(key, metrics)
+
+        return metrics
+
     def random_message(self):
         """
         Generate a random message for watermarking.
@@ -232,6 +773,47 @@ class Solver(object):
         self.visqol_api_48k = visqol_lib_py.VisqolApi()
         self.visqol_api_48k.Create(config_48k)
 
+    def load_reference(self,
+                       audio_filepath: str,
+                       start_time: float,
+                       audio_duration: float) -> torch.Tensor:
+        """
+        Load the original audio of a chunk at 16 kHz, the reference of the perceptual metrics.
+
+        The last `reference_cache_size` chunks are kept in memory, so the reference is read and
+        resampled once for all the attack rows of a chunk (and all the models of a `MultiSolver`).
+
+        Args:
+            audio_filepath (str): Path to the original audio file.
+            start_time (float): Start time of the segment.
+            audio_duration (float): Duration of the segment.
+
+        Returns:
+            torch.Tensor: Reference audio at 16 kHz.
+        """
+        key = (str(audio_filepath), round(float(start_time), 6), float(audio_duration))
+        if key in self.reference_cache:
+            self.reference_cache.move_to_end(key)
+            return self.reference_cache[key]
+
+        metadata = torchaudio.info(audio_filepath)
+        orig_sample_rate = metadata.sample_rate
+        audio_orig, _ = torchaudio.load(audio_filepath, 
+                                        int(start_time*orig_sample_rate), 
+                                        num_frames=int(audio_duration*orig_sample_rate))
+
+        if orig_sample_rate != 16000:
+            y_16k = torchaudio.transforms.Resample(orig_freq=orig_sample_rate,
+                                                   new_freq=16000)(audio_orig)
+        else:
+            y_16k = audio_orig.clone()
+
+        self.reference_cache[key] = y_16k
+        while len(self.reference_cache) > self.reference_cache_size:
+            self.reference_cache.popitem(last=False)
+
+        return y_16k
+
     def compute_perceptual_metrics(self,
                                    audio_filepath: str,
                                    start_time: float,
@@ -263,19 +845,10 @@ class Solver(object):
             - moslqo_distorted_48k: MOS-LQO between the original audio and the distorted audio (48 kHz).
             - moslqo_distorted_16k: MOS-LQO between the original audio and the distorted audio (16 kHz).        
         """
-        metadata = torchaudio.info(audio_filepath)
-        orig_sample_rate = metadata.sample_rate
-        audio_orig, _ = torchaudio.load(audio_filepath, 
-                                        int(start_time*orig_sample_rate), 
-                                        num_frames=int(audio_duration*orig_sample_rate))
+        y_16k = self.load_reference(audio_filepath, start_time, audio_duration)
 
         y_wm = watermarked_audio.detach().to('cpu')
         y_distorted = distorted_audio.detach().to('cpu')
-        if orig_sample_rate != 16000:
-            y_16k = torchaudio.transforms.Resample(orig_freq=orig_sample_rate,
-                                                   new_freq=16000)(audio_orig)
-        else:
-            y_16k = audio_orig.clone()
 
         if self.sample_rate != 16000:
             y_distorted_16k = torchaudio.transforms.Resample(orig_freq=self.sample_rate, 
@@ -351,7 +924,7 @@ class Solver(object):
 
         grouped_by_track = df_per_track.groupby(['audio_filepath', 'attack_type', 'attack_params'])
 
-        columns_to_aggregate = set(df_per_track.columns) - {'audio_filepath', 'dataset', 'attack_type', 'attack_params', 'chunk_index', 'num_frames'}
+        columns_to_aggregate = set(df_per_track.columns) - {'audio_filepath', 'relative_filepath', 'dataset', 'attack_type', 'attack_params', 'chunk_index', 'num_frames'}
         # hard_columns = [col for col in columns_to_aggregate if col.startswith('hard')]
         mean_columns = [col for col in columns_to_aggregate if col not in sum_columns]
 
@@ -389,7 +962,7 @@ class Solver(object):
                     logger.warning(f"Different {column} values found in group {name}")
         
         # Set of columns except for audio_filepath, dataset, attack_type, attack_params, chunk_index
-        columns_to_aggregate = set(df_per_track.columns) - {'audio_filepath', 'dataset', 'attack_type', 'attack_params', 'chunk_index'}
+        columns_to_aggregate = set(df_per_track.columns) - {'audio_filepath', 'relative_filepath', 'dataset', 'attack_type', 'attack_params', 'chunk_index'}
         hard_columns = [col for col in columns_to_aggregate if col.startswith('hard')]
         very_hard_columns = [f'very_{col}' for col in columns_to_aggregate if col.startswith('hard')]
         mean_columns = [col for col in columns_to_aggregate if col not in hard_columns]
@@ -0,0 +1,165 @@
+from typing import Dict, List
+
+import pandas as pd
+from loguru import logger
+from omegaconf import OmegaConf
+
+from .base import Solver
+
+
+class MultiSolver(object):
+    """
+    Evaluate several watermarking models in a single pass over the test set.
+
+    The models share the test loader (each chunk is read and normalized once), the attacks on the
+    original audio (the `no_watermark_distorted` control and `sisnr_attack` of a row are computed
+    from the same attacked signal for every model) and the reference audio of the perceptual metrics.
+    Each model only runs its own embedding, the attacks on its watermarked audio and its detector.
+    Results are written to the run directory of each model, exactly as with separate evaluations.
+    """
+    # Settings that must be identical for the models to share data and attacks
+    shared_fields = ['sample_rate', 'device', 'ffmpeg4codecs', 'codec_backend', 'codec_batching', 'codec_delay_table',
+                     'neural_codec_window', 'neural_codec_inference', 'dataset', 'attack', 'datapath', 'shard_index', 'num_shards', 'allow_missing_dataset', 'full_perceptual']
+
+    def __init__(self,
+                 solvers: List[Solver]):
+        """
+        Initialize the MultiSolver with already built solvers.
+
+        Args:
+            solvers (List[Solver]): Solvers of the models to evaluate, with the same data and attack settings.
+        """
+        if len(solvers) == 0:
+            raise ValueError("MultiSolver needs at least one solver.")
+
+        self.solvers = solvers
+        self.check_shared_settings()
+
+        run_dirs = [solver.run_dir for solver in solvers]
+        if len(set(run_dirs)) != len(run_dirs):
+            raise ValueError(f"Every model must have its own run_dir, got {run_dirs}.")
+
+        # The batch size is limited by the models that only support a single row per step
+        owner = next((solver for solver in solvers if not solver.supports_batched_eval), solvers[0])
+
+        # A row is skipped only if all the models have already evaluated it. Rows finished by some
+        # of the models are evaluated again, and the most recent result of each row is kept by `load_result_shards`.
+        exclude_keys = None
+        if all(solver.resume for solver in solvers):
+            exclude_keys = set.intersection(*[solver.finished_keys() for solver in solvers])
+
+        num_finished_rows = owner.num_finished_rows
+        owner.build_dataloaders(exclude_keys=exclude_keys if exclude_keys is not None else set())
+        owner.num_finished_rows = num_finished_rows
+        self.test_loader = owner.test_loader
+
+        reference_cache = solvers[0].reference_cache
+        for solver in solvers:
+            solver.test_loader = self.test_loader
+            solver.reference_cache = reference_cache
+
+        logger.info(f"Evaluating {len(solvers)} models in a single pass: "
+                    f"{', '.join(solver.model_type for solver in solvers)}")
+
+    def check_shared_settings(self):
+        """
+        Check that the settings the shared data and attacks depend on are identical for all the models.
+        """
+        def to_container(value):
+            if OmegaConf.is_config(value):
+                return OmegaConf.to_container(value, resolve=True)
+            return value
+
+        reference = self.solvers[0]
+        for solver in self.solvers[1:]:
+            for field in self.shared_fields:
+                expected = to_container(reference.config.get(field))
+                actual = to_container(solver.config.get(field))
+                if expected != actual:
+                    raise ValueError(f"{field} of {solver.model_type} ({actual}) differs from "
+                                     f"{reference.model_type} ({expected}). All the models of a "
+                                     f"single-pass evaluation must share it.")
+
+    def embed_batch(self, ret: tuple) -> List[dict]:
+        """
+        Watermark a batch of the test loader with every model.
+
+        Args:
+            ret (tuple): Batch returned by the test loader.
+
+        Returns:
+            List[dict]: State of the batch of every model.
+        """
+        return [solver.embed_batch(ret) for solver in self.solvers]
+
+    def attack_batch(self, batches: List[dict]) -> List[dict]:
+        """
+        Attack the watermarked audio of every model and the original audio once for all the models.
+
+        Args:
+            batches (List[dict]): State of the batch of every model (see `embed_batch`).
+
+        Returns:
+            List[dict]: State of the batch of every model with the attacked audio.
+        """
+        shared = {}
+        for batch in batches:
+            batch['shared_attacks'] = shared
+
+        return [solver.attack_batch(batch) for solver, batch in zip(self.solvers, batches)]
+
+    def detect_batch(self, batches: List[dict]) -> List[dict]:
+        """
+        Detect the watermarks with every model.
+
+        Args:
+            batches (List[dict]): State of the batch of every model (see `attack_batch`).
+
+        Returns:
+            List[dict]: State of the batch of every model with the decoded messages.
+        """
+        return [solver.detect_batch(batch) for solver, batch in zip(self.solvers, batches)]
+
+    def write_batch_metrics(self, batches: List[dict]):
+        """
+        Compute and write the metrics of every model.
+
+        Args:
+            batches (List[dict]): State of the batch of every model (see `detect_batch`).
+        """
+        for solver, batch in zip(self.solvers, batches):
+            solver.write_batch_metrics(batch)
+
+    def eval(self,
+             epoch_num: int = None,
+             write_to_disk: bool = True) -> Dict[str, pd.DataFrame]:
+        """
+        Evaluate all the models on the test set.
+
+        Args:
+            epoch_num (int, optional): Epoch number for naming output files.
+            write_to_disk (bool): Whether to write results to disk.
+
+        Returns:
+            Dict[str, pd.DataFrame]: DataFrame of results of every model, by run directory.
+        """
+        for solver in self.solvers:
+            solver.prepare_eval()
+        logger.info("Start evaluation.")
+
+        reference = self.solvers[0]
+        reference.seed_everything(reference.config.random_seed_for_eval)
+        reference.run_eval_stages(embed_fn=self.embed_batch,
+                                  attack_fn=self.attack_batch,
+                                  detect_fn=self.detect_batch,
+                                  metrics_fn=self.write_batch_metrics)
+
+        return {solver.run_dir: solver.finalize_results(epoch_num=epoch_num, write_to_disk=write_to_disk)
+                for solver in self.solvers}
+
+    def close_eval(self):
+        """
+        Close all the solvers, releasing any resources or handles.
+        """
+        for solver in self.solvers:
+            solver.close_eval()
@@ -1,19 +1,14 @@
-import json
 import math
 import os
-import time
 from collections import defaultdict, OrderedDict
 from pathlib import Path
 from types import SimpleNamespace
 from typing import Dict, List, Optional, Tuple, Union
 
-import pandas as pd
 import torch
 from loguru import logger
 from omegaconf import DictConfig, OmegaConf
-from qqdm import qqdm
 from ..model.silentcipher import CarrierDecoder, Encoder, MsgDecoder
-from torchmetrics.audio.snr import ScaleInvariantSignalNoiseRatio
 
 from .base import Solver
 from ..utils import AVERAGE_ENERGY_VCTK
@@ -23,6 +18,12 @@ DEC_CFG = SimpleNamespace(
     no_normalization=False
 )
 
+# Metrics that only depend on the chunk and its message, not on the attack
+CLEAN_METRICS = ['msg_l', 'hard/clean', 'bitwise/clean', 'hard/no_watermark_clean', 'bitwise/no_watermark_clean']
+LOSS_LOG_ORDER = ['msg_l'] + [f'{metric}/{variant}' 
+                              for variant in ['clean', 'distorted', 'no_watermark_clean', 'no_watermark_distorted']
+                              for metric in ['hard', 'bitwise']]
+
 class SolverSilentCipher(Solver):
     def __init__(
         self, 
@@ -167,6 +168,9 @@ class SolverSilentCipher(Solver):
         total_msg_loss = 0
 
         for i in range(n_msg):
+            if 'clean' not in msg_reconst:
+                # memoized with the other attack-independent metrics of the chunk
+                break
             if msg_reconst['clean'][0][i].shape[3] == msg_gt[i].shape[3]:
                 msg_loss = torch.nn.functional.cross_entropy(
                     msg_reconst['clean'][0][i].transpose(2, 3).reshape([-1, self.msg_dim]),
@@ -178,7 +182,8 @@ class SolverSilentCipher(Solver):
             msg_loss = torch.mean(msg_loss)
             total_msg_loss += msg_loss
    
-        loss_log['msg_l'] = total_msg_loss.item() / self.n_messages
+        if 'clean' in msg_reconst:
+            loss_log['msg_l'] = total_msg_loss.item() / self.n_messages
         
         with torch.no_grad():
             for msg_reconst_key in msg_reconst:
@@ -192,7 +197,8 @@ class SolverSilentCipher(Solver):
 
     def random_message(self, 
                        batch_size: int, 
-                       sample_len: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+                       sample_len: Optional[int] = None,
+                       generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         message = []
         message_compact = []
 
@@ -207,7 +213,7 @@ class SolverSilentCipher(Solver):
 
             for _ in range(self.n_messages):
                 # Generate random indices
-                index = torch.cat((torch.randint(1, self.msg_dim, (self.msg_len - 1,)), torch.tensor([0])))
+                index = torch.cat((torch.randint(1, self.msg_dim, (self.msg_len - 1,), generator=generator), torch.tensor([0])))
 
                 # Create one-hot encoding
                 one_hot = torch.eye(self.msg_dim)[index]
@@ -234,42 +240,21 @@ class SolverSilentCipher(Solver):
 
         return message, message_compact
 
-    def encode(self, 
-               audio: torch.Tensor, 
-               msg: List[float], 
-               attack_types: List[str],
-               attack_params: List[str]):     
-           
-        def decoder(encoded: torch.Tensor, 
-                    carrier: torch.Tensor = None):
-            """
-            Parameters
-            ----------
-            encoded: torch.Tensor [shape=(B, 1, T)]
-                Watermarked audio signal
-
-            carrier: torch.Tensor [shape=(B, 1, M, T)]
-                Magnitude spectrogram of the carrier signal
-            """           
-            carrier_reconst_tag, _ = self.stft.transform(encoded.squeeze(1))
-            carrier_reconst_tag = carrier_reconst_tag.unsqueeze(1)
-
-            # decode messages from carrier
-            msg_reconst_list = []
-            pred_msg_list = []
-            
-            for i in range(self.n_messages):  # decode each msg_i using decoder_m_i
-                args = {'x': carrier_reconst_tag}
-                msg_reconst = self.dec_m[i](**args)
-                pred_message = self.calculate_aligned_message(msg_reconst)
-                msg_reconst_list.append(msg_reconst.to(self.device))
-                pred_msg_list.append(pred_message.to(self.device))
-
-            return msg_reconst_list, pred_msg_list
-        
-        assert type(msg) == list  # type(carrier) == torch.Tensor and 
+    def embed(self,
+              audio: torch.Tensor,
+              msg: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Embed the messages into the audio.
 
-        start = time.time()
+        Args:
+            audio: torch.Tensor [shape=(B, 1, T)]
+                Carrier audio signal.
+            msg: List[torch.Tensor]
+                Messages to embed (see `random_message`).
+
+        Returns:
+            torch.Tensor [shape=(B, 1, T)]: Watermarked audio signal.
+        """
         audio, msg = audio.to(self.device), [msg_i.to(self.device) for msg_i in msg]
 
         mag_carrier, carrier_phase = self.stft.transform(audio.squeeze(1))
@@ -298,138 +283,284 @@ class SolverSilentCipher(Solver):
                                               audio.shape[-1])
         y_wm = y_wm[..., :audio.shape[-1]]
 
-        mag_wm, _ = self.stft.transform(y_wm.squeeze(1))
-        mag_wm = mag_wm[:, None]
-        y_wm_cpu = y_wm.clone().detach()
+        return y_wm
+
+    def decode_message(self,
+                       encoded: torch.Tensor) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Decode the messages from an audio signal.
+
+        Parameters
+        ----------
+        encoded: torch.Tensor [shape=(B, 1, T)]
+            Watermarked audio signal
+
+        Returns
+        -------
+        Tuple[List[torch.Tensor], List[torch.Tensor]]: Reconstructed messages and aligned predicted messages.
+        """           
+        carrier_reconst_tag, _ = self.stft.transform(encoded.squeeze(1))
+        carrier_reconst_tag = carrier_reconst_tag.unsqueeze(1)
+
+        # decode messages from carrier
+        msg_reconst_list = []
+        pred_msg_list = []
+        
+        for i in range(self.n_messages):  # decode each msg_i using decoder_m_i
+            args = {'x': carrier_reconst_tag}
+            msg_reconst = self.dec_m[i](**args)
+            pred_message = self.calculate_aligned_message(msg_reconst)
+            msg_reconst_list.append(msg_reconst.to(self.device))
+            pred_msg_list.append(pred_message.to(self.device))
+
+        return msg_reconst_list, pred_msg_list
+
+    def attack(self,
+               audio: torch.Tensor,
+               y_wm: torch.Tensor,
+               attack_types: List[str],
+               attack_params: List[str],
+               keys: Optional[List[tuple]] = None,
+               shared: Optional[dict] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Attack the watermarked and the original audio.
+
+        Args:
+            audio: torch.Tensor [shape=(B, 1, T)]
+                Original audio signal.
+            y_wm: torch.Tensor [shape=(B, 1, T)]
+                Watermarked audio signal.
+            attack_types: List[str]
+                Attack type of each item.
+            attack_params: List[str]
+                JSON-encoded attack parameters of each item.
+            keys: List[tuple], optional
+                Chunk key of each item, required with `shared`.
+            shared: dict, optional
+                Attacked original audio shared with other models (see `Solver.attack_clean`).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Attacked watermarked audio (energy-normalized) and attacked original audio.
+        """
+        audio = audio.to(self.device)
+        y_wm_dirty = torch.zeros_like(y_wm)
+        y_dirty = torch.zeros_like(y_wm)
+
+        # With attack_pool_workers > 0, both signals are attacked in parallel
+        futures = []
+        for b in range(y_wm_dirty.shape[0]):
+            args = self.parse_attack_params(attack_types[b], attack_params[b])
+                                 
+            futures.append((self.audio_attack.submit(y_wm[b, ...],
+                                                     attack_type=attack_types[b],
+                                                     **args),
+                            self.attack_clean(audio[b, ...],
+                                              None if keys is None else keys[b],
+                                              attack_types[b],
+                                              attack_params[b],
+                                              shared=shared,
+                                              **args)))
+
+        for b, (y_wm_dirty_b, y_dirty_b) in enumerate(futures):
+            y_wm_dirty[b, ...] = y_wm_dirty_b.result()
+            y_dirty[b, ...] = y_dirty_b.result()
+
+        # now the each attack can handle device by itself
+        y_wm_dirty = y_wm_dirty * ((AVERAGE_ENERGY_VCTK / torch.mean(y_wm_dirty**2, dim=2, keepdim=True))**0.5)
+
+        return y_wm_dirty, y_dirty
+
+    def decode(self,
+               audio: torch.Tensor,
+               y_wm: torch.Tensor,
+               y_wm_dirty: Optional[torch.Tensor] = None,
+               y_dirty: Optional[torch.Tensor] = None,
+               decode_clean: bool = True) -> Tuple[torch.Tensor, Dict]:
+        """
+        Decode the messages of the clean and attacked signals.
+
+        Args:
+            audio: torch.Tensor [shape=(B, 1, T)]
+                Original audio signal.
+            y_wm: torch.Tensor [shape=(B, 1, T)]
+                Watermarked audio signal.
+            y_wm_dirty: torch.Tensor, optional
+                Attacked watermarked audio signal.
+            y_dirty: torch.Tensor, optional
+                Attacked original audio signal.
+            decode_clean: bool
+                Whether to decode the clean signals (skipped when the attack-independent
+                metrics of the chunk are memoized).
+
+        Returns:
+            Tuple[torch.Tensor, Dict]: Magnitude spectrogram of the carrier and the decoded messages
+                ('clean', 'distorted', 'no_watermark_clean', 'no_watermark_distorted').
+        """
+        audio = audio.to(self.device)
+        mag_carrier, _ = self.stft.transform(audio.squeeze(1))
+        mag_carrier = mag_carrier[:, None]
+
+        all_msg_reconst = {}
+        if decode_clean:
+            all_msg_reconst['clean'] = self.decode_message(y_wm)
 
-        # Decode without distortion
-        all_msg_reconst = {'clean': decoder(y_wm_cpu, carrier=mag_wm)}
+        if y_wm_dirty is not None:
+            all_msg_reconst['distorted'] = self.decode_message(y_wm_dirty)
+            if decode_clean:
+                all_msg_reconst['no_watermark_clean'] = self.decode_message(audio)
+            all_msg_reconst['no_watermark_distorted'] = self.decode_message(y_dirty)
+
+        return mag_carrier, all_msg_reconst
+
+    def encode(self, 
+               audio: torch.Tensor, 
+               msg: List[float], 
+               attack_types: List[str],
+               attack_params: List[str],
+               y_wm: Optional[torch.Tensor] = None,
+               decode_clean: bool = True):     
+        """
+        Embed the messages, apply the attacks (if any) and decode the messages.
+
+        Args:
+            audio: torch.Tensor [shape=(B, 1, T)]
+                Original audio signal.
+            msg: List[torch.Tensor]
+                Messages to embed (see `random_message`).
+            attack_types: List[str]
+                Attack type of each item (None to skip the attacks).
+            attack_params: List[str]
+                JSON-encoded attack parameters of each item.
+            y_wm: torch.Tensor, optional
+                Already watermarked audio (see `Solver.embed_chunks`).
+            decode_clean: bool
+                Whether to decode the clean signals.
+
+        Returns:
+            Tuple: Magnitude spectrogram of the carrier, decoded messages, watermarked audio and attacked original audio.
+        """
+        assert type(msg) == list  # type(carrier) == torch.Tensor and 
+
+        if y_wm is None:
+            y_wm = self.embed(audio, msg)
+        y_wm_cpu = y_wm.clone().detach()
 
         # Apply audio attacks, if available
+        y_wm_dirty, y_dirty = None, None
         if attack_types is not None:
-            y_wm_dirty = torch.zeros_like(y_wm)
-            y_dirty = torch.zeros_like(y_wm)
+            y_wm_dirty, y_dirty = self.attack(audio, y_wm_cpu, attack_types, attack_params)
 
-            for b in range(y_wm_dirty.shape[0]):
-                args = {} if attack_params[b] is None else json.loads(attack_params[b])
-                
-                if attack_types[b] == 'phase_shift':
-                    # During test and validation, the phase shift parameter is in seconds.
-                    args['shift'] = int(args['shift'] * self.sample_rate)   
-            
-                    # The computation here is in seconds, so we divide by the hop length to get the number of hops
-                    if args['shift'] > self.stft.hop_len / 2:
-                        msg_shift = int(args['shift'] / self.stft.hop_len + 0.5) # what is this?
-                                     
-                y_wm_dirty[b, ...] = self.audio_attack(y_wm_cpu[b, ...],
-                                                       attack_type=attack_types[b],
-                                                       **args)
-                y_dirty[b, ...] = self.audio_attack(audio[b, ...],
-                                                    attack_type=attack_types[b],
-                                                    **args)
-
-                                                            
-            # now the each attack can handle device by itself
-            y_wm_dirty = y_wm_dirty * ((AVERAGE_ENERGY_VCTK / torch.mean(y_wm_dirty**2, dim=2, keepdim=True))**0.5)
-            all_msg_reconst['distorted'] = decoder(y_wm_dirty, carrier=mag_wm)
-            all_msg_reconst['no_watermark_clean'] = decoder(audio, carrier=mag_carrier)
-            all_msg_reconst['no_watermark_distorted'] = decoder(y_dirty, carrier=mag_carrier)
+        mag_carrier, all_msg_reconst = self.decode(audio, y_wm_cpu, y_wm_dirty, y_dirty, decode_clean=decode_clean)
 
         return mag_carrier, all_msg_reconst, y_wm_cpu, y_dirty
 
-
     def eval(self, 
              epoch_num: int = None,
              write_to_disk: bool = True):
-        
-        if self.config.test_suffix is not None:
-            csv_suffix = '_' + self.config.test_suffix 
 
-        if self.audio_attack is not None:
-            self.audio_attack.set_mode('test')
-
-        self.eval_mode()
-        res_list = []
-        column_names = ['audio_filepath', 
-                        'dataset', 
-                        'attack_type', 
-                        'attack_params', 
-                        'chunk_index']
-        
-        sisnr_f = ScaleInvariantSignalNoiseRatio().to(self.device)        
+        self.prepare_eval()
 
         self.seed_everything(self.config.random_seed_for_eval)
-        with torch.inference_mode():
-            num_items = 0
-            data = self.test_loader
-            logger.info("Start evaluation.")
-            for ret in qqdm(data):
-                audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
-                audio_chunks *= torch.sqrt(AVERAGE_ENERGY_VCTK / torch.mean(audio_chunks**2))
-                assert audio_chunks.shape[0]==1, 'batch size should be 1'
-                msg, msg_compact = self.random_message(audio_chunks.shape[0], sample_len=audio_chunks.shape[-1])
-                
-                # feedforward and incur loss
-                msg = [msg]
-
-                # feedforward and suffer loss
-                mag_carrier, all_msg_reconst, y_wm, y_dirty = self.encode(audio=audio_chunks,
-                                                                          msg=msg, 
-                                                                          attack_types=att_types,
-                                                                          attack_params=attack_params)
-
-                cur_losses_log = self.incur_loss_test(mag_carrier=mag_carrier, 
-                                                      msg_gt=msg, 
-                                                      msg_reconst=all_msg_reconst,
-                                                      msg_compact=msg_compact)                   
-
-                if self.config.full_perceptual:
-                    perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=audio_filepaths[0],
-                                                                         start_time=start_times[0],
-                                                                         audio_duration=self.config.dataset.eval_seg_duration,
-                                                                         watermarked_audio=y_wm,
-                                                                         distorted_audio=y_dirty)
-                    cur_losses_log.update(perceptual_metrics)
-                audio_chunks = audio_chunks.to(self.device)
-                cur_losses_log['sisnr_wm'] =  sisnr_f(y_wm, audio_chunks).item()
-                cur_losses_log['sisnr_attack'] =  sisnr_f(y_dirty, audio_chunks).item()
-
-                log_dir = {f"{att_types[0]}/{key}": val for key, val in cur_losses_log.items()}
-                self.exp_logger.log_metric(log_dir, step=num_items)
-                
-                num_items += 1
-                res_list.append(
-                        [audio_filepaths[0], 
-                         datasets[0], 
-                         att_types[0], 
-                         attack_params[0], 
-                         chunk_indices[0].item()] + [val for val in cur_losses_log.values()]
-                    )
-
-        column_names += list(cur_losses_log.keys())    
-        df_result = pd.DataFrame(res_list, 
-                                 columns=column_names)
+        logger.info("Start evaluation.")
+        self.run_eval_stages(embed_fn=self.embed_batch,
+                             attack_fn=self.attack_batch,
+                             detect_fn=self.detect_batch,
+                             metrics_fn=self.write_batch_metrics)
+
+        df_result = self.finalize_results(epoch_num=epoch_num, write_to_disk=write_to_disk)
+
+        return df_result, self.cur_losses_log
+
+    def embed_batch(self, ret: tuple) -> dict:
+        audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
+        # Not in-place: the batch may be shared with other models (see `MultiSolver`)
+        audio_chunks = audio_chunks * torch.sqrt(AVERAGE_ENERGY_VCTK / torch.mean(audio_chunks**2))
+        assert audio_chunks.shape[0]==1, 'batch size should be 1'
+        audio_chunks = audio_chunks.to(self.device)
+        key = self.row_chunk_key(audio_filepaths[0], datasets[0], start_times[0].item())
+        msg, msg_compact = self.random_message(audio_chunks.shape[0], 
+                                               sample_len=audio_chunks.shape[-1],
+                                               generator=self.chunk_generator(key))
         
-        key_columns = ['bitwise/clean', 'bitwise/distorted', 'hard/clean', 'hard/distorted', 'sisnr_wm', 'sisnr_attack']
-
-        # per chunk aggregation
-        self.compute_agg(df_result, cur_losses_log.keys(), csv_suffix, key_columns, prefix='chunklv')
-
-        # write raw results to disk
-        if write_to_disk:
-            os.makedirs(self.test_results_dir, exist_ok=True)
-            if epoch_num is not None:
-                output_csv_filename = f'test_results_epoch{csv_suffix}{epoch_num}.csv'
-            else:
-                output_csv_filename = f'test_results{csv_suffix}.csv'
+        # feedforward and incur loss
+        msg = [msg]
+
+        # The chunk is only watermarked once for all its attack rows
+        y_wm = self.embed_chunks([key], lambda _: self.embed(audio_chunks, msg)).clone().detach()
+
+        return {'audio_filepaths': audio_filepaths, 
+                'datasets': datasets, 
+                'att_types': att_types, 
+                'attack_params': attack_params,
+                'chunk_indices': chunk_indices, 
+                'start_times': start_times, 
+                'key': key,
+                'msg': msg,
+                'msg_compact': msg_compact,
+                'audio': audio_chunks, 
+                'y_wm': y_wm}
+
+    def attack_batch(self, batch: dict) -> dict:
+        batch['y_wm_dirty'], batch['y_dirty'] = self.attack(batch['audio'], 
+                                                            batch['y_wm'], 
+                                                            batch['att_types'], 
+                                                            batch['attack_params'],
+                                                            keys=[batch['key']],
+                                                            shared=batch.get('shared_attacks'))
+        return batch
+
+    def detect_batch(self, batch: dict) -> dict:
+        key = batch['key']
+
+        # The clean decodes do not depend on the attack, so they only run for the first row of each chunk
+        decode_clean = key not in self.clean_metrics_memo
+
+        # feedforward and suffer loss
+        mag_carrier, all_msg_reconst = self.decode(batch['audio'], 
+                                                   batch['y_wm'], 
+                                                   batch['y_wm_dirty'], 
+                                                   batch['y_dirty'], 
+                                                   decode_clean=decode_clean)
+
+        cur_losses_log = self.incur_loss_test(mag_carrier=mag_carrier, 
+                                              msg_gt=batch['msg'], 
+                                              msg_reconst=all_msg_reconst,
+                                              msg_compact=batch['msg_compact'])                   
+
+        if decode_clean:
+            self.clean_metrics_memo.put(key, {name: cur_losses_log[name] for name in CLEAN_METRICS})
+        else:
+            cur_losses_log.update(self.clean_metrics_memo.get(key))
+        batch['losses'] = {name: cur_losses_log[name] for name in LOSS_LOG_ORDER if name in cur_losses_log}
+
+        return batch
+
+    def write_batch_metrics(self, batch: dict):
+        cur_losses_log = batch['losses']
+        audio_chunks, y_wm, y_dirty = batch['audio'], batch['y_wm'], batch['y_dirty']
+        att_types = batch['att_types']
+
+        if self.config.full_perceptual:
+            perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=batch['audio_filepaths'][0],
+                                                                 start_time=batch['start_times'][0],
+                                                                 audio_duration=self.config.dataset.eval_seg_duration,
+                                                                 watermarked_audio=y_wm,
+                                                                 distorted_audio=y_dirty)
+            cur_losses_log.update(perceptual_metrics)
+        cur_losses_log['sisnr_wm'] =  self.sisnr_f(y_wm, audio_chunks).item()
+        cur_losses_log['sisnr_attack'] =  self.sisnr_f(y_dirty, audio_chunks).item()
+
+        log_dir = {f"{att_types[0]}/{key}": val for key, val in cur_losses_log.items()}
+        self.exp_logger.log_metric(log_dir, step=self.num_items)
         
-            df_result.to_csv(os.path.join(self.test_results_dir, output_csv_filename), 
-                             sep=self.csv_delimiter,
-                             index=False)
-
-        # TODO: Take average of cur_losses_log
-
-        return df_result, cur_losses_log
+        self.num_items += 1
+        self.write_result(audio_filepath=batch['audio_filepaths'][0],
+                          dataset=batch['datasets'][0],
+                          attack_type=att_types[0],
+                          attack_params=batch['attack_params'][0],
+                          chunk_index=batch['chunk_indices'][0].item(),
+                          metrics=cur_losses_log)
+        self.cur_losses_log = cur_losses_log
     
     def calculate_aligned_message_weighted(self,
                                            msg_pred_rpt: torch.Tensor,
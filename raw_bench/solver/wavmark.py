@@ -1,16 +1,12 @@
-import json
 import os
 import time
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
 import numpy as np
-import pandas as pd
 import torch
 from loguru import logger
 from omegaconf import DictConfig
-from qqdm import qqdm
-from torchmetrics.audio.snr import ScaleInvariantSignalNoiseRatio
 from tqdm import tqdm
 from wavmark import wm_add_util
 from wavmark.models.hinet import Hinet
@@ -87,116 +83,199 @@ class SolverWavMark(Solver):
         Returns:
             Tuple[pd.DataFrame, dict]: Results DataFrame and last loss log.
         """   
-        if self.config.test_suffix is not None:
-            csv_suffix = '_' + self.config.test_suffix 
-        self.eval_mode()
+        self.prepare_eval()
         logger.info("Start evaluation.")
-
-        res_list = []
-        column_names = ['audio_filepath', 
-                        'dataset', 
-                        'attack_type', 
-                        'attack_params', 
-                        'chunk_index']
-
-        sisnr_f = ScaleInvariantSignalNoiseRatio().to(self.device)
         
         self.seed_everything(self.config.random_seed_for_eval)
-        with torch.inference_mode():
-            num_items = 0  # Keep track of the number of batches proczessed
-            for ret in qqdm(self.test_loader):
-                audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
-                message = self.random_message(self.payload_bits, audio_chunks.shape[0])
-                y = audio_chunks.to(self.device)
-                message = message.to(self.device).to(torch.float32)
-
-                for b in range(y.shape[0]):
-                    cur_losses_log = {}
-                    audio_chunk = y[b]
-                    msg = message[b]
-                    y_wm, _ = self.encode_watermark(audio_chunk.view(-1), 
-                                                    msg, 
-                                                    show_progress=False)
-                    y_wm = y_wm.unsqueeze(0)
-
-                    args = {} if attack_params[b] is None else json.loads(attack_params[b])
-                    
-                    if att_types[b] == 'phase_shift':
-                        # During test and validation, the phase shift parameter is in seconds.
-                        args['shift'] = int(args['shift'] * self.config.sample_rate)   
-                    
-                    
-                    length = audio_chunk.shape[-1]
-                    y_wm_dirty = self.audio_attack(y_wm, attack_type=att_types[b], **args)[..., :length].squeeze(0)
-                    y_dirty = self.audio_attack(audio_chunk, attack_type=att_types[b], **args)[..., :length].squeeze(0)
-                    
-                    y_wm_dirty_decoded, _ = self.decode_watermark(y_wm_dirty.view(-1))
-                    y_wm_decoded, _  = self.decode_watermark(y_wm.view(-1))
-                    y_decoded, _ = self.decode_watermark(audio_chunk.view(-1))
-                    y_dirty_dicoded, _ = self.decode_watermark(y_dirty.view(-1))
-
-                    if y_wm_decoded is None:
-                        cur_losses_log['bitwise/clean'] = 0.0 
-                    else:
-                        cur_losses_log['bitwise/clean'] = torch.mean(((y_wm_decoded == message[b]).float())).item()
-                    if y_wm_dirty_decoded is None:
-                        cur_losses_log['bitwise/distorted'] = 0.0
-                    else:
-                        cur_losses_log['bitwise/distorted'] = torch.mean(((y_wm_dirty_decoded == message[b]).float())).item()
-                    if y_decoded is None:
-                        cur_losses_log['bitwise/no_watermark_clean'] = 0.0
-                    else:
-                        cur_losses_log['bitwise/no_watermark_clean'] = torch.mean(((y_decoded == message[b]).float())).item()
-                    if y_dirty_dicoded is None:
-                        cur_losses_log['bitwise/no_watermark_distorted'] = 0.0
-                    else:
-                        cur_losses_log['bitwise/no_watermark_distorted'] = torch.mean(((y_dirty_dicoded == message[b]).float())).item()
-
-                    hard_metics = {key.replace('bitwise/', 'hard/'): int(value == 1.0) for key, value in cur_losses_log.items()}
-                    cur_losses_log.update(hard_metics)
-                    
-                    if self.config.full_perceptual:
-                        perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=audio_filepaths[b],
-                                                                            start_time=start_times[b],
-                                                                            audio_duration=self.config.dataset.eval_seg_duration,
-                                                                            watermarked_audio=y_wm[b],
-                                                                            distorted_audio=y_dirty[b])
-                        cur_losses_log.update(perceptual_metrics)
-
-                    cur_losses_log['sisnr_wm'] =  sisnr_f(y_wm, audio_chunk).item()
-                    cur_losses_log['sisnr_attack'] =  sisnr_f(y_dirty, audio_chunk).item()
-
-                    log_dir = {f"{att_types[b]}/{key}": val for key, val in cur_losses_log.items()}
-                    self.exp_logger.log_metric(log_dir, step=num_items)
-
-                    num_items += 1
-                    res_list.append(
-                        [audio_filepaths[0], 
-                         datasets[0], 
-                         att_types[0], 
-                         attack_params[0], 
-                         chunk_indices[0].item()] + [val for val in cur_losses_log.values()]
-                    )
-            column_names += list(cur_losses_log.keys())    
-            df_result = pd.DataFrame(res_list, columns=column_names)
-
-        key_columns = ['bitwise/clean', 'bitwise/distorted', 'hard/clean', 'hard/distorted', 'sisnr_wm', 'sisnr_attack']
-
-        # per chunk aggregation
-        self.compute_agg(df_result, cur_losses_log.keys(), csv_suffix, key_columns, prefix='chunklv')
-
-        # write raw results to disk
-        if write_to_disk:
-            os.makedirs(self.test_results_dir, exist_ok=True)
-            if epoch_num is not None:
-                output_csv_filename = f'test_results_epoch{csv_suffix}{epoch_num}.csv'
+        self.run_eval_stages(embed_fn=self.embed_batch,
+                             attack_fn=self.attack_batch,
+                             detect_fn=self.detect_batch,
+                             metrics_fn=self.write_batch_metrics)
+
+        df_result = self.finalize_results(epoch_num=epoch_num, write_to_disk=write_to_disk)
+
+        return df_result, self.cur_losses_log
+
+    def embed_batch(
+        self,
+        ret: tuple
+    ) -> dict:
+        """
+        Watermark every row of a batch of the test loader.
+
+        Args:
+            ret: tuple
+                Batch returned by the test loader.
+
+        Returns:
+            dict: State of the batch passed to the following stages.
+        """
+        audio_chunks, audio_filepaths, datasets, att_types, attack_params, chunk_indices, start_times = ret
+        keys = [self.row_chunk_key(f, d, t) for f, d, t in zip(audio_filepaths, datasets, start_times.tolist())]
+        message = torch.cat([self.random_message(self.payload_bits, 1, generator=self.chunk_generator(key))
+                             for key in keys])
+        y = audio_chunks.to(self.device)
+        message = message.to(self.device).to(torch.float32)
+
+        y_wm = []
+        for b in range(y.shape[0]):
+            # add_watermark (with SNR retries) only runs once per chunk, not once per attack row
+            y_wm.append(self.embed_chunks([keys[b]],
+                                          lambda _: self.encode_watermark(y[b].view(-1),
+                                                                          message[b],
+                                                                          show_progress=False)[0].unsqueeze(0)))
+
+        return {'audio_filepaths': audio_filepaths, 
+                'datasets': datasets, 
+                'att_types': att_types, 
+                'attack_params': attack_params,
+                'chunk_indices': chunk_indices, 
+                'start_times': start_times, 
+                'keys': keys,
+                'message': message, 
+                'y': y, 
+                'y_wm': y_wm}
+
+    def attack_batch(
+        self,
+        batch: dict
+    ) -> dict:
+        """
+        Attack the watermarked and the original audio of every row of a batch.
+
+        Args:
+            batch: dict
+                State of the batch (see `embed_batch`).
+
+        Returns:
+            dict: State of the batch with the attacked audio.
+        """
+        # With attack_pool_workers > 0, the rows are attacked in parallel
+        futures = []
+        for b, audio_chunk in enumerate(batch['y']):
+            args = self.parse_attack_params(batch['att_types'][b], batch['attack_params'][b])
+            futures.append((self.audio_attack.submit(batch['y_wm'][b], attack_type=batch['att_types'][b], **args),
+                            self.attack_clean(audio_chunk, batch['keys'][b], batch['att_types'][b], batch['attack_params'][b],
+                                              shared=batch.get('shared_attacks'), **args)))
+
+        y_wm_dirty, y_dirty = [], []
+        for b, (y_wm_dirty_b, y_dirty_b) in enumerate(futures):
+            length = batch['y'][b].shape[-1]
+            y_wm_dirty.append(y_wm_dirty_b.result()[..., :length].squeeze(0))
+            y_dirty.append(y_dirty_b.result()[..., :length].squeeze(0))
+
+        batch.update({'y_wm_dirty': y_wm_dirty, 'y_dirty': y_dirty})
+        return batch
+
+    def detect_batch(
+        self,
+        batch: dict
+    ) -> dict:
+        """
+        Decode the watermarks of the attacked audio of every row of a batch.
+
+        Args:
+            batch: dict
+                State of the batch (see `attack_batch`).
+
+        Returns:
+            dict: State of the batch with the bitwise accuracies.
+        """
+        message = batch['message']
+        bitwise = []
+        for b, audio_chunk in enumerate(batch['y']):
+            cur_losses_log = {}
+            y_wm_dirty_decoded, _ = self.decode_watermark(batch['y_wm_dirty'][b].view(-1))
+            y_dirty_dicoded, _ = self.decode_watermark(batch['y_dirty'][b].view(-1))
+
+            # The sliding-window scans of the clean signals only run for the first attack row of each chunk
+            clean_metrics = self.clean_metrics(batch['keys'][b], 
+                                               lambda: self.compute_clean_metrics(batch['y_wm'][b], audio_chunk, message[b]))
+
+            cur_losses_log['bitwise/clean'] = clean_metrics['bitwise/clean']
+            if y_wm_dirty_decoded is None:
+                cur_losses_log['bitwise/distorted'] = 0.0
             else:
-                output_csv_filename = f'test_results{csv_suffix}.csv'
-        
-            df_result.to_csv(os.path.join(self.test_results_dir, output_csv_filename), 
-                             sep=self.csv_delimiter,
-                             index=False)
-        return df_result, cur_losses_log
+                cur_losses_log['bitwise/distorted'] = torch.mean(((y_wm_dirty_decoded == message[b]).float())).item()
+            cur_losses_log['bitwise/no_watermark_clean'] = clean_metrics['bitwise/no_watermark_clean']
+            if y_dirty_dicoded is None:
+                cur_losses_log['bitwise/no_watermark_distorted'] = 0.0
+            else:
+                cur_losses_log['bitwise/no_watermark_distorted'] = torch.mean(((y_dirty_dicoded == message[b]).float())).item()
+            bitwise.append(cur_losses_log)
+
+        batch['bitwise'] = bitwise
+        return batch
+
+    def write_batch_metrics(
+        self,
+        batch: dict
+    ):
+        """
+        Compute, log and write the metrics of every row of a batch.
+
+        Args:
+            batch: dict
+                State of the batch (see `detect_batch`).
+        """
+        att_types = batch['att_types']
+        for b, audio_chunk in enumerate(batch['y']):
+            y_wm, y_dirty = batch['y_wm'][b], batch['y_dirty'][b]
+            cur_losses_log = dict(batch['bitwise'][b])
+
+            hard_metics = {key.replace('bitwise/', 'hard/'): int(value == 1.0) for key, value in cur_losses_log.items()}
+            cur_losses_log.update(hard_metics)
+            
+            if self.config.full_perceptual:
+                perceptual_metrics = self.compute_perceptual_metrics(audio_filepath=batch['audio_filepaths'][b],
+                                                                    start_time=batch['start_times'][b],
+                                                                    audio_duration=self.config.dataset.eval_seg_duration,
+                                                                    watermarked_audio=y_wm,
+                                                                    distorted_audio=y_dirty)
+                cur_losses_log.update(perceptual_metrics)
+
+            cur_losses_log['sisnr_wm'] =  self.sisnr_f(y_wm, audio_chunk).item()
+            cur_losses_log['sisnr_attack'] =  self.sisnr_f(y_dirty, audio_chunk).item()
+
+            log_dir = {f"{att_types[b]}/{key}": val for key, val in cur_losses_log.items()}
+            self.exp_logger.log_metric(log_dir, step=self.num_items)
+
+            self.num_items += 1
+            self.write_result(audio_filepath=batch['audio_filepaths'][b],
+                              dataset=batch['datasets'][b],
+                              attack_type=att_types[b],
+                              attack_params=batch['attack_params'][b],
+                              chunk_index=batch['chunk_indices'][b].item(),
+                              metrics=cur_losses_log)
+            self.cur_losses_log = cur_losses_log
+
+    def compute_clean_metrics(
+        self,
+        y_wm: torch.Tensor,
+        audio_chunk: torch.Tensor,
+        message: torch.Tensor
+    ) -> dict:
+        """
+        Compute the attack-independent bitwise accuracies of a chunk.
+
+        Args:
+            y_wm: torch.Tensor
+                Watermarked audio of the chunk.
+            audio_chunk: torch.Tensor
+                Original audio of the chunk.
+            message: torch.Tensor
+                Payload embedded into the chunk.
+
+        Returns:
+            dict: 'bitwise/clean' and 'bitwise/no_watermark_clean' (0.0 if no pattern was found).
+        """
+        y_wm_decoded, _  = self.decode_watermark(y_wm.view(-1))
+        y_decoded, _ = self.decode_watermark(audio_chunk.view(-1))
+
+        return {
+            'bitwise/clean': 0.0 if y_wm_decoded is None else torch.mean(((y_wm_decoded == message).float())).item(),
+            'bitwise/no_watermark_clean': 0.0 if y_decoded is None else torch.mean(((y_decoded == message).float())).item()
+        }
 
     def custom_stft(
         self,
@@ -519,7 +598,8 @@ class SolverWavMark(Solver):
     @staticmethod
     def random_message(
         nbits: int,
-        batch_size: int
+        batch_size: int,
+        generator: Optional[torch.Generator] = None
     ) -> torch.Tensor:
         """
         Generate a random message as a 0/1 tensor.
@@ -529,6 +609,8 @@ class SolverWavMark(Solver):
                 Number of bits in the message.
             batch_size: int
                 Number of messages to generate.
+            generator: torch.Generator, optional
+                Random generator, e.g. seeded from the chunk key (see `Solver.chunk_generator`).
 
         Returns:
             torch.Tensor: Random message tensor.
@@ -536,4 +618,4 @@ class SolverWavMark(Solver):
         if nbits == 0:
             return torch.tensor([])
         
-        return torch.randint(0, 2, (batch_size, nbits))
+        return torch.randint(0, 2, (batch_size, nbits), generator=generator)
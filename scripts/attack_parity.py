@@ -0,0 +1,384 @@
+"""
+Parity checks between optimized attack implementations and the reference implementations they replace.
+
+Example:
+    python scripts/attack_parity.py --checks aac_delay --ffmpeg4codecs ffmpeg/ffmpeg-7.0.2-amd64-static/ffmpeg
+    python scripts/attack_parity.py --checks dynamics time_stretch --sr 44100 --duration 10
+
+Exits with a non-zero status if any check fails.
+"""
+import argparse
+import shutil
+import sys
+
+import torch
+from loguru import logger
+
+
+def reference_aac_delay(reference: torch.Tensor,
+                        signal: torch.Tensor) -> int:
+    """Encoder delay search of `get_aac` before the FFT alignment: exhaustive L1 sliding window."""
+    reference = reference.reshape(-1)
+    signal = signal.reshape(-1)
+    length = reference.shape[-1]
+    min_distance = float('inf')
+    min_index = -1
+    for index in range(signal.shape[-1] - length + 1):
+        l1_distance = torch.sum(torch.abs(signal[index:index + length] - reference))
+        if l1_distance < min_distance:
+            min_distance = l1_distance
+            min_index = index
+    return min_index
+
+
+def check_aac_delay(args) -> bool:
+    """`find_delay` against the exhaustive search, on simulated and (if ffmpeg is available) real AAC outputs."""
+    from raw_bench.attacks.compression import ffmpeg_roundtrip, find_delay
+
+    generator = torch.Generator().manual_seed(args.seed)
+    cases = []
+
+    # Simulated codec: delay, low-pass filtering, quantization noise and trailing padding
+    kernel = torch.tensor([0.25, 0.5, 0.25]).view(1, 1, -1)
+    for i in range(args.num_cases):
+        length = int(args.sr * args.duration)
+        reference = 0.1 * torch.randn(length, generator=generator)
+        delay = int(torch.randint(0, 2048, (1,), generator=generator))
+        padding = int(torch.randint(1, 1024, (1,), generator=generator))
+        filtered = torch.nn.functional.conv1d(reference.view(1, 1, -1), kernel, padding=1).view(-1)
+        signal = torch.cat([torch.zeros(delay), filtered, torch.zeros(padding)])
+        signal = signal + 1e-3 * torch.randn(signal.shape, generator=generator)
+        cases.append((f'simulated-{i}', reference, signal))
+
+    # Real AAC round-trips
+    ffmpeg = args.ffmpeg4codecs or shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning("aac_delay: ffmpeg not found, only simulated codec outputs are checked.")
+    else:
+        for i in range(args.num_cases):
+            length = int(args.sr * args.duration)
+            t = torch.arange(length) / args.sr
+            reference = 0.1 * torch.sin(2 * torch.pi * (200 + 100 * i) * t) + 0.02 * torch.randn(length, generator=generator)
+            for bitrate in ['64k', '128k']:
+                signal = ffmpeg_roundtrip(reference.view(1, -1), args.sr, ['-b:a', bitrate, '-c:a', 'aac'],
+                                          container='adts', ffmpeg4codecs=ffmpeg)
+                if signal.shape[-1] > length:
+                    cases.append((f'aac-{bitrate}-{i}', reference, signal))
+
+    passed = True
+    for name, reference, signal in cases:
+        expected = reference_aac_delay(reference, signal)
+        actual = find_delay(reference, signal, max_delay=args.max_delay)
+        if actual != expected:
+            passed = False
+            logger.error(f"aac_delay/{name}: find_delay={actual}, reference={expected}")
+        else:
+            logger.info(f"aac_delay/{name}: delay={actual}")
+
+    return passed
+
+
+def check_codec_delay(args) -> bool:
+    """Calibrated AAC delay (impulse probe) against the delay searched for every signal."""
+    from raw_bench.attacks.compression import ffmpeg_roundtrip, find_delay, measure_codec_delay
+
+    ffmpeg = args.ffmpeg4codecs or shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning("codec_delay: ffmpeg not found, skipped.")
+        return True
+
+    generator = torch.Generator().manual_seed(args.seed)
+    passed = True
+    for bitrate in ['64k', '128k', '256k']:
+        def roundtrip(stream):
+            return ffmpeg_roundtrip(stream, args.sr, ['-b:a', bitrate, '-c:a', 'aac'],
+                                    container='adts', ffmpeg4codecs=ffmpeg)
+
+        calibrated = measure_codec_delay(roundtrip, args.sr)
+        for i in range(args.num_cases):
+            reference = 0.1 * torch.randn(1, int(args.sr * args.duration), generator=generator)
+            searched = find_delay(reference, roundtrip(reference), max_delay=args.max_delay)
+            if searched != calibrated:
+                passed = False
+                logger.error(f"codec_delay/aac-{bitrate}-{i}: calibrated={calibrated}, searched={searched}")
+            else:
+                logger.info(f"codec_delay/aac-{bitrate}-{i}: delay={calibrated}")
+
+    return passed
+
+
+def check_codec_pipe(args) -> bool:
+    """`ffmpeg_roundtrip` (pipes for streamable containers) against the temporary-file round-trip, for every codec."""
+    from raw_bench.attacks.compression import _ffmpeg_roundtrip_tempfile, ffmpeg_roundtrip, find_delay
+
+    ffmpeg = args.ffmpeg4codecs or shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning("codec_pipe: ffmpeg not found, skipped.")
+        return True
+
+    generator = torch.Generator().manual_seed(args.seed)
+    # Encoder settings of `get_mp3`, `get_aac` and `get_vorbis` at 64k and 128k (Vorbis is set by quality)
+    codecs = [('mp3', 'mp3', {bitrate: ['-b:a', bitrate, '-c:a', 'libmp3lame'] for bitrate in ['64k', '128k']}),
+              ('aac', 'adts', {bitrate: ['-b:a', bitrate, '-c:a', 'aac'] for bitrate in ['64k', '128k']}),
+              ('vorbis', 'ogg', {'64k': ['-aq', '0', '-c:a', 'libvorbis'], '128k': ['-aq', '4', '-c:a', 'libvorbis']})]
+    passed = True
+    for codec, container, settings in codecs:
+        for bitrate, codec_args in settings.items():
+            for i in range(args.num_cases):
+                length = int(args.sr * args.duration)
+                t = torch.arange(length) / args.sr
+                reference = 0.1 * torch.sin(2 * torch.pi * (200 + 100 * i) * t) + 0.02 * torch.randn(length, generator=generator)
+                reference = reference.view(1, -1)
+                piped = ffmpeg_roundtrip(reference, args.sr, codec_args, container=container, ffmpeg4codecs=ffmpeg)
+                expected = _ffmpeg_roundtrip_tempfile(reference, args.sr, codec_args, container=container, ffmpeg=ffmpeg)
+
+                # Extra leading samples of the piped output (or of the file output, if negative)
+                common = min(piped.shape[-1], expected.shape[-1]) - args.max_pipe_delay
+                padded = torch.nn.functional.pad(piped, (args.max_pipe_delay, 0))
+                offset = find_delay(expected[..., :common], padded, max_delay=2 * args.max_pipe_delay) - args.max_pipe_delay
+                error = (piped[..., :common] - expected[..., :common]).abs().max().item()
+                case = f"codec_pipe/{codec}-{bitrate}-{i}"
+                if offset != 0 or error > args.max_pipe_error:
+                    passed = False
+                    logger.error(f"{case}: offset={offset}, error={error:.2e} "
+                                 f"(lengths: pipe={piped.shape[-1]}, file={expected.shape[-1]})")
+                else:
+                    logger.info(f"{case}: error={error:.2e}")
+
+    return passed
+
+
+def check_codec_batching(args) -> bool:
+    """Every item of a batched codec round-trip (`codec_batching`) against the same item encoded alone, after the
+    same leading guard, and against the same batch in another order."""
+    from raw_bench.attacks.compression import get_aac, get_mp3, get_vorbis
+
+    ffmpeg = args.ffmpeg4codecs or shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning("codec_batching: ffmpeg not found, skipped.")
+        return True
+
+    generator = torch.Generator().manual_seed(args.seed)
+    length = int(args.sr * args.duration)
+    t = torch.arange(length) / args.sr
+    # Items of very different levels and spectra, so that the bit reservoir and rate control have to adapt
+    items = []
+    for i in range(args.num_cases):
+        level = 0.5 if i % 2 == 0 else 0.01
+        items.append(level * torch.sin(2 * torch.pi * (200 + 300 * i) * t) + level * 0.2 * torch.randn(length, generator=generator))
+    batch = torch.stack(items).view(len(items), 1, length)
+    permutation = torch.randperm(len(items), generator=generator)
+
+    passed = True
+    for codec, codec_fn in [('mp3', get_mp3), ('aac', get_aac), ('vorbis', get_vorbis)]:
+        for bitrate in ['64k', '128k']:
+            def roundtrip(audio):
+                return codec_fn(audio, args.sr, bitrate=bitrate, ffmpeg4codecs=ffmpeg, batched=True)
+
+            batched = roundtrip(batch)
+            permuted = torch.empty_like(batched)
+            permuted[permutation] = roundtrip(batch[permutation])
+            for b in range(len(items)):
+                alone = roundtrip(batch[b:b + 1])[0]
+                error = (batched[b] - alone).abs().max().item()
+                permuted_error = (permuted[b] - alone).abs().max().item()
+                case = f"codec_batching/{codec}-{bitrate}/{b}"
+                if max(error, permuted_error) > args.max_batching_error:
+                    passed = False
+                    logger.error(f"{case}: error={error:.2e}, permuted error={permuted_error:.2e}")
+                else:
+                    logger.info(f"{case}: error={error:.2e}, permuted error={permuted_error:.2e}")
+
+    return passed
+
+
+def reference_dynamic_range_compression(audio: torch.Tensor,
+                                        threshold: float,
+                                        ratio: float,
+                                        sr: int) -> torch.Tensor:
+    """`dynamic_range_compression` before the torch implementation: pydub's `compress_dynamic_range`."""
+    from pydub.effects import compress_dynamic_range
+    from raw_bench.utils import convert_pydub_to_torch, convert_torch_to_pydub
+
+    max_val = torch.max(torch.abs(audio))
+    audio_seg = convert_torch_to_pydub(audio=audio / max_val, sr=sr)
+    compressed_audio_seg = compress_dynamic_range(audio_seg, ratio=ratio, threshold=threshold)
+    return convert_pydub_to_torch(compressed_audio_seg) * max_val
+
+
+def reference_dynamic_range_expansion(audio: torch.Tensor,
+                                      threshold: float,
+                                      ratio: float,
+                                      sr: int,
+                                      attack: float = 5.0,
+                                      release: float = 50.0) -> torch.Tensor:
+    """`dynamic_range_expansion` before the O(N) implementation: RMS of the attack window and gain frame by frame."""
+    from pydub.utils import audioop, db_to_float, ratio_to_db
+    from raw_bench.utils import convert_pydub_to_torch, convert_torch_to_pydub
+
+    max_val = torch.max(torch.abs(audio))
+    seg = convert_torch_to_pydub(audio=audio / max_val, sr=sr)
+
+    thresh_rms = seg.max_possible_amplitude * db_to_float(threshold)
+    look_frames = int(seg.frame_count(ms=attack))
+    attack_frames = seg.frame_count(ms=attack)
+    release_frames = seg.frame_count(ms=release)
+    output = []
+    amplification = 0.0
+    for i in range(int(seg.frame_count())):
+        rms_now = seg.get_sample_slice(i - look_frames, i).rms
+        db_over_threshold = 0.0 if rms_now == 0 else max(ratio_to_db(rms_now / thresh_rms), 0)
+        max_amplification = (ratio - 1) * db_over_threshold
+        if rms_now > thresh_rms and amplification <= max_amplification:
+            amplification = min(amplification + max_amplification / attack_frames, max_amplification)
+        else:
+            amplification = max(amplification - max_amplification / release_frames, 0)
+        frame = seg.get_frame(i)
+        if amplification != 0.0:
+            frame = audioop.mul(frame, seg.sample_width, db_to_float(-amplification))
+        output.append(frame)
+
+    return convert_pydub_to_torch(seg._spawn(data=b''.join(output))) * max_val
+
+
+def dynamics_signals(args,
+                 generator: torch.Generator) -> list:
+    """Amplitude-modulated noise and tone bursts, with levels crossing the thresholds of the dynamics attacks."""
+    length = int(args.sr * args.duration)
+    t = torch.arange(length) / args.sr
+    signals = []
+    for i in range(args.num_cases):
+        envelope = 0.1 + torch.sin(2 * torch.pi * (1 + i) * t).abs()
+        signals.append((f'noise-{i}', 0.3 * envelope * torch.randn(length, generator=generator)))
+        bursts = (torch.sin(2 * torch.pi * (2 + i) * t) > 0).float() * 0.9 + 0.05
+        signals.append((f'bursts-{i}', bursts * torch.sin(2 * torch.pi * (220 + 110 * i) * t)))
+    return [(name, signal.view(1, 1, -1)) for name, signal in signals]
+
+
+def check_dynamics(args) -> bool:
+    """Torch dynamic range compression, limiter and expansion against the pydub implementations, item by item and batched."""
+    from raw_bench.attacks.dynamics import dynamic_range_compression, dynamic_range_expansion
+
+    generator = torch.Generator().manual_seed(args.seed)
+    signals = dynamics_signals(args, generator)
+    passed = True
+    for attack, ratio in [('compression', 4.0), ('compression', 2.0), ('limiter', torch.inf), 
+                          ('expansion', 2.0), ('expansion', 4.0)]:
+        if attack == 'expansion':
+            attack_fn, reference_fn = dynamic_range_expansion, reference_dynamic_range_expansion
+        else:
+            attack_fn, reference_fn = dynamic_range_compression, reference_dynamic_range_compression
+        for threshold in [-10.0, -20.0, -30.0]:
+            batch = torch.cat([signal for _, signal in signals], dim=0)
+            batched = attack_fn(batch, threshold=threshold, ratio=ratio, sr=args.sr)
+            for b, (name, signal) in enumerate(signals):
+                expected = reference_fn(signal, threshold, ratio, args.sr)
+                actual = attack_fn(signal, threshold=threshold, ratio=ratio, sr=args.sr)
+                # Differences in 16-bit steps of the normalized signal
+                error = ((actual - expected).abs() / signal.abs().max() * 32767).max().item()
+                batch_error = ((batched[b:b + 1] - actual).abs().max()).item()
+                case = f"dynamics/{attack}-{ratio}-{threshold}/{name}"
+                if error > args.max_dynamics_error or batch_error > 0:
+                    passed = False
+                    logger.error(f"{case}: error={error:.2f} LSB, batched error={batch_error:.2e}")
+                else:
+                    logger.info(f"{case}: error={error:.2f} LSB")
+
+    return passed
+
+
+def snr_db(estimate: torch.Tensor,
+           reference: torch.Tensor) -> float:
+    """SNR (dB) of `estimate` against `reference`."""
+    return (10 * torch.log10(reference.pow(2).sum() / (estimate - reference).pow(2).sum().clamp(min=1e-30))).item()
+
+
+def check_time_stretch(args) -> bool:
+    """Torch phase-vocoder time stretch against `librosa.effects.time_stretch`, item by item and batched.
+
+    In float64, both implementations compute the same thing, so they must match closely (--min-time-stretch-snr).
+    In float32 (the attacks), the phases accumulated by librosa drift from the float64 ones, and so do
+    the torch ones, differently: the SNR against librosa in float32 is reported next to the SNR of
+    librosa in float32 against librosa in float64, which is the precision of the previous implementation.
+    """
+    import librosa
+    from raw_bench.attacks.low_level import time_stretch, time_stretch_wrapper
+
+    generator = torch.Generator().manual_seed(args.seed)
+    signals = [(name, signal.double()) for name, signal in dynamics_signals(args, generator)]
+    rates = [0.7, 0.75, 0.8, 0.9, 0.95, 1.05, 1.1, 1.25, 1.5]
+    passed = True
+    for name, signal in signals:
+        for rate in rates:
+            expected = torch.from_numpy(librosa.effects.time_stretch(signal.numpy()[0], rate=rate))
+            actual = time_stretch(signal, rate=rate)[0]
+            expected_float32 = torch.from_numpy(librosa.effects.time_stretch(signal.float().numpy()[0], rate=rate))
+            actual_float32 = time_stretch(signal.float(), rate=rate)[0]
+
+            case = f"time_stretch/{rate}/{name}"
+            if actual.shape != expected.shape:
+                passed = False
+                logger.error(f"{case}: length={actual.shape[-1]}, librosa={expected.shape[-1]}")
+                continue
+            snr = snr_db(actual, expected)
+            message = (f"{case}: SNR float64={snr:.1f} dB, float32={snr_db(actual_float32, expected_float32):.1f} dB "
+                       f"(librosa float32 against float64: {snr_db(expected_float32, expected.float()):.1f} dB)")
+            if snr < args.min_time_stretch_snr:
+                passed = False
+                logger.error(message)
+            else:
+                logger.info(message)
+
+    # Items with different rates, truncated or zero-padded to the input length as in `apply_time_stretch`
+    batch = torch.cat([signal for _, signal in signals], dim=0)
+    batch_rates = [rates[b % len(rates)] for b in range(batch.shape[0])]
+    batched = time_stretch_wrapper(batch, rate=batch_rates, length=batch.shape[-1])
+    for b, rate in enumerate(batch_rates):
+        single = time_stretch_wrapper(batch[b:b + 1], rate=rate, length=batch.shape[-1])
+        if not torch.allclose(batched[b:b + 1], single, atol=1e-9):
+            passed = False
+            logger.error(f"time_stretch/batched/{b}: differs from the item alone")
+
+    return passed
+
+
+CHECKS = {
+    'aac_delay': check_aac_delay,
+    'codec_batching': check_codec_batching,
+    'codec_delay': check_codec_delay,
+    'codec_pipe': check_codec_pipe,
+    'dynamics': check_dynamics,
+    'time_stretch': check_time_stretch,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', nargs='+', default=list(CHECKS), choices=list(CHECKS))
+    parser.add_argument('--sr', type=int, default=16000)
+    parser.add_argument('--duration', type=float, default=1.0, help="Duration of the test signals, in seconds.")
+    parser.add_argument('--num-cases', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-delay', type=int, default=8192, help="max_delay of find_delay (see get_aac).")
+    parser.add_argument('--ffmpeg4codecs', default=None)
+    parser.add_argument('--max-pipe-delay', type=int, default=4096,
+                        help="Largest offset searched between the piped and the file round-trips.")
+    parser.add_argument('--max-pipe-error', type=float, default=1e-4,
+                        help="Maximum difference between the piped and the file round-trips.")
+    parser.add_argument('--max-batching-error', type=float, default=1e-4,
+                        help="Maximum difference between an item of a batched codec round-trip and the item alone.")
+    parser.add_argument('--max-dynamics-error', type=float, default=1.0,
+                        help="Maximum difference of the dynamics attacks with pydub, in 16-bit steps.")
+    parser.add_argument('--min-time-stretch-snr', type=float, default=100.0,
+                        help="Minimum SNR (dB) of the time stretching against librosa, in float64.")
+    args = parser.parse_args()
+
+    failed = [name for name in args.checks if not CHECKS[name](args)]
+    if len(failed) > 0:
+        logger.error(f"Failed checks: {', '.join(failed)}")
+        sys.exit(1)
+    logger.info(f"All checks passed: {', '.join(args.checks)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Accuracy and speed of the inference modes of the neural codecs (neural_codec_inference) against fp32.
+
+The DAC and Encodec rows of the test manifest are evaluated once per inference mode, on the same fixed
+sample (the first --num-rows rows). For every mode, the report compares against fp32:
+- the time spent in the codec attacks on the original audio of the sample, and the speedup,
+- the SI-SNR of the attacked audio, with the fp32 output as reference,
+- the bitwise accuracy of the watermark detection after the attack, row by row.
+
+Example:
+    python scripts/codec_inference_report.py \
+        --config-name ../configs/audioseal/eval_strict.yaml \
+        --run-root runs/codec_inference/audioseal \
+        --modes bf16 compile \
+        device=cpu
+
+int8 only supports Encodec (DAC has no layer that dynamic quantization can quantize):
+    python scripts/codec_inference_report.py ... --modes int8 --attacks encodec
+
+The report is written to <run-root>/report.csv.
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+import torch
+from hydra import compose, initialize
+from loguru import logger
+from omegaconf import open_dict
+
+from eval_multi import get_solver_class
+from raw_bench.results import KEY_COLUMNS
+
+
+def si_snr(estimate: torch.Tensor,
+           reference: torch.Tensor) -> float:
+    """Scale-invariant SNR (dB) of `estimate` against `reference`."""
+    estimate = estimate.reshape(-1) - estimate.mean()
+    reference = reference.reshape(-1) - reference.mean()
+    target = torch.dot(estimate, reference) / torch.dot(reference, reference).clamp(min=1e-12) * reference
+    noise = estimate - target
+    return (10 * torch.log10(target.pow(2).sum().clamp(min=1e-12) / noise.pow(2).sum().clamp(min=1e-12))).item()
+
+
+def evaluate_mode(config,
+                  mode: str) -> dict:
+    """Attack the original audio of the sample with the codecs, then evaluate the sample with the watermark model."""
+    solver = get_solver_class(config.model_type)(config)
+    dataset = solver.test_loader.dataset
+
+    outputs = []
+    codec_time = 0.0
+    for index in range(len(dataset)):
+        audio, _, _, attack_type, attack_param, _, _ = dataset[index]
+        args = solver.parse_attack_params(attack_type, attack_param)
+        audio = audio.unsqueeze(0).to(solver.device)
+        if index == 0:
+            # Loads the codec (and compiles it in compile mode) outside of the timed calls
+            solver.audio_attack(audio, attack_type=attack_type, **args)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            outputs.append(solver.audio_attack(audio, attack_type=attack_type, **args).cpu())
+        codec_time += time.perf_counter() - start
+
+    df_result = solver.eval(write_to_disk=False)[0]
+    solver.close_eval()
+    logger.info(f"{mode}: {len(outputs)} rows, codec time: {codec_time:.2f} s")
+
+    return {'outputs': outputs, 'df_result': df_result, 'codec_time': codec_time}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config-name', required=True,
+                        help="Evaluation config of the watermark model (same value as --config-name of scripts/eval.py).")
+    parser.add_argument('--run-root', required=True,
+                        help="Each mode is evaluated in <run-root>/<mode>, the report is written to <run-root>/report.csv.")
+    parser.add_argument('--modes', nargs='+', default=['bf16', 'compile'], choices=['bf16', 'int8', 'compile'])
+    parser.add_argument('--attacks', nargs='+', default=['dac', 'encodec'], choices=['dac', 'encodec'])
+    parser.add_argument('--num-rows', type=int, default=32, help="Number of codec rows of the fixed sample.")
+    parser.add_argument('overrides', nargs='*', help="Hydra overrides (e.g. device=cpu).")
+    args = parser.parse_args()
+    if 'int8' in args.modes and 'dac' in args.attacks:
+        parser.error("int8 is not supported by DAC, run it with --attacks encodec.")
+
+    os.makedirs(args.run_root, exist_ok=True)
+    with initialize(version_base=None, config_path="../configs"):
+        config = compose(config_name=args.config_name, overrides=args.overrides)
+
+        # Fixed sample: the first codec rows of the manifest
+        df_manifest = pd.read_csv(config.dataset.test_path, delimiter='|')
+        df_sample = df_manifest[df_manifest['attack_type'].isin(args.attacks)].head(args.num_rows)
+        if len(df_sample) == 0:
+            raise ValueError(f"No {args.attacks} rows in {config.dataset.test_path}.")
+        sample_path = os.path.join(args.run_root, 'sample.csv')
+        df_sample.to_csv(sample_path, sep='|', index=False)
+        logger.info(f"Fixed sample of {len(df_sample)} rows written to {sample_path}")
+
+        results = {}
+        for mode in ['fp32'] + args.modes:
+            config = compose(config_name=args.config_name,
+                             overrides=args.overrides + [f"neural_codec_inference={mode}"])
+            with open_dict(config):
+                config.run_dir = os.path.join(args.run_root, mode)
+                config.dataset.test_path = sample_path
+                config.resume = False
+                config.wandb = False
+            results[mode] = evaluate_mode(config, mode)
+
+    reference = results['fp32']
+    rows = []
+    for mode, result in results.items():
+        sisnr = [si_snr(output, ref_output) for output, ref_output in zip(result['outputs'], reference['outputs'])]
+        df = reference['df_result'].merge(result['df_result'], on=KEY_COLUMNS, suffixes=('_fp32', ''))
+        delta = (df['bitwise/distorted'] - df['bitwise/distorted_fp32']).abs()
+        rows.append({'mode': mode,
+                     'codec_time_s': result['codec_time'],
+                     'speedup': reference['codec_time'] / max(result['codec_time'], 1e-9),
+                     'sisnr_vs_fp32_db': sum(sisnr) / len(sisnr),
+                     'min_sisnr_vs_fp32_db': min(sisnr),
+                     'bitwise/distorted': df['bitwise/distorted'].mean(),
+                     'bitwise_delta_mean': delta.mean(),
+                     'bitwise_delta_max': delta.max(),
+                     'rows_changed': int((delta > 0).sum()),
+                     'rows': len(df)})
+
+    df_report = pd.DataFrame(rows)
+    report_path = os.path.join(args.run_root, 'report.csv')
+    df_report.to_csv(report_path, index=False)
+    logger.info(f"Inference modes against fp32 (written to {report_path}):\n{df_report.to_string(index=False)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,30 +3,33 @@ import hydra
 @hydra.main(version_base=None, config_path="../configs", config_name="eval.yaml")
 def main(config):
     if config.model_type == 'silentcipher':
-        from raw_bench.solver import SolverSilentCipher
-        solver = SolverSilentCipher(config)
+        from raw_bench.solver import SolverSilentCipher as SolverClass
 
     elif config.model_type == 'audioseal':
-        from raw_bench.solver import SolverAudioSeal        
-        solver = SolverAudioSeal(config)
+        from raw_bench.solver import SolverAudioSeal as SolverClass
 
     elif config.model_type == 'timbre':
-        from raw_bench.solver import SolverTimbre
-        solver = SolverTimbre(config)
+        from raw_bench.solver import SolverTimbre as SolverClass
 
     elif config.model_type == 'wavmark':
-        from raw_bench.solver import SolverWavMark
-        solver = SolverWavMark(config)
+        from raw_bench.solver import SolverWavMark as SolverClass
     else:   
         raise ValueError(f"Entered model type {config.model_type} not supported!")
-        
+
+    assert config.mode == 'test'
+
+    # Combine the results of all the evaluation shards and aggregate them once
+    if config.get("merge", False):
+        SolverClass.merge_results(config)
+        return
+
     if config.checkpoint is None:
         raise ValueError("checkpoint must be provided in test mode")
-    
-    assert config.mode == 'test'
+
+    solver = SolverClass(config)
     solver.eval(write_to_disk=True)
     solver.close_eval()
     
  
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
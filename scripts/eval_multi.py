@@ -0,0 +1,71 @@
+"""
+Evaluate several watermarking models in a single pass over the test set.
+
+The models share the data loading, the attacks on the original audio and the perceptual references,
+so each of them only pays for its own embedding, attacks on its watermarked audio and detection.
+
+Example:
+    python scripts/eval_multi.py \
+        --config-names ../configs/audioseal/eval_strict.yaml ../configs/wavmark/eval_strict.yaml \
+        --run-root runs/all_on_strict \
+        ffmpeg4codecs=ffmpeg/ffmpeg-7.0.2-amd64-static/ffmpeg
+
+The results of each model are written to <run-root>/<model_type>, as with scripts/eval.py.
+"""
+import argparse
+import os
+
+from hydra import compose, initialize
+from omegaconf import open_dict
+
+
+def get_solver_class(model_type: str):
+    if model_type == 'silentcipher':
+        from raw_bench.solver import SolverSilentCipher as SolverClass
+
+    elif model_type == 'audioseal':
+        from raw_bench.solver import SolverAudioSeal as SolverClass
+
+    elif model_type == 'timbre':
+        from raw_bench.solver import SolverTimbre as SolverClass
+
+    elif model_type == 'wavmark':
+        from raw_bench.solver import SolverWavMark as SolverClass
+    else:
+        raise ValueError(f"Entered model type {model_type} not supported!")
+
+    return SolverClass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config-names', nargs='+', required=True,
+                        help="Evaluation config of each model (same values as --config-name of scripts/eval.py).")
+    parser.add_argument('--run-root', default=None,
+                        help="Each model is evaluated in <run-root>/<model_type> (default: run_dir of each config).")
+    parser.add_argument('overrides', nargs='*',
+                        help="Hydra overrides applied to every config (e.g. ffmpeg4codecs=...).")
+    args = parser.parse_args()
+
+    from raw_bench.solver import MultiSolver
+
+    configs = []
+    with initialize(version_base=None, config_path="../configs"):
+        for config_name in args.config_names:
+            config = compose(config_name=config_name, overrides=args.overrides)
+            assert config.mode == 'test'
+            if config.checkpoint is None:
+                raise ValueError(f"checkpoint must be provided in test mode ({config_name})")
+            if args.run_root is not None:
+                with open_dict(config):
+                    config.run_dir = os.path.join(args.run_root, config.model_type)
+            configs.append(config)
+
+    solvers = [get_solver_class(config.model_type)(config) for config in configs]
+    solver = MultiSolver(solvers)
+    solver.eval(write_to_disk=True)
+    solver.close_eval()
+
+
+if __name__ == '__main__':
+    main()